@@ -0,0 +1,459 @@
+import asyncio
+import fnmatch
+import os
+import posixpath
+import shlex
+import stat
+import time
+from contextlib import contextmanager
+
+import asyncssh
+import paramiko
+
+from backups import GENERATIONS, backup_directory, match_backups, snapshot_command
+from catalog import AmbiguousFileError
+from checksum import CHECKSUM_COMMANDS
+from inventory import INVENTORY_PATH, load_inventory
+from listings import RemoteEntry
+from sshpool import HostKeyCache
+from telemetry import Telemetry
+from transfercache import mapped
+from worker import TransferCancelled
+
+# Size of one SFTP read or write request, and how many of them a transfer keeps in flight
+BLOCK_SIZE = 64 * 1024
+MAX_REQUESTS = 128
+
+# Commands open a channel each, OpenSSH allows 10 per connection unless the server sets MaxSessions
+CHANNELS_PER_HOST = 10
+
+
+class HostKeyClient(asyncssh.SSHClient):
+    # Checks server keys against the same known_hosts cache as the paramiko pool: trusted on first use, refused when changed
+    def __init__(self, host_keys, hostname):
+        self.host_keys = host_keys
+        self.hostname = hostname
+        self.closed = False
+
+    def validate_host_public_key(self, host, addr, port, key):
+        try:
+            self.host_keys.check(self.hostname, paramiko.PKey.from_type_string(key.get_algorithm(), key.public_data))
+        except paramiko.BadHostKeyException:
+            return False
+        return True
+
+    def connection_lost(self, exc):
+        self.closed = True
+
+
+class HostConnection:
+    # One SSH connection per host, its channels are multiplexed instead of opening a session per operation
+    def __init__(self, client, connection, sftp, channels, tunnelled=False):
+        self.client = client
+        self.connection = connection
+        self.sftp = sftp
+        self.channels = channels
+        self.tunnelled = tunnelled
+
+    async def close(self):
+        self.sftp.exit()
+        self.connection.close()
+        await self.connection.wait_closed()
+
+
+def connect_options(server_info):
+    # The asyncssh counterpart of sshpool.connect_kwargs
+    options = {"username": server_info["username"]}
+    if server_info.get("key_filename"):
+        options["client_keys"] = [server_info["key_filename"]]
+    if server_info.get("password"):
+        options["password"] = server_info["password"]
+        if not server_info.get("key_filename"):
+            options["client_keys"] = None
+    if "client_keys" in options or "password" in options:
+        # Only the configured credential is offered, no round trips for agent or default keys first
+        options["agent_path"] = None
+    options["compression_algs"] = ["zlib@openssh.com", "zlib", "none"] if server_info.get("compress") else ["none"]
+    if server_info.get("ciphers"):
+        # The preferred ciphers go first, the defaults stay available for servers without them
+        options["encryption_algs"] = "^" + ",".join(server_info["ciphers"])
+    return options
+
+
+@contextmanager
+def sftp_errors(path):
+    # SFTP errors surface as the same exceptions the paramiko path raises
+    try:
+        yield
+    except asyncssh.SFTPNoSuchFile as e:
+        raise FileNotFoundError(f"{path}: {e.reason}") from e
+    except asyncssh.SFTPPermissionDenied as e:
+        raise PermissionError(f"{path}: {e.reason}") from e
+
+
+def entry_from_attrs(name, attrs):
+    return RemoteEntry(name, stat.S_ISDIR(attrs.permissions or 0), attrs.size, attrs.mtime)
+
+
+async def run_all(coroutines):
+    # Runs the coroutines together, the first failure cancels the rest and is raised
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Cancelled tasks get to close their files before the error goes up
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception():
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
+class AsyncTransferEngine:
+    # The list, stat, find, get, put, backup and transfer operations of TransferEngine on asyncio and asyncssh.
+    # Hundreds of operations share one connection per host instead of a thread and a session each;
+    # cancelling the task stops an operation at its next request.
+    def __init__(self, servers=None, inventory_path=INVENTORY_PATH, known_hosts_path="known_hosts",
+                 catalog_roots=("/app/mf/cer",), block_size=BLOCK_SIZE, max_requests=MAX_REQUESTS,
+                 backup_generations=GENERATIONS, connect_timeout=15, metrics_log=None):
+        self.servers = servers if servers is not None else load_inventory(inventory_path)
+        self.catalog_roots = list(catalog_roots)
+        self.block_size = block_size
+        self.max_requests = max_requests
+        self.backup_generations = backup_generations
+        self.connect_timeout = connect_timeout
+        self.host_keys = HostKeyCache(known_hosts_path)
+        self.telemetry = Telemetry(metrics_log)
+        self.handshakes = 0
+        self._hosts = {}
+        self._connecting = {}
+
+    def get_server_info(self, server_name):
+        server_info = self.servers.get(server_name)
+        if server_info is None:
+            raise ValueError(f"Server '{server_name}' not found in server list.")
+        return server_info
+
+    async def host(self, server_info):
+        key = (server_info["hostname"], server_info.get("port", 22), server_info["username"])
+        lock = self._connecting.setdefault(key, asyncio.Lock())
+        # Concurrent operations on a new host wait for the one connection instead of opening their own
+        async with lock:
+            host = self._hosts.get(key)
+            if host is None or host.client.closed:
+                host = self._hosts[key] = await self._connect(server_info)
+        return host
+
+    async def _connect(self, server_info):
+        hostname = server_info["hostname"]
+        port = server_info.get("port", 22)
+        tunnel = None
+        if server_info.get("jump"):
+            # Tunnelled through the jump host, which resolves the name itself
+            tunnel = (await self.host(server_info["jump"])).connection
+        # Host keys are stored under the same name as paramiko uses
+        key_name = hostname if port == 22 else f"[{hostname}]:{port}"
+        client = None
+
+        def client_factory():
+            nonlocal client
+            client = HostKeyClient(self.host_keys, key_name)
+            return client
+
+        # The TCP connect and the SSH handshake are one step in asyncssh
+        with self.telemetry.phase("handshake", hostname):
+            # An empty known_hosts list leaves every key to HostKeyClient
+            connection = await asyncio.wait_for(
+                asyncssh.connect(hostname if tunnel else server_info.get("address") or hostname, port, tunnel=tunnel,
+                                 known_hosts=[], client_factory=client_factory, **connect_options(server_info)),
+                self.connect_timeout)
+            sftp = await connection.start_sftp_client()
+        self.handshakes += 1
+        channels = asyncio.Semaphore(min(server_info.get("max_sessions", CHANNELS_PER_HOST), CHANNELS_PER_HOST))
+        return HostConnection(client, connection, sftp, channels, tunnelled=tunnel is not None)
+
+    async def run(self, server_info, command):
+        # Runs a command to completion and returns its exit status, stdout and stderr
+        host = await self.host(server_info)
+        async with host.channels:
+            result = await host.connection.run(command, check=False)
+        return result.exit_status, result.stdout, result.stderr
+
+    async def list(self, server_name, directory):
+        # Entries of a directory as RemoteEntry tuples, like TransferEngine.list_entries
+        host = await self.host(self.get_server_info(server_name))
+        with sftp_errors(directory):
+            names = await host.sftp.readdir(directory)
+        return [entry_from_attrs(name.filename, name.attrs) for name in names if name.filename not in (".", "..")]
+
+    async def stat(self, server_name, path):
+        host = await self.host(self.get_server_info(server_name))
+        with sftp_errors(path):
+            attrs = await host.sftp.stat(path)
+        return entry_from_attrs(posixpath.basename(path), attrs)
+
+    async def find(self, server_name, file_path):
+        # The requested path first, otherwise a file with the same name under the catalog roots, "" when there is none
+        server_info = self.get_server_info(server_name)
+        try:
+            await self.stat(server_name, file_path)
+            return file_path
+        except FileNotFoundError:
+            pass
+        roots = " ".join(shlex.quote(root) for root in self.catalog_roots)
+        with self.telemetry.phase("lookup", server_info["hostname"]):
+            status, output, errors = await self.run(
+                server_info, f"find {roots} -name {shlex.quote(posixpath.basename(file_path))} -type f 2>/dev/null")
+        matches = [{"path": path} for path in output.splitlines() if path]
+        if len(matches) > 1:
+            raise AmbiguousFileError(posixpath.basename(file_path), server_info["hostname"], matches)
+        return matches[0]["path"] if matches else ""
+
+    async def checksum(self, server_info, path):
+        # (algorithm, digest) like checksum.remote_checksum
+        for command in CHECKSUM_COMMANDS:
+            status, output, errors = await self.run(server_info, f"{command} {shlex.quote(path)}")
+            if status == 0:
+                return command[:-3], output.split()[0]
+            if "No such file" in errors:
+                raise FileNotFoundError(f"{path}: {errors.strip()}")
+        raise IOError(f"No checksum command available to check {path}")
+
+    async def is_identical(self, source_server, source_path, destination_server, destination_path):
+        # Size and mtime first, the checksums only run when those are not conclusive, like checksum.files_identical
+        try:
+            source, destination = await asyncio.gather(self.stat(source_server, source_path),
+                                                       self.stat(destination_server, destination_path))
+        except FileNotFoundError:
+            return False
+        if source.size != destination.size:
+            return False
+        if source.mtime == destination.mtime:
+            return True
+        source_checksum, destination_checksum = await asyncio.gather(
+            self.checksum(self.get_server_info(source_server), source_path),
+            self.checksum(self.get_server_info(destination_server), destination_path))
+        return source_checksum == destination_checksum
+
+    async def makedirs(self, server_name, directory):
+        host = await self.host(self.get_server_info(server_name))
+        with sftp_errors(directory):
+            await host.sftp.makedirs(directory, exist_ok=True)
+
+    async def pipeline(self, size, read, write, progress=None):
+        # Keeps max_requests block reads and writes in flight, so a transfer is not one round trip per block
+        offsets = iter(range(0, size, self.block_size))
+        transferred = 0
+
+        async def copy_blocks():
+            nonlocal transferred
+            for offset in offsets:
+                length = min(self.block_size, size - offset)
+                data = b""
+                # Servers may answer with fewer bytes than asked for
+                while len(data) < length:
+                    chunk = await read(offset + len(data), length - len(data))
+                    if not chunk:
+                        raise EOFError(f"File ended at {offset + len(data)} of {size} bytes")
+                    data += chunk
+                await write(offset, data)
+                transferred += length
+                if progress:
+                    # TransferProgress raises TransferCancelled here once the transfer is cancelled
+                    progress(transferred, size)
+
+        workers = min(self.max_requests, -(-size // self.block_size))
+        await run_all(copy_blocks() for _ in range(workers))
+        return transferred
+
+    async def get(self, server_name, remote_path, local_path, progress=None):
+        # Downloads into local_path.part, which replaces local_path only when complete
+        server_info = self.get_server_info(server_name)
+        host = await self.host(server_info)
+        part_path = local_path + ".part"
+        with self.telemetry.phase("download", server_info["hostname"], "local") as measurement, \
+                sftp_errors(remote_path):
+            async with host.sftp.open(remote_path, "rb") as remote_file:
+                size = (await remote_file.stat()).size
+                with open(part_path, "wb") as local_file:
+
+                    async def write(offset, data):
+                        local_file.seek(offset)
+                        local_file.write(data)
+
+                    try:
+                        measurement.bytes = await self.pipeline(
+                            size, lambda offset, length: remote_file.read(length, offset), write, progress)
+                    except BaseException:
+                        local_file.close()
+                        os.remove(part_path)
+                        raise
+        os.replace(part_path, local_path)
+        return size
+
+    async def put(self, local_path, server_name, remote_path, progress=None):
+        # Uploads into remote_path.part, which is renamed over remote_path only when complete
+        server_info = self.get_server_info(server_name)
+        host = await self.host(server_info)
+        part_path = remote_path + ".part"
+        with self.telemetry.phase("upload", "local", server_info["hostname"]) as measurement, \
+                mapped(local_path) as view, sftp_errors(remote_path):
+
+            async def read(offset, length):
+                with view[offset:offset + length] as data:
+                    return bytes(data)
+
+            async with host.sftp.open(part_path, "wb") as part_file:
+                try:
+                    measurement.bytes = await self.pipeline(
+                        len(view), read, lambda offset, data: part_file.write(data, offset), progress)
+                except BaseException:
+                    await asyncio.shield(self.remove_quietly(host, part_path))
+                    raise
+            await host.sftp.posix_rename(part_path, remote_path)
+        return measurement.bytes
+
+    async def remove_quietly(self, host, path):
+        try:
+            await host.sftp.remove(path)
+        except asyncssh.SFTPError:
+            pass
+
+    async def backup(self, server_name, file_path):
+        # A snapshot next to the file on the server, like TransferEngine.create_backup in server mode.
+        # Returns the snapshot path, None when the file does not exist.
+        server_info = self.get_server_info(server_name)
+        host = await self.host(server_info)
+        backup_path, command = snapshot_command(file_path)
+        with self.telemetry.phase("backup", server_info["hostname"]):
+            status, output, errors = await self.run(server_info, command)
+            if status == 3:
+                return None
+            if status == 4:
+                return output.strip()
+            if status != 0:
+                raise IOError(f"Failed to back up {file_path}: {errors.strip()}")
+            names = await host.sftp.readdir(backup_directory(file_path))
+            expired = match_backups(file_path, ((name.filename, name.attrs.size) for name in names))
+            await run_all(host.sftp.remove(backup.path) for backup in expired[self.backup_generations:])
+        return backup_path
+
+    async def transfer(self, source_server, source_file_path, destination_server, remote_path, progress=None,
+                       skip_identical=True):
+        # Relays the file from the source server to the destination server, backing up the file it replaces.
+        # Files already identical on the destination are skipped entirely, like TransferEngine.transfer.
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+        # The destination is only backed up once the source is found, a missing or ambiguous one changes nothing
+        remote_file_path = await self.find(source_server, source_file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {source_file_path} not found on {source_server}")
+        if skip_identical and await self.is_identical(source_server, remote_file_path, destination_server, remote_path):
+            return {"skipped": True, "size": 0}
+        await self.backup(destination_server, remote_path)
+
+        started = time.monotonic()
+        source, destination = await asyncio.gather(self.host(source_info), self.host(destination_info))
+        part_path = remote_path + ".part"
+        with self.telemetry.phase("stream", source_info["hostname"], destination_info["hostname"]) as measurement:
+            with sftp_errors(remote_file_path):
+                source_file = await source.sftp.open(remote_file_path, "rb")
+            async with source_file:
+                size = (await source_file.stat()).size
+                with sftp_errors(remote_path):
+                    async with destination.sftp.open(part_path, "wb") as part_file:
+                        try:
+                            measurement.bytes = await self.pipeline(
+                                size, lambda offset, length: source_file.read(length, offset),
+                                lambda offset, data: part_file.write(data, offset), progress)
+                        except BaseException:
+                            await asyncio.shield(self.remove_quietly(destination, part_path))
+                            raise
+                    await destination.sftp.posix_rename(part_path, remote_path)
+        seconds = time.monotonic() - started
+        return {"size": size, "sent": size, "seconds": seconds, "throughput": size / seconds if seconds else 0}
+
+    async def expand(self, server_name, source_path):
+        # Glob patterns in the file name are matched against the directory listing, other paths are kept as they are
+        directory, pattern = posixpath.split(source_path)
+        if not any(character in pattern for character in "*?["):
+            return [source_path]
+        entries = await self.list(server_name, directory)
+        return sorted(posixpath.join(directory, entry.name) for entry in entries
+                      if not entry.is_dir and fnmatch.fnmatchcase(entry.name, pattern))
+
+    async def close(self):
+        hosts, self._hosts = list(self._hosts.values()), {}
+        # Tunnelled connections close before the jump hosts they run through
+        for host in sorted(hosts, key=lambda host: not host.tunnelled):
+            try:
+                await host.close()
+            except (OSError, asyncssh.Error):
+                pass
+        self.telemetry.close()
+
+
+async def transfer_files(engine, source_server, source_paths, destination_server, destination_path, concurrency=64,
+                         progress=None, skip_identical=True):
+    # Transfers every file at once, at most concurrency at a time; the summary has the shape of a batch summary.
+    # The destination directory is created when it does not exist, like BatchTransfer.ensure_remote_directory.
+    sources = [path for patterns in await asyncio.gather(*(engine.expand(source_server, path) for path in source_paths))
+               for path in patterns]
+    await engine.makedirs(destination_server, destination_path)
+    slots = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def transfer(source_path):
+        remote_path = posixpath.join(destination_path, posixpath.basename(source_path))
+        row = {"source": source_path, "destination": remote_path, "status": "done", "bytes": 0, "seconds": 0,
+               "result": None, "error": None}
+        async with slots:
+            transfer_started = time.monotonic()
+            try:
+                row["result"] = await engine.transfer(source_server, source_path, destination_server, remote_path,
+                                                      progress, skip_identical)
+                row["bytes"] = row["result"]["size"]
+                if row["result"].get("skipped"):
+                    row["status"] = "skipped"
+            except (TransferCancelled, asyncio.CancelledError):
+                row["status"] = "cancelled"
+                raise
+            except Exception as e:
+                row["status"] = "failed"
+                row["error"] = str(e)
+            row["seconds"] = round(time.monotonic() - transfer_started, 3)
+        return row
+
+    transfers = await asyncio.gather(*(transfer(path) for path in sources))
+    seconds = time.monotonic() - started
+    statuses = {}
+    for row in transfers:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    total_bytes = sum(row["bytes"] for row in transfers)
+    return {"items": len(transfers), "statuses": statuses, "bytes": total_bytes, "seconds": seconds,
+            "throughput": total_bytes / seconds if seconds else 0, "transfers": transfers}
+
+
+async def run_command(engine, args):
+    # The list, backup and transfer commands of transferengine with --engine asyncio,
+    # returns the result to print and the process exit code
+    if args.command == "list":
+        entries = await engine.list(args.server, args.directory)
+        return {"directory": args.directory, "directories": sorted(entry.name for entry in entries if entry.is_dir),
+                "files": sorted(entry.name for entry in entries if not entry.is_dir)}, 0
+
+    if args.command == "backup":
+        remote_file_path = await engine.find(args.server, args.file_path)
+        backup_path = await engine.backup(args.server, remote_file_path) if remote_file_path else None
+        if not backup_path:
+            raise FileNotFoundError(f"File {args.file_path} not found on {args.server}")
+        return {"server": args.server, "file": args.file_path, "backup": backup_path}, 0
+
+    summary = await transfer_files(engine, args.source_server, args.source_path, args.destination_server,
+                                   args.destination_path, concurrency=args.concurrency, skip_identical=not args.force)
+    succeeded = summary["statuses"].get("done", 0) + summary["statuses"].get("skipped", 0)
+    return summary, 0 if succeeded == summary["items"] else 1
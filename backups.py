@@ -0,0 +1,112 @@
+import calendar
+import posixpath
+import re
+import shlex
+import time
+from collections import namedtuple
+
+# Snapshots live in this directory next to the file, on the same filesystem, so they can be hardlinks
+BACKUP_DIR = ".backups"
+
+# Generations kept per file, older snapshots are removed when a new one is taken
+GENERATIONS = 5
+
+Backup = namedtuple("Backup", "path created size")
+
+
+def backup_directory(path):
+    return posixpath.join(posixpath.dirname(path), BACKUP_DIR)
+
+
+def timestamp():
+    # UTC with microseconds, so snapshots sort by name and two in the same second do not collide
+    now = time.time()
+    return time.strftime("%Y%m%d-%H%M%S", time.gmtime(now)) + f"-{int(now % 1 * 1000000):06}"
+
+
+def snapshot_command(path):
+    # The snapshot path for path and the shell command that takes it, which exits with 3 when path does not exist
+    # and with 4, printing the newest snapshot, when that snapshot already is the current version.
+    # Transfers replace files by renaming a new file over them, so a hardlink keeps the old version at no cost;
+    # filesystems without hardlinks get a copy.
+    directory = backup_directory(path)
+    backup_path = posixpath.join(directory, f"{posixpath.basename(path)}.{timestamp()}")
+    source, backup = shlex.quote(path), shlex.quote(backup_path)
+    snapshots = shlex.quote(posixpath.join(directory, posixpath.basename(path))) + ".[0-9]*"
+    return backup_path, (f"test -f {source} || exit 3; "
+                         f"newest=$(ls -1d -- {snapshots} 2>/dev/null | tail -n 1); "
+                         f"if [ -n \"$newest\" ] && {{ [ \"$newest\" -ef {source} ] || cmp -s -- \"$newest\" {source}; }}; "
+                         f"then echo \"$newest\"; exit 4; fi; "
+                         f"mkdir -p {shlex.quote(directory)} && "
+                         f"(ln -- {source} {backup} 2>/dev/null || cp -p -- {source} {backup})")
+
+
+def snapshot(session, path, generations=GENERATIONS):
+    # Keeps the current version of path in .backups and returns the snapshot path, None when path does not exist.
+    # A version that is already the newest snapshot is not taken again, so retries and forced transfers of the
+    # same file do not push the older generations out.
+    backup_path, command = snapshot_command(path)
+    status, output, errors = session.run(command)
+    if status == 3:
+        return None
+    if status == 4:
+        return output.strip()
+    if status != 0:
+        raise IOError(f"Failed to back up {path}: {errors.strip()}")
+    prune(session.open_sftp(), path, generations)
+    return backup_path
+
+
+def match_backups(path, entries):
+    # Snapshots of path among the (filename, size) entries of its .backups directory, newest first
+    pattern = re.compile(re.escape(posixpath.basename(path)) + r"\.(\d{8}-\d{6})-\d{6}$")
+    directory = backup_directory(path)
+    backups = []
+    for filename, size in entries:
+        match = pattern.match(filename)
+        if match:
+            created = calendar.timegm(time.strptime(match.group(1), "%Y%m%d-%H%M%S"))
+            backups.append(Backup(posixpath.join(directory, filename), created, size))
+    return sorted(backups, key=lambda backup: backup.path, reverse=True)
+
+
+def list_backups(sftp, path):
+    try:
+        entries = sftp.listdir_attr(backup_directory(path))
+    except FileNotFoundError:
+        return []
+    return match_backups(path, ((entry.filename, entry.st_size) for entry in entries))
+
+
+def prune(sftp, path, generations=GENERATIONS):
+    for backup in list_backups(sftp, path)[generations:]:
+        sftp.remove(backup.path)
+
+
+def restore(session, path, backup_path=None, generations=GENERATIONS):
+    # Puts a snapshot back in place of path, the newest one unless backup_path is given.
+    # The version being replaced is snapshotted first, so restoring again undoes the restore.
+    backups = list_backups(session.open_sftp(), path)
+    if backup_path is None:
+        if not backups:
+            raise FileNotFoundError(f"No backups of {path}")
+        backup_path = backups[0].path
+    elif backup_path not in [backup.path for backup in backups]:
+        raise FileNotFoundError(f"{backup_path} is not a backup of {path}")
+
+    # The snapshot is copied out before the current version is backed up, pruning may remove the oldest one
+    temp_path = path + ".restore-tmp"
+    backup, temp = shlex.quote(backup_path), shlex.quote(temp_path)
+    status, output, errors = session.run(f"cp --reflink=auto -p -- {backup} {temp} 2>/dev/null || cp -p -- {backup} {temp}")
+    if status != 0:
+        session.run(f"rm -f -- {temp}")
+        raise IOError(f"Failed to restore {backup_path}: {errors.strip()}")
+    try:
+        snapshot(session, path, generations)
+    except IOError:
+        session.run(f"rm -f -- {temp}")
+        raise
+    status, output, errors = session.run(f"mv -f -- {temp} {shlex.quote(path)}")
+    if status != 0:
+        raise IOError(f"Failed to restore {backup_path}: {errors.strip()}")
+    return backup_path
@@ -0,0 +1,277 @@
+import itertools
+import os
+import threading
+import time
+
+# Urgent transfers get the bandwidth of a limited host or link before normal ones, normal ones before bulk syncs
+PRIORITIES = ("urgent", "normal", "bulk")
+
+# This machine, the end of a download and the start of an upload in staged transfers
+LOCAL = "local"
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# A bucket holds at most this many seconds of its rate, so an idle link cannot save up a long burst
+BURST_SECONDS = 1
+
+# Waiting transfers look again at least this often, so new limits, windows and cancels apply within a second
+RECHECK_INTERVAL = 1
+
+# The inventory file is checked for edited limits at most this often
+RELOAD_INTERVAL = 5
+
+
+def parse_days(spec):
+    # "mon-fri", "sat,sun" or "*" to weekday numbers
+    if spec in (None, "*"):
+        return frozenset(range(7))
+    days = set()
+    for part in spec.lower().split(","):
+        first, _, last = part.strip().partition("-")
+        if first not in DAYS or (last and last not in DAYS):
+            raise ValueError(f"Unknown days '{spec}', use names like mon-fri or sat,sun")
+        start, end = DAYS.index(first), DAYS.index(last or first)
+        days.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+    return frozenset(days)
+
+
+def parse_time(text):
+    hours, _, minutes = text.partition(":")
+    if not (hours.isdigit() and minutes.isdigit() and int(hours) < 24 and int(minutes) < 60):
+        raise ValueError(f"Invalid time '{text}', use HH:MM")
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_windows(windows):
+    # Inventory windows such as {"days": "mon-fri", "start": "08:00", "end": "18:00", "bandwidth": 5} in MB/s.
+    # A window may run past midnight, bandwidth 0 holds transfers until it ends.
+    parsed = []
+    for window in windows:
+        parsed.append({"days": parse_days(window.get("days")), "start": parse_time(window["start"]),
+                       "end": parse_time(window["end"]), "bandwidth": int(window["bandwidth"] * 1024 * 1024)})
+    return parsed
+
+
+def window_bandwidth(windows, now):
+    # Bytes/s of the first window open at now (a time.struct_time), None when none is
+    minute = now.tm_hour * 60 + now.tm_min
+    for window in windows:
+        if window["start"] <= window["end"]:
+            open_now = now.tm_wday in window["days"] and window["start"] <= minute < window["end"]
+        else:
+            # Past midnight the window still belongs to the day it started on
+            open_now = ((now.tm_wday in window["days"] and minute >= window["start"])
+                        or ((now.tm_wday - 1) % 7 in window["days"] and minute < window["end"]))
+        if open_now:
+            return window["bandwidth"]
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate * BURST_SECONDS
+        self.updated = time.monotonic()
+
+    def refill(self, rate, now):
+        # Tokens earned so far count at the old rate, a changed limit applies from now on
+        self.tokens = min(rate * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.rate = rate
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Progress is reported after a chunk was sent, so its sender waits until the bucket holds the chunk.
+        # A chunk larger than the burst waits for a full bucket and leaves it in debt for the next one.
+        needed = min(amount, self.rate * BURST_SECONDS)
+        return (needed - self.tokens) / self.rate if self.tokens < needed else 0
+
+
+class Job:
+    # One throttled transfer; start and finish are its start-time fair queueing tags
+    def __init__(self, priority, source, destination):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}'")
+        self.priority = priority
+        self.source = source
+        self.destination = destination
+        self.finish = 0
+        self.transferred = 0
+        self._lock = threading.Lock()
+
+    def resume(self, offset):
+        # A transfer continuing from a checkpoint is only charged for the bytes it sends from there
+        with self._lock:
+            self.transferred = offset
+
+    def advance(self, transferred):
+        # Bytes since the last progress report, a report lower than the last one means the transfer started over
+        with self._lock:
+            if transferred < self.transferred:
+                self.transferred = 0
+            amount = transferred - self.transferred
+            self.transferred = transferred
+        return amount
+
+
+class BandwidthScheduler:
+    # Token buckets per host and per link between two hosts, shared by every transfer of the engine.
+    # A host is limited by its bandwidth setting or the window open at the time, a link by the link_bandwidth
+    # both ends give for each other; live limits set here take precedence over both.
+    # Where transfers compete for a bucket, higher priorities go first and equal ones share it fairly by bytes.
+    def __init__(self, servers, clock=time.localtime):
+        self.clock = clock
+        self.overrides = {}
+        self._hosts = self._by_hostname(servers)
+        self._buckets = {}
+        self._waiting = {}
+        self._virtual = 0
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+        self._inventory_path = None
+        self._inventory_mtime = None
+        self._checked_at = 0
+
+    def _by_hostname(self, servers):
+        # Several server names may point at one host, its most restrictive settings win
+        hosts = {}
+        for server_info in servers.values():
+            hosts.setdefault(server_info["hostname"], []).append(server_info)
+        return hosts
+
+    def watch(self, inventory_path):
+        # Limits edited in the inventory file apply to running transfers within RELOAD_INTERVAL seconds
+        self._inventory_path = inventory_path
+        self._inventory_mtime = os.path.getmtime(inventory_path)
+
+    def _reload(self):
+        now = time.monotonic()
+        if self._inventory_path is None or now - self._checked_at < RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self._inventory_path)
+            if mtime == self._inventory_mtime:
+                return
+            from inventory import load_inventory
+            servers = load_inventory(self._inventory_path, resolve=False)
+        except (OSError, ValueError, KeyError):
+            # A file caught halfway through an edit is read again on the next check
+            return
+        self._inventory_mtime = mtime
+        self._hosts = self._by_hostname(servers)
+
+    def set_limit(self, host, bandwidth):
+        # Live limit in bytes/s for a hostname, 0 holds its transfers, None goes back to the inventory settings
+        self._override(("host", host), bandwidth)
+
+    def set_link_limit(self, host, other_host, bandwidth):
+        self._override(("link", frozenset((host, other_host))), bandwidth)
+
+    def _override(self, key, bandwidth):
+        with self._cond:
+            if bandwidth is None:
+                self.overrides.pop(key, None)
+            else:
+                self.overrides[key] = bandwidth
+            self._cond.notify_all()
+
+    def rate(self, key):
+        # Bytes/s allowed through a bucket right now, None when it is not limited
+        if key in self.overrides:
+            return self.overrides[key]
+        if key[0] == "host":
+            rates = []
+            for server_info in self._hosts.get(key[1], ()):
+                bandwidth = window_bandwidth(server_info.get("bandwidth_windows", ()), self.clock())
+                rates.append(bandwidth if bandwidth is not None else server_info.get("bandwidth"))
+        else:
+            hosts = sorted(key[1])
+            rates = [server_info.get("link_bandwidth", {}).get(other)
+                     for host, other in zip(hosts, reversed(hosts)) for server_info in self._hosts.get(host, ())]
+        rates = [rate for rate in rates if rate is not None]
+        return min(rates) if rates else None
+
+    def keys(self, source, destination):
+        keys = [("host", host) for host in (source, destination) if host != LOCAL]
+        if source != destination:
+            keys.append(("link", frozenset((source, destination))))
+        return keys
+
+    def is_limited(self, source, destination):
+        with self._cond:
+            self._reload()
+            return any(self.rate(key) is not None for key in self.keys(source, destination))
+
+    def throttle(self, callback, source, destination, priority="normal"):
+        # Wraps a (transferred, total) progress callback so the transfer waits for bandwidth after each chunk.
+        # The callback still runs first and while waiting, so a cancel also stops a transfer that is held back.
+        # Resumable transfers pass their checkpoint to the resume attribute of the returned callback.
+        job = Job(priority, source, destination)
+
+        def throttled(transferred, total):
+            if callback:
+                callback(transferred, total)
+            amount = job.advance(transferred)
+            if amount > 0:
+                self.acquire(job, amount, check=callback and (lambda: callback(transferred, total)))
+
+        throttled.resume = job.resume
+        return throttled
+
+    def acquire(self, job, amount, check=None):
+        # Blocks until amount bytes may pass every limited bucket between the job's hosts
+        ticket = None
+        try:
+            while True:
+                with self._cond:
+                    self._reload()
+                    limits = {key: self.rate(key) for key in self.keys(job.source, job.destination)}
+                    limits = {key: rate for key, rate in limits.items() if rate is not None}
+                    if not limits:
+                        return
+                    if ticket is None:
+                        ticket = next(self._tickets)
+                        start = max(job.finish, self._virtual)
+                        self._waiting[ticket] = (PRIORITIES.index(job.priority), start, ticket, set(limits))
+                    timeout = self._take(ticket, limits, amount, job)
+                    if timeout is None:
+                        return
+                    self._cond.wait(min(timeout, RECHECK_INTERVAL))
+                if check:
+                    check()
+        finally:
+            if ticket is not None:
+                with self._cond:
+                    self._waiting.pop(ticket, None)
+                    self._cond.notify_all()
+
+    def _take(self, ticket, limits, amount, job):
+        # Takes the bytes and returns None, or returns how long to wait before trying again
+        rank = self._waiting[ticket]
+        for other, other_rank in self._waiting.items():
+            if other != ticket and other_rank[:3] < rank[:3] and other_rank[3] & set(limits):
+                # A transfer ahead in line wants the same bucket, it wakes the others when it is through
+                return RECHECK_INTERVAL
+        if 0 in limits.values():
+            # A window or limit of 0 holds the transfer until it changes
+            return RECHECK_INTERVAL
+
+        now = time.monotonic()
+        buckets = []
+        for key, rate in limits.items():
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate)
+            bucket.refill(rate, now)
+            buckets.append(bucket)
+        timeout = max(bucket.wait_time(amount) for bucket in buckets)
+        if timeout > 0:
+            return timeout
+
+        for bucket in buckets:
+            bucket.tokens -= amount
+        self._virtual = rank[1]
+        job.finish = rank[1] + amount
+        del self._waiting[ticket]
+        self._cond.notify_all()
+        return None
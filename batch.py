@@ -0,0 +1,186 @@
+import fnmatch
+import posixpath
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from backups import BACKUP_DIR
+from worker import TransferCancelled
+
+
+def has_magic(path):
+    return any(char in path for char in "*?[")
+
+
+class TransferItem:
+    def __init__(self, source_server, source_path, destination_server, destination_path):
+        self.source_server = source_server
+        self.source_path = source_path
+        self.destination_server = destination_server
+        self.destination_path = destination_path
+        self.status = "pending"
+        self.error = None
+        self.bytes_transferred = 0
+        self.result = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def remote_path(self):
+        return posixpath.join(self.destination_path, posixpath.basename(self.source_path))
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def __str__(self):
+        text = f"[{self.status}] {self.source_server}:{self.source_path} -> {self.destination_server}:{self.destination_path}"
+        if self.error:
+            text += f" ({self.error})"
+        return text
+
+
+class BatchTransfer:
+    def __init__(self, app, workers_per_pair=2, mode="stream", skip_identical=True, on_update=None, priority="normal"):
+        self.app = app
+        self.workers_per_pair = workers_per_pair
+        self.mode = mode
+        self.skip_identical = skip_identical
+        # Where servers have bandwidth limits, urgent batches go ahead of normal ones and normal ones ahead of bulk
+        self.priority = priority
+        self.on_update = on_update
+        self.items = []
+        self.cancel_event = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+
+    def add(self, source_server, source_path, destination_server, destination_path):
+        # Directories and glob patterns are expanded into one item per file on the source server
+        items = self.expand(source_server, source_path, destination_server, destination_path)
+        self.items.extend(items)
+        return items
+
+    def expand(self, source_server, source_path, destination_server, destination_path):
+        server_info = self.app.get_server_info(source_server)
+        items = []
+        with self.app.pool.sftp(server_info) as sftp:
+            if has_magic(source_path):
+                directory, pattern = posixpath.split(source_path)
+                for entry in sftp.listdir_attr(directory):
+                    if fnmatch.fnmatch(entry.filename, pattern) and not stat.S_ISDIR(entry.st_mode):
+                        items.append(TransferItem(source_server, posixpath.join(directory, entry.filename),
+                                                  destination_server, destination_path))
+            elif stat.S_ISDIR(sftp.stat(source_path).st_mode):
+                # Files inside a directory keep their relative location under the destination path
+                root = source_path.rstrip("/")
+                target = posixpath.join(destination_path, posixpath.basename(root))
+                pending = [root]
+                while pending:
+                    directory = pending.pop()
+                    relative = posixpath.relpath(directory, root)
+                    for entry in sftp.listdir_attr(directory):
+                        path = posixpath.join(directory, entry.filename)
+                        if stat.S_ISDIR(entry.st_mode):
+                            # Backup snapshots stay on the server they were taken on
+                            if entry.filename != BACKUP_DIR:
+                                pending.append(path)
+                        else:
+                            items.append(TransferItem(source_server, path, destination_server,
+                                                      posixpath.normpath(posixpath.join(target, relative))))
+            else:
+                items.append(TransferItem(source_server, source_path, destination_server, destination_path))
+        return items
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        # Items are grouped by host pair, each pair gets its own set of workers
+        pairs = {}
+        for item in self.items:
+            if item.status not in ("done", "skipped"):
+                pairs.setdefault((item.source_server, item.destination_server), []).append(item)
+
+        self.started_at = time.monotonic()
+        executors = [ThreadPoolExecutor(max_workers=self.workers_per_pair, thread_name_prefix=f"batch-{source}-{destination}")
+                     for source, destination in pairs]
+        try:
+            futures = [executor.submit(self.transfer_item, item)
+                       for executor, items in zip(executors, pairs.values()) for item in items]
+            wait(futures)
+        finally:
+            for executor in executors:
+                executor.shutdown()
+        self.finished_at = time.monotonic()
+        return self.summary()
+
+    def transfer_item(self, item):
+        if self.cancel_event.is_set():
+            self._update(item, "cancelled")
+            return
+
+        def progress(transferred, total):
+            if self.cancel_event.is_set():
+                raise TransferCancelled("Transfer cancelled")
+            item.bytes_transferred = transferred
+
+        item.started_at = time.monotonic()
+        item.bytes_transferred = 0
+        item.error = None
+        self._update(item, "running")
+        try:
+            self.ensure_remote_directory(item.destination_server, item.destination_path)
+            item.result = self.app.run_transfer(item.source_server, item.source_path, item.destination_server,
+                                                item.remote_path, self.mode, progress, self.skip_identical,
+                                                priority=self.priority)
+        except TransferCancelled:
+            item.finished_at = time.monotonic()
+            self._update(item, "cancelled")
+        except Exception as e:
+            item.error = e
+            item.finished_at = time.monotonic()
+            self._update(item, "failed")
+        else:
+            item.finished_at = time.monotonic()
+            self._update(item, "skipped" if item.result and item.result.get("skipped") else "done")
+
+    def ensure_remote_directory(self, server_name, directory):
+        server_info = self.app.get_server_info(server_name)
+        with self.app.pool.sftp(server_info) as sftp:
+            missing = []
+            while directory not in ("", "/"):
+                try:
+                    sftp.stat(directory)
+                    break
+                except FileNotFoundError:
+                    missing.append(directory)
+                    directory = posixpath.dirname(directory)
+            for path in reversed(missing):
+                self.app.invalidate_listing(server_name, posixpath.dirname(path))
+                try:
+                    sftp.mkdir(path)
+                except OSError:
+                    # Another worker of the batch may have created it in the meantime
+                    sftp.stat(path)
+
+    def _update(self, item, status):
+        item.status = status
+        if self.on_update:
+            self.on_update(item)
+
+    def summary(self):
+        counts = {}
+        for item in self.items:
+            counts[item.status] = counts.get(item.status, 0) + 1
+        total_bytes = sum(item.bytes_transferred for item in self.items if item.status == "done")
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0
+        return {
+            "items": len(self.items),
+            "statuses": counts,
+            "bytes": total_bytes,
+            "seconds": elapsed,
+            "throughput": total_bytes / elapsed if elapsed else 0,
+        }
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import BatchTransfer
+from localserver import LocalSFTPProcess
+from transferengine import ENGINES, TRANSFER_MODES, TransferEngine
+
+SCENARIOS = ("large_file", "small_files", "deep_listing", "backup_transfer", "concurrent_sessions")
+
+# Scenarios that run on the asyncio engine too
+ASYNC_SCENARIOS = ("large_file", "concurrent_sessions")
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile, values does not need to be sorted
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as output:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            output.write(block)
+            remaining -= len(block)
+
+
+class Benchmark:
+    # Runs scripted scenarios through the TransferEngine, or the asyncio engine, against two local SFTP stand-in servers
+    def __init__(self, workspace, latency=0, bandwidth=None, mode="stream", repeat=3, file_size=64 * 1024 * 1024,
+                 small_files=200, small_file_size=4096, depth=4, fanout=4, entries=50, engine="paramiko",
+                 concurrency=100, session_file_size=64 * 1024):
+        self.workspace = workspace
+        self.mode = mode if engine == "paramiko" else "stream"
+        self.engine_name = engine
+        self.concurrency = concurrency
+        self.session_file_size = session_file_size
+        self.repeat = repeat
+        self.file_size = file_size
+        self.small_file_count = small_files
+        self.small_file_size = small_file_size
+        self.depth = depth
+        self.fanout = fanout
+        self.entries = entries
+        self.source_root = os.path.join(workspace, "source")
+        self.destination_root = os.path.join(workspace, "destination")
+
+        # The stand-ins run in child processes, their threads and memory are not counted as the client's
+        self.source = LocalSFTPProcess(latency=latency, bandwidth=bandwidth)
+        self.destination = LocalSFTPProcess(latency=latency, bandwidth=bandwidth, host_key=self.source.host_key)
+        self.source.start()
+        self.destination.start()
+        self.engine = None
+        self.loop = asyncio.new_event_loop() if engine == "asyncio" else None
+
+    def close_engine(self):
+        if self.engine is None:
+            return
+        if self.loop is not None:
+            self.loop.run_until_complete(self.engine.close())
+        else:
+            self.engine.close()
+        self.engine = None
+
+    def new_engine(self):
+        # Every scenario starts with a cold engine: no pooled sessions, no cached listings.
+        # Both stand-ins run on this machine, so copying on the server would skip the mode being measured.
+        self.close_engine()
+        servers = {"SOURCE": self.source.server_info(), "DESTINATION": self.destination.server_info()}
+        if self.loop is not None:
+            from asyncengine import AsyncTransferEngine
+            self.engine = AsyncTransferEngine(servers=servers, catalog_roots=(self.source_root,),
+                                              known_hosts_path=os.path.join(self.workspace, "known_hosts"))
+            return self.engine
+        self.engine = TransferEngine(servers=servers,
+                                     catalog_roots=(self.source_root,),
+                                     catalog_path=os.path.join(self.workspace, "file_catalog.db"),
+                                     backup_dir=os.path.join(self.workspace, "local_backup"),
+                                     transfer_dir=os.path.join(self.workspace, "transferfiles"),
+                                     journal_path=os.path.join(self.workspace, "transfer_journal.json"),
+                                     link_speeds_path=os.path.join(self.workspace, "link_speeds.json"),
+                                     known_hosts_path=os.path.join(self.workspace, "known_hosts"),
+                                     metrics_log=None, remote_copy=False)
+        return self.engine
+
+    def run(self, scenarios=SCENARIOS):
+        return [getattr(self, scenario)() for scenario in scenarios]
+
+    def measure(self, name, operation, sessions=1):
+        # Runs operation repeat times, each call returns the bytes it moved.
+        # An asyncio operation is a coroutine function, it runs on the benchmark's event loop.
+        engine = self.new_engine()
+        if self.loop is not None:
+            coroutine_function = operation
+            operation = lambda engine: self.loop.run_until_complete(coroutine_function(engine))
+        connections = self.source.connections + self.destination.connections
+        latencies = []
+        total_bytes = 0
+        started = time.monotonic()
+        for _ in range(self.repeat):
+            operation_started = time.monotonic()
+            total_bytes += operation(engine)
+            latencies.append(time.monotonic() - operation_started)
+        seconds = time.monotonic() - started
+        result = {"scenario": name, "engine": self.engine_name, "mode": self.mode, "operations": len(latencies),
+                  "bytes": total_bytes, "seconds": seconds, "throughput": total_bytes / seconds if seconds else 0,
+                  "p50": percentile(latencies, 50), "p99": percentile(latencies, 99),
+                  "handshakes": self.source.connections + self.destination.connections - connections,
+                  "phases": {row["phase"]: row["seconds"] for row in engine.telemetry.summary()}}
+        if sessions > 1:
+            # One more run with tracemalloc on, it slows Python down too much to be part of the timed runs.
+            # Pooled sessions keep their transport threads, so the thread count is taken after the run.
+            tracemalloc.start()
+            try:
+                operation(engine)
+                result["memory_per_session"] = tracemalloc.get_traced_memory()[1] / sessions
+            finally:
+                tracemalloc.stop()
+            result["threads"] = threading.active_count()
+        return result
+
+    def large_file(self):
+        source_path = os.path.join(self.source_root, "large", "large.bin")
+        write_file(source_path, self.file_size)
+        remote_path = os.path.join(self.destination_root, "large", "large.bin")
+        os.makedirs(os.path.dirname(remote_path), exist_ok=True)
+
+        def transfer(engine):
+            engine.run_transfer("SOURCE", source_path, "DESTINATION", remote_path, mode=self.mode, skip_identical=False)
+            return self.file_size
+
+        async def transfer_async(engine):
+            await engine.transfer("SOURCE", source_path, "DESTINATION", remote_path, skip_identical=False)
+            return self.file_size
+
+        return self.measure("large_file", transfer_async if self.loop else transfer)
+
+    def small_files(self):
+        source_directory = os.path.join(self.source_root, "small")
+        for index in range(self.small_file_count):
+            write_file(os.path.join(source_directory, f"file{index:05}.dat"), self.small_file_size)
+
+        def transfer(engine):
+            # The same batch path as the GUI and the command line
+            batch = BatchTransfer(engine, mode=self.mode, skip_identical=False)
+            batch.add("SOURCE", source_directory, "DESTINATION", self.destination_root)
+            summary = batch.run()
+            failed = [item for item in batch.items if item.status != "done"]
+            if failed:
+                raise RuntimeError(f"{len(failed)} small files failed, first: {failed[0]}")
+            return summary["bytes"]
+
+        return self.measure("small_files", transfer)
+
+    def deep_listing(self):
+        root = os.path.join(self.source_root, "deep")
+        directories = [root]
+        for level in range(self.depth):
+            children = []
+            for directory in directories:
+                for index in range(self.fanout):
+                    children.append(os.path.join(directory, f"level{level}_{index}"))
+            directories = children
+            for directory in directories:
+                os.makedirs(directory, exist_ok=True)
+        for directory in directories:
+            for index in range(self.entries):
+                open(os.path.join(directory, f"entry{index:04}.dat"), "w").close()
+
+        def browse(engine):
+            # Walks the whole tree the way the browser opens one directory after another, with a cold cache
+            engine.listings.clear()
+            server_info = engine.get_server_info("SOURCE")
+            pending = [root]
+            while pending:
+                directory = pending.pop()
+                files, subdirectories = engine.list_files_and_dirs_on_server(server_info, directory)
+                pending.extend(os.path.join(directory, name) for name in subdirectories)
+            return 0
+
+        return self.measure("deep_listing", browse)
+
+    def backup_transfer(self):
+        source_path = os.path.join(self.source_root, "backup", "data.bin")
+        remote_path = os.path.join(self.destination_root, "backup", "data.bin")
+        write_file(source_path, self.file_size // 4)
+        # The destination already has an older copy, so every run backs it up before replacing it
+        write_file(remote_path, self.file_size // 4)
+
+        def transfer(engine):
+            engine.run_transfer("SOURCE", source_path, "DESTINATION", remote_path, mode=self.mode, skip_identical=False)
+            return self.file_size // 4
+
+        return self.measure("backup_transfer", transfer)
+
+    def concurrent_sessions(self):
+        # concurrency clients at once, each lists a directory and transfers a file of its own
+        source_directory = os.path.join(self.source_root, "sessions")
+        destination_directory = os.path.join(self.destination_root, "sessions")
+        os.makedirs(destination_directory, exist_ok=True)
+        names = [f"session{index:05}.dat" for index in range(self.concurrency)]
+        for name in names:
+            write_file(os.path.join(source_directory, name), self.session_file_size)
+
+        def sessions(engine):
+            # The paramiko path: a thread and a pooled SSH session per client
+            engine.pool.max_sessions_per_host = self.concurrency
+            engine.listings.clear()
+
+            def session(name):
+                engine.list_entries(engine.get_server_info("SOURCE"), source_directory)
+                engine.run_transfer("SOURCE", os.path.join(source_directory, name), "DESTINATION",
+                                    os.path.join(destination_directory, name), mode=self.mode, skip_identical=False)
+                return self.session_file_size
+
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                return sum(executor.map(session, names))
+
+        async def sessions_async(engine):
+            async def session(name):
+                await engine.list("SOURCE", source_directory)
+                await engine.transfer("SOURCE", os.path.join(source_directory, name), "DESTINATION",
+                                      os.path.join(destination_directory, name), skip_identical=False)
+                return self.session_file_size
+
+            return sum(await asyncio.gather(*(session(name) for name in names)))
+
+        return self.measure("concurrent_sessions", sessions_async if self.loop else sessions, sessions=self.concurrency)
+
+    def close(self):
+        self.close_engine()
+        if self.loop is not None:
+            self.loop.close()
+        self.source.close()
+        self.destination.close()
+
+
+def print_report(results, baseline=None):
+    # Scenarios are compared by name, so a run in another mode is compared against the baseline mode
+    baseline = {result["scenario"]: result for result in baseline or []}
+    print(f"{'scenario':20} {'engine':9} {'mode':9} {'ops':>4} {'MB/s':>9} {'p50 s':>8} {'p99 s':>8} {'handshakes':>10}")
+    for result in results:
+        # Results saved before the asyncio engine existed ran on paramiko
+        engine = result.get("engine", "paramiko")
+        line = (f"{result['scenario']:20} {engine:9} {result['mode']:9} {result['operations']:4} "
+                f"{result['throughput'] / 1024 / 1024:9.2f} {result['p50']:8.3f} {result['p99']:8.3f} "
+                f"{result['handshakes']:10}")
+        previous = baseline.get(result["scenario"])
+        if previous and previous["p50"]:
+            line += (f"   p50 {result['p50'] / previous['p50']:.2f}x of baseline "
+                     f"{previous.get('engine', 'paramiko')} {previous['mode']}")
+        print(line)
+        if "memory_per_session" in result:
+            print(f"    {result['memory_per_session'] / 1024:.1f} KB allocated per session, {result['threads']} threads")
+        slowest = sorted(result["phases"].items(), key=lambda phase: phase[1], reverse=True)[:4]
+        print("    " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in slowest))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmark",
+                                     description="Measure transfers against local SFTP stand-in servers.")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"scenarios to run, any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--mode", choices=TRANSFER_MODES, default="stream", help="transfer mode of the engine")
+    parser.add_argument("--engine", choices=ENGINES, default="paramiko",
+                        help=f"engine to measure, asyncio runs {', '.join(ASYNC_SCENARIOS)} (needs asyncssh)")
+    parser.add_argument("--concurrency", type=int, default=100, help="clients at once in concurrent_sessions")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added in each direction")
+    parser.add_argument("--bandwidth", type=float, help="MB/s per connection")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each scenario")
+    parser.add_argument("--size", type=int, default=64, help="size in MB of the large file")
+    parser.add_argument("--small-files", type=int, default=200, help="number of small files")
+    parser.add_argument("--depth", type=int, default=4, help="directory levels of the deep listing")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--save", help="write the results to this file to compare later runs against")
+    parser.add_argument("--baseline", help="results saved by an earlier run to compare against")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    available = ASYNC_SCENARIOS if args.engine == "asyncio" else SCENARIOS
+    for scenario in args.scenarios:
+        if scenario not in available:
+            parser.error(f"unknown scenario '{scenario}' for the {args.engine} engine")
+    if args.engine == "asyncio":
+        if importlib.util.find_spec("asyncssh") is None:
+            parser.error("--engine asyncio needs asyncssh, install it with pip install asyncssh")
+    workspace = tempfile.mkdtemp(prefix="transfer-benchmark-")
+    benchmark = Benchmark(workspace, latency=args.latency / 1000,
+                          bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None, mode=args.mode,
+                          repeat=args.repeat, file_size=args.size * 1024 * 1024, small_files=args.small_files,
+                          depth=args.depth, engine=args.engine, concurrency=args.concurrency)
+    try:
+        results = benchmark.run(args.scenarios or available)
+    finally:
+        benchmark.close()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        print_report(results, baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import posixpath
+import time
+import tkinter as tk
+from tkinter import messagebox, ttk
+
+# Rows are added to the tree a page at a time, when the view scrolls near the end
+PAGE_SIZE = 500
+
+
+class RemoteBrowser(tk.Frame):
+    def __init__(self, master, engine, worker, directories_only=False, on_select=None, on_loaded=None, height=12):
+        super().__init__(master)
+        self.engine = engine
+        self.worker = worker
+        self.directories_only = directories_only
+        self.on_select = on_select
+        # Called with (server_name, directory, subdirectory names) once a directory is fully listed
+        self.on_loaded = on_loaded
+        self.server_name = None
+        self.directory = None
+        self.entries = []
+        self.shown = 0
+        self.loading = False
+        self.generation = 0
+
+        # Filters are applied on the server, only the matching entries are sent back
+        frame_filters = tk.Frame(self)
+        frame_filters.pack(fill="x", pady=2)
+
+        tk.Label(frame_filters, text="Name:").pack(side="left")
+        self.pattern_var = tk.StringVar(self)
+        self.pattern_entry = tk.Entry(frame_filters, textvariable=self.pattern_var, width=20)
+        self.pattern_entry.pack(side="left", padx=2)
+        self.pattern_entry.bind("<Return>", lambda event: self.refresh())
+
+        tk.Label(frame_filters, text="Min size (KB):").pack(side="left")
+        self.min_size_var = tk.StringVar(self)
+        tk.Entry(frame_filters, textvariable=self.min_size_var, width=8).pack(side="left", padx=2)
+
+        tk.Label(frame_filters, text="Modified in last (days):").pack(side="left")
+        self.days_var = tk.StringVar(self)
+        tk.Entry(frame_filters, textvariable=self.days_var, width=5).pack(side="left", padx=2)
+
+        tk.Button(frame_filters, text="Filter", command=self.refresh).pack(side="left", padx=2)
+
+        frame_tree = tk.Frame(self)
+        frame_tree.pack(fill="both", expand=True)
+
+        self.tree = ttk.Treeview(frame_tree, columns=("size", "modified"), height=height, selectmode="browse")
+        self.tree.heading("#0", text="Name")
+        self.tree.heading("size", text="Size")
+        self.tree.heading("modified", text="Modified")
+        self.tree.column("#0", width=320)
+        self.tree.column("size", width=100, anchor="e")
+        self.tree.column("modified", width=140)
+
+        self.scrollbar = ttk.Scrollbar(frame_tree, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.on_scroll)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.tree.bind("<Double-1>", self.on_double_click)
+        self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+
+        self.status_label = tk.Label(self, text="")
+        self.status_label.pack(anchor="w")
+
+    def open(self, server_name, directory):
+        self.server_name = server_name
+        self.directory = directory
+        self.refresh()
+        if self.on_select:
+            self.on_select(self.selected_path())
+
+    def refresh(self):
+        if self.server_name is None:
+            return
+        try:
+            filters = self.filters()
+            server_info = self.engine.get_server_info(self.server_name)
+        except ValueError as e:
+            messagebox.showerror("Error", f"Failed to list {self.directory}: {str(e)}")
+            return
+
+        self.generation += 1
+        generation = self.generation
+        directory = self.directory
+        self.entries = []
+        self.shown = 0
+        self.loading = True
+        self.tree.delete(*self.tree.get_children())
+        if posixpath.dirname(self.directory.rstrip("/")) != self.directory.rstrip("/"):
+            self.tree.insert("", "end", iid="..", text=".. (Up)")
+        self.status_label.config(text=f"Listing {self.directory}...")
+
+        def load():
+            for batch in self.engine.iter_directory(server_info, directory, **filters):
+                if generation != self.generation:
+                    # The user opened another directory, stop reading this one
+                    return
+                self.worker.post(self.add_entries, generation, batch)
+
+        self.worker.submit(load, on_success=lambda result: self.finish_loading(generation),
+                           on_error=lambda e: self.loading_failed(generation, e), key=str(self))
+
+    def filters(self):
+        # Raises ValueError for sizes or ages that are not numbers
+        filters = {}
+        if self.pattern_var.get().strip():
+            filters["pattern"] = self.pattern_var.get().strip()
+        if self.min_size_var.get().strip():
+            filters["min_size"] = float(self.min_size_var.get()) * 1024
+        if self.days_var.get().strip():
+            filters["modified_after"] = time.time() - float(self.days_var.get()) * 86400
+        return filters
+
+    def add_entries(self, generation, batch):
+        if generation != self.generation:
+            return
+        if self.directories_only:
+            batch = [entry for entry in batch if entry.is_dir]
+        self.entries.extend(batch)
+        # Only the first page is shown right away, the rest waits until it is scrolled to
+        if self.shown < PAGE_SIZE:
+            self.show_more()
+        self.update_status()
+
+    def show_more(self):
+        page = self.entries[self.shown:self.shown + PAGE_SIZE]
+        for index, entry in enumerate(page, self.shown):
+            if entry.is_dir:
+                self.tree.insert("", "end", iid=str(index), text=f"[D] {entry.name}", values=("", self.format_time(entry.mtime)))
+            else:
+                self.tree.insert("", "end", iid=str(index), text=entry.name,
+                                 values=(f"{entry.size:,}", self.format_time(entry.mtime)))
+        self.shown += len(page)
+        self.update_status()
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if float(last) > 0.9 and self.shown < len(self.entries):
+            self.show_more()
+
+    def finish_loading(self, generation):
+        if generation == self.generation:
+            self.loading = False
+            self.update_status()
+            if self.on_loaded:
+                self.on_loaded(self.server_name, self.directory, [entry.name for entry in self.entries if entry.is_dir])
+
+    def loading_failed(self, generation, error):
+        if generation == self.generation:
+            self.loading = False
+            self.status_label.config(text="")
+            messagebox.showerror("Error", f"Failed to list {self.directory}: {str(error)}")
+
+    def update_status(self):
+        text = f"{self.directory}: {len(self.entries)} entries"
+        if self.shown < len(self.entries):
+            text += f", {self.shown} shown"
+        if self.loading:
+            text += ", loading..."
+        self.status_label.config(text=text)
+
+    def format_time(self, mtime):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))
+
+    def selected_entry(self):
+        selection = self.tree.selection()
+        if not selection or selection[0] == "..":
+            return None
+        return self.entries[int(selection[0])]
+
+    def selected_path(self):
+        # The selected file, or the open directory when nothing or a directory is selected in directories_only mode
+        entry = self.selected_entry()
+        if entry is None:
+            return self.directory if self.directories_only else ""
+        if entry.is_dir and not self.directories_only:
+            return ""
+        return posixpath.join(self.directory, entry.name)
+
+    def on_tree_select(self, event):
+        if self.on_select:
+            self.on_select(self.selected_path())
+
+    def on_double_click(self, event):
+        item = self.tree.focus()
+        if item == "..":
+            self.open(self.server_name, posixpath.dirname(self.directory.rstrip("/")) or "/")
+        elif item:
+            entry = self.entries[int(item)]
+            if entry.is_dir:
+                self.open(self.server_name, posixpath.join(self.directory, entry.name))
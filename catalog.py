@@ -0,0 +1,140 @@
+import os
+import posixpath
+import sqlite3
+import stat
+import threading
+import time
+
+from backups import BACKUP_DIR
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    server TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT,
+    mtime INTEGER,
+    PRIMARY KEY (server, path)
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (server, parent);
+CREATE TABLE IF NOT EXISTS files (
+    server TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    PRIMARY KEY (server, path)
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (server, name);
+CREATE INDEX IF NOT EXISTS files_directory ON files (server, directory);
+CREATE TABLE IF NOT EXISTS scans (
+    server TEXT PRIMARY KEY,
+    scanned_at REAL
+);
+"""
+
+
+class AmbiguousFileError(Exception):
+    def __init__(self, file_name, server, matches):
+        self.matches = matches
+        paths = ", ".join(match["path"] for match in matches)
+        super().__init__(f"File {file_name} matches {len(matches)} files on {server}: {paths}")
+
+
+class RemoteFileCatalog:
+    def __init__(self, db_path="file_catalog.db", roots=("/app/mf/cer",), refresh_interval=300):
+        self.roots = list(roots)
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def last_scan(self, server):
+        with self._lock:
+            row = self.db.execute("SELECT scanned_at FROM scans WHERE server = ?", (server,)).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self, server):
+        scanned_at = self.last_scan(server)
+        return scanned_at is None or time.time() - scanned_at > self.refresh_interval
+
+    def refresh(self, server, sftp):
+        # Walk the roots, only listing directories whose mtime changed since the last scan
+        pending = [root.rstrip("/") or "/" for root in self.roots]
+        while pending:
+            directory = pending.pop()
+            try:
+                mtime = sftp.stat(directory).st_mtime
+            except FileNotFoundError:
+                self._forget(server, directory)
+                continue
+
+            with self._lock:
+                row = self.db.execute("SELECT mtime FROM directories WHERE server = ? AND path = ?",
+                                      (server, directory)).fetchone()
+                if row is not None and row[0] == mtime:
+                    children = self.db.execute("SELECT path FROM directories WHERE server = ? AND parent = ?",
+                                               (server, directory)).fetchall()
+                    pending.extend(child[0] for child in children)
+                    continue
+
+            pending.extend(self._scan_directory(server, sftp, directory, mtime))
+
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO scans (server, scanned_at) VALUES (?, ?)", (server, time.time()))
+
+    def _scan_directory(self, server, sftp, directory, mtime):
+        files = []
+        subdirectories = []
+        for item in sftp.listdir_attr(directory):
+            path = posixpath.join(directory, item.filename)
+            if stat.S_ISDIR(item.st_mode):
+                # Backup snapshots are found through list_backups, not the catalog
+                if item.filename != BACKUP_DIR:
+                    subdirectories.append(path)
+            elif stat.S_ISREG(item.st_mode):
+                files.append((server, path, item.filename, directory, item.st_size, item.st_mtime))
+
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM files WHERE server = ? AND directory = ?", (server, directory))
+            self.db.executemany("INSERT INTO files (server, path, name, directory, size, mtime) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", files)
+            known = self.db.execute("SELECT path FROM directories WHERE server = ? AND parent = ?",
+                                    (server, directory)).fetchall()
+            for (path,) in known:
+                if path not in subdirectories:
+                    self._forget_locked(server, path)
+            self.db.execute("INSERT OR REPLACE INTO directories (server, path, parent, mtime) VALUES (?, ?, ?, ?)",
+                            (server, directory, posixpath.dirname(directory), mtime))
+        return subdirectories
+
+    def _forget(self, server, directory):
+        with self._lock, self.db:
+            self._forget_locked(server, directory)
+
+    def _forget_locked(self, server, directory):
+        prefix = directory.rstrip("/") + "/"
+        self.db.execute("DELETE FROM files WHERE server = ? AND (directory = ? OR substr(directory, 1, ?) = ?)",
+                        (server, directory, len(prefix), prefix))
+        self.db.execute("DELETE FROM directories WHERE server = ? AND (path = ? OR substr(path, 1, ?) = ?)",
+                        (server, directory, len(prefix), prefix))
+
+    def lookup(self, server, file_path):
+        with self._lock:
+            rows = self.db.execute("SELECT path, size, mtime FROM files WHERE server = ? AND name = ? ORDER BY path",
+                                   (server, os.path.basename(file_path))).fetchall()
+        return [{"path": path, "size": size, "mtime": mtime} for path, size, mtime in rows]
+
+    def resolve(self, server, file_path):
+        # An exact path match wins, otherwise the basename must be unique in the catalog
+        matches = self.lookup(server, file_path)
+        for match in matches:
+            if match["path"] == file_path:
+                return match["path"]
+        if len(matches) > 1:
+            raise AmbiguousFileError(os.path.basename(file_path), server, matches)
+        return matches[0]["path"] if matches else ""
+
+    def close(self):
+        with self._lock:
+            self.db.close()
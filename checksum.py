@@ -0,0 +1,34 @@
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+CHECKSUM_COMMANDS = ("sha256sum", "md5sum")
+
+
+def remote_checksum(session, path):
+    # Returns (algorithm, digest), using the first checksum tool available on the server
+    for command in CHECKSUM_COMMANDS:
+        status, output, errors = session.run(f"{command} {shlex.quote(path)}")
+        if status == 0:
+            return command[:-3], output.split()[0]
+        if "No such file" in errors:
+            raise FileNotFoundError(f"{path}: {errors.strip()}")
+    raise IOError(f"No checksum command available to check {path}")
+
+
+def files_identical(source_session, source_path, destination_session, destination_path):
+    # Size and mtime come from a cheap stat, the checksums only run when those are not conclusive
+    source_attributes = source_session.open_sftp().stat(source_path)
+    try:
+        destination_attributes = destination_session.open_sftp().stat(destination_path)
+    except FileNotFoundError:
+        return False
+
+    if source_attributes.st_size != destination_attributes.st_size:
+        return False
+    if source_attributes.st_mtime == destination_attributes.st_mtime:
+        return True
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_checksum = executor.submit(remote_checksum, source_session, source_path)
+        destination_checksum = executor.submit(remote_checksum, destination_session, destination_path)
+        return source_checksum.result() == destination_checksum.result()
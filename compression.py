@@ -0,0 +1,138 @@
+import json
+import os
+import shlex
+import threading
+import zlib
+
+CHUNK_SIZE = 1024 * 1024
+
+# auto picks between none and gzip per file, ssh turns on SSH transport compression for every connection
+COMPRESSION_MODES = ("auto", "none", "gzip", "ssh")
+
+# Already compressed formats gain nothing from another pass
+INCOMPRESSIBLE_EXTENSIONS = (".gz", ".tgz", ".zip", ".bz2", ".xz", ".zst", ".7z", ".jpg", ".jpeg", ".png", ".pdf")
+MIN_COMPRESS_SIZE = 64 * 1024
+
+# Bytes from the middle of a file that are gzipped on the source server to see how well the file compresses
+SAMPLE_SIZE = 256 * 1024
+
+# Files whose sample shrinks less than this are sent as they are
+MIN_RATIO = 1.1
+
+# gzip -1 compresses about this many bytes/s on one core, a compressed transfer cannot go faster
+GZIP_SPEED = 50 * 1024 * 1024
+
+# Smaller plain transfers are bound by latency and say little about the speed of the link
+MIN_MEASURE_SIZE = 4 * 1024 * 1024
+
+
+def choose_compression(path, size, ratio=None, link_speed=None):
+    # ratio is the sample's uncompressed / compressed size, link_speed the measured bytes/s of plain transfers.
+    # Until a pair has been measured its files go plain, which measures it.
+    if size < MIN_COMPRESS_SIZE or path.lower().endswith(INCOMPRESSIBLE_EXTENSIONS):
+        return "none"
+    if ratio is None or ratio < MIN_RATIO or link_speed is None:
+        return "none"
+    # gzip sends size / ratio bytes over the link, but no faster than gzip itself compresses
+    return "gzip" if min(link_speed * ratio, GZIP_SPEED) > link_speed else "none"
+
+
+def sample_ratio(session, path, size):
+    # Gzips SAMPLE_SIZE bytes from the middle of the file on the server, None when that fails
+    block_size = 64 * 1024
+    skip = max(0, size // 2 - SAMPLE_SIZE // 2) // block_size
+    sampled = min(SAMPLE_SIZE, size - skip * block_size)
+    quoted = shlex.quote(path)
+    status, output, errors = session.run(f"test -r {quoted} || exit 1; dd if={quoted} bs={block_size} skip={skip} "
+                                         f"count={SAMPLE_SIZE // block_size} 2>/dev/null | gzip -c -1 | wc -c")
+    try:
+        compressed = int(output.strip())
+    except ValueError:
+        return None
+    if status != 0 or sampled <= 0 or compressed <= 0:
+        return None
+    return sampled / compressed
+
+
+def auto_compression(session, path, size, link_speed):
+    # The sample costs a command on the source server, it is only taken when compression could pay off
+    if size < MIN_COMPRESS_SIZE or path.lower().endswith(INCOMPRESSIBLE_EXTENSIONS):
+        return "none"
+    if link_speed is None or link_speed >= GZIP_SPEED:
+        return "none"
+    return choose_compression(path, size, sample_ratio(session, path, size), link_speed)
+
+
+class LinkSpeeds:
+    # Measured bytes/s of plain transfers per (source, destination) server pair.
+    # Kept in a JSON file, so a new run chooses the compression from what earlier runs measured.
+    def __init__(self, path="link_speeds.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._speeds = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as speeds_file:
+                    self._speeds = json.load(speeds_file)
+            except ValueError:
+                self._speeds = {}
+
+    def get(self, source, destination):
+        with self._lock:
+            return self._speeds.get(f"{source} {destination}")
+
+    def record(self, source, destination, size, seconds):
+        if size < MIN_MEASURE_SIZE or seconds <= 0:
+            return
+        key = f"{source} {destination}"
+        with self._lock:
+            # Averaged with the earlier measurement, one slow transfer does not flip the choice
+            previous = self._speeds.get(key)
+            self._speeds[key] = size / seconds if previous is None else (previous + size / seconds) / 2
+            if self.path:
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as speeds_file:
+                    json.dump(self._speeds, speeds_file)
+                os.replace(temp_path, self.path)
+
+
+def compressed_relay(source_session, source_path, destination_session, destination_path,
+                     chunk_size=CHUNK_SIZE, callback=None):
+    # The source server gzips the file, the compressed stream is relayed to gunzip on the destination server
+    file_size = source_session.open_sftp().stat(source_path).st_size
+    temp_path = destination_path + ".gzip-tmp"
+
+    source_stdin, source_stdout, source_stderr = source_session.exec_command(f"gzip -c -1 {shlex.quote(source_path)}")
+    destination_stdin, destination_stdout, destination_stderr = destination_session.exec_command(
+        f"gzip -d -c > {shlex.quote(temp_path)}")
+
+    # Only used to count the uncompressed bytes for the progress callback
+    counter = zlib.decompressobj(wbits=31)
+    sent = 0
+    transferred = 0
+    try:
+        while True:
+            data = source_stdout.channel.recv(chunk_size)
+            if not data:
+                break
+            destination_stdin.write(data)
+            sent += len(data)
+            transferred += len(counter.decompress(data))
+            if callback:
+                callback(transferred, file_size)
+        destination_stdin.channel.shutdown_write()
+
+        if source_stdout.channel.recv_exit_status() != 0:
+            raise IOError(f"Failed to compress {source_path}: {source_stderr.read().decode().strip()}")
+        if destination_stdout.channel.recv_exit_status() != 0:
+            raise IOError(f"Failed to decompress {destination_path}: {destination_stderr.read().decode().strip()}")
+        if transferred != file_size:
+            raise IOError(f"Compressed transfer of {source_path} sent {transferred} of {file_size} bytes")
+        destination_session.open_sftp().posix_rename(temp_path, destination_path)
+    except BaseException:
+        source_stdout.channel.close()
+        destination_stdin.channel.close()
+        destination_session.run(f"rm -f {shlex.quote(temp_path)}")
+        raise
+
+    return {"size": file_size, "sent": sent, "compression": "gzip", "ratio": file_size / sent if sent else 1}
@@ -0,0 +1,117 @@
+import hashlib
+import shlex
+import threading
+import time
+
+from relay import read_chunks
+
+BLOCK_SIZE = 256 * 1024
+
+# Run on the server so the block checksums are computed without moving the file.
+# Blocks are only compared at the same offset, so the sha256 of each block is all that is needed.
+SIGNATURE_SCRIPT = """
+import hashlib, sys
+with open(sys.argv[1], "rb") as f:
+    while True:
+        block = f.read(int(sys.argv[2]))
+        if not block:
+            break
+        print(hashlib.sha256(block).hexdigest())
+"""
+
+
+def block_signature(block):
+    # Same format as SIGNATURE_SCRIPT
+    return hashlib.sha256(block).hexdigest()
+
+
+def remote_signatures(session, path, block_size=BLOCK_SIZE):
+    for python in ("python3", "python"):
+        status, output, stderr = session.run(
+            f"{python} -c {shlex.quote(SIGNATURE_SCRIPT)} {shlex.quote(path)} {block_size}")
+        if status == 0:
+            return output.splitlines()
+
+    # No Python on the server: read the file through SFTP and checksum it locally
+    sftp = session.open_sftp()
+    file_size = sftp.stat(path).st_size
+    with sftp.open(path, "rb") as remote_file:
+        return [block_signature(block) for block in read_chunks(remote_file, file_size, block_size)]
+
+
+def changed_ranges(source_signatures, destination_signatures, block_size):
+    # Consecutive changed blocks are merged into one (offset, length) range
+    ranges = []
+    for index, signature in enumerate(source_signatures):
+        if index < len(destination_signatures) and destination_signatures[index] == signature:
+            continue
+        offset = index * block_size
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + block_size)
+        else:
+            ranges.append((offset, block_size))
+    return ranges
+
+
+def delta_copy(source_session, source_path, destination_session, destination_path,
+               block_size=BLOCK_SIZE, callback=None):
+    source_sftp = source_session.open_sftp()
+    destination_sftp = destination_session.open_sftp()
+    file_size = source_sftp.stat(source_path).st_size
+    signatures = {}
+    errors = []
+
+    def compute(name, session, path):
+        try:
+            signatures[name] = remote_signatures(session, path, block_size)
+        except Exception as e:
+            errors.append(e)
+
+    # Both servers checksum their copy at the same time
+    threads = [threading.Thread(target=compute, args=("source", source_session, source_path)),
+               threading.Thread(target=compute, args=("destination", destination_session, destination_path))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    ranges = changed_ranges(signatures["source"], signatures["destination"], block_size)
+    ranges = [(offset, min(length, file_size - offset)) for offset, length in ranges]
+    total = sum(length for offset, length in ranges)
+
+    # The new version is assembled next to the old one and renamed over it when complete
+    temp_path = destination_path + ".delta-tmp"
+    status, output, stderr = destination_session.run(
+        f"cp -p {shlex.quote(destination_path)} {shlex.quote(temp_path)}")
+    if status != 0:
+        raise IOError(f"Failed to copy {destination_path} on the destination server: {stderr.strip()}")
+
+    sent = 0
+    started = time.monotonic()
+    try:
+        with source_sftp.open(source_path, "rb") as source_file, destination_sftp.open(temp_path, "r+b") as temp_file:
+            temp_file.set_pipelined(True)
+            for offset, length in ranges:
+                temp_file.seek(offset)
+                for data in read_chunks(source_file, offset + length, offset=offset):
+                    temp_file.write(data)
+                    sent += len(data)
+                    if callback:
+                        callback(sent, total)
+        destination_sftp.truncate(temp_path, file_size)
+        destination_sftp.posix_rename(temp_path, destination_path)
+    except BaseException:
+        destination_session.run(f"rm -f {shlex.quote(temp_path)}")
+        raise
+
+    return {
+        "size": file_size,
+        "sent": sent,
+        "saved": file_size - sent,
+        # Time spent sending the changed blocks, without the checksums
+        "send_seconds": time.monotonic() - started,
+        "blocks": len(signatures["source"]),
+        "changed_blocks": sum((length + block_size - 1) // block_size for offset, length in ranges),
+    }
@@ -1,13 +1,30 @@
 import tkinter as tk
-from tkinter import messagebox
-import paramiko
+from tkinter import messagebox, ttk
 import os
 
+from browser import RemoteBrowser
+from compression import COMPRESSION_MODES
+from prefetch import ListingPrefetcher
+from transferengine import TRANSFER_MODES, TransferEngine
+from worker import BackgroundWorker, TransferCancelled, TransferProgress
+
+
 class FileTransferApp:
     def __init__(self, master):
         self.master = master
         master.title("File Transfer App")
 
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # Network work runs on worker threads, results come back through the Tk main loop
+        self.worker = BackgroundWorker(master)
+        self.engine = TransferEngine(notify=lambda title, message: self.worker.post(messagebox.showerror, title, message))
+        self.progress = None
+
+        # List the default roots of every server in the background so the first clicks need no round trip
+        self.prefetcher = ListingPrefetcher(self.engine)
+        self.prefetcher.prefetch_roots()
+
         self.setup_gui()
 
     def setup_gui(self):
@@ -21,17 +38,17 @@ class FileTransferApp:
         self.source_server_label = tk.Label(frame_servers, text="Select the source server:")
         self.source_server_label.grid(row=0, column=0, padx=10)
 
+        # Servers in the order of the inventory file
+        self.servers = list(self.engine.servers)
+
         self.source_server_var = tk.StringVar(self.master)
-        self.source_server_var.set("Server 1")  # Default value
+        self.source_server_var.set(self.servers[0])  # Default value
 
         self.destination_server_label = tk.Label(frame_servers, text="Select the destination server:")
         self.destination_server_label.grid(row=0, column=2, padx=10)
 
         self.destination_server_var = tk.StringVar(self.master)
-        self.destination_server_var.set("Server 2")  # Default value
-
-        self.servers = ["Server 1", "Server 2", "Server 3", "Server 4", "Server 5", 
-                        "Server 6", "Server 7", "Server 8", "Server 9", "Server 10", "Server 11"]
+        self.destination_server_var.set(self.servers[1 % len(self.servers)])  # Default value
 
         self.source_server_menu = tk.OptionMenu(frame_servers, self.source_server_var, *self.servers, command=self.update_source_file_list)
         self.source_server_menu.grid(row=0, column=1, padx=10)
@@ -39,15 +56,16 @@ class FileTransferApp:
         self.destination_server_menu = tk.OptionMenu(frame_servers, self.destination_server_var, *self.servers, command=self.update_dest_dir_list)
         self.destination_server_menu.grid(row=0, column=3, padx=10)
 
-        # Dropdown to select source file and destination path
-        self.source_file_label = tk.Label(self.master, text="Select the source file or folder:")
+        # Browsers to select source file and destination path, double-click a [D] entry to open it
+        self.source_file_label = tk.Label(self.master, text="Select the source file:")
         self.source_file_label.pack(pady=5)
 
         self.source_file_var = tk.StringVar(self.master)
         self.source_file_var.set("")
 
-        self.source_file_menu = tk.OptionMenu(self.master, self.source_file_var, "")
-        self.source_file_menu.pack(pady=5)
+        self.source_browser = RemoteBrowser(self.master, self.engine, self.worker, on_select=self.source_file_var.set,
+                                            on_loaded=self.prefetch_children)
+        self.source_browser.pack(pady=5, fill="both", expand=True)
 
         self.dest_path_label = tk.Label(self.master, text="Select the destination path:")
         self.dest_path_label.pack(pady=5)
@@ -55,194 +73,156 @@ class FileTransferApp:
         self.dest_path_var = tk.StringVar(self.master)
         self.dest_path_var.set("/app/mf/cer/data")
 
-        self.dest_path_menu = tk.OptionMenu(self.master, self.dest_path_var, "")
-        self.dest_path_menu.pack(pady=5)
+        self.dest_browser = RemoteBrowser(self.master, self.engine, self.worker, directories_only=True,
+                                          on_select=self.dest_path_var.set, on_loaded=self.prefetch_children, height=6)
+        self.dest_browser.pack(pady=5, fill="both", expand=True)
 
-        self.transfer_button = tk.Button(self.master, text="Transfer File", command=self.transfer_file)
-        self.transfer_button.pack(pady=10)
+        self.mode_label = tk.Label(self.master, text="Select the transfer mode:")
+        self.mode_label.pack(pady=5)
 
-        self.backup_dir = "local_backup"
-        self.transfer_dir = "transferfiles"
+        self.mode_var = tk.StringVar(self.master)
+        self.mode_var.set("stream")
 
-        if not os.path.exists(self.transfer_dir):
-            os.makedirs(self.transfer_dir)
+        self.mode_menu = tk.OptionMenu(self.master, self.mode_var, *TRANSFER_MODES)
+        self.mode_menu.pack(pady=5)
 
-        # Initialize navigation to the initial folder
-        self.update_source_file_list(self.source_server_var.get())
-        self.update_dest_dir_list(self.destination_server_var.get())
+        # gzip the relayed stream, compress the SSH connections, or let each transfer choose
+        self.compression_var = tk.StringVar(self.master)
+        self.compression_var.set("auto")
 
-    def update_source_file_list(self, server_name):
-        self.update_file_list(server_name, self.source_file_menu, self.source_file_var, "/app/mf/cer/data", False)
+        self.compression_menu = tk.OptionMenu(self.master, self.compression_var, *COMPRESSION_MODES)
+        self.compression_menu.pack(pady=5)
 
-    def update_dest_dir_list(self, server_name):
-        self.update_file_list(server_name, self.dest_path_menu, self.dest_path_var, "/app/mf/cer/data", True)
+        self.skip_identical_var = tk.BooleanVar(self.master, value=True)
+        self.skip_identical_check = tk.Checkbutton(self.master, text="Skip files that are identical on the destination",
+                                                   variable=self.skip_identical_var)
+        self.skip_identical_check.pack(pady=5)
 
-    def update_file_list(self, server_name, menu_widget, var_widget, directory, is_directory):
-        try:
-            server_info = self.get_server_info(server_name)
-            if server_info is None:
-                raise ValueError(f"Server '{server_name}' not found in server list.")
+        frame_buttons = tk.Frame(self.master)
+        frame_buttons.pack(pady=10)
 
-            files, directories = self.list_files_and_dirs_on_server(server_info, directory)
-            menu = menu_widget["menu"]
-            menu.delete(0, "end")
+        self.transfer_button = tk.Button(frame_buttons, text="Transfer File", command=self.transfer_file)
+        self.transfer_button.grid(row=0, column=0, padx=5)
 
-            parent_dir = os.path.dirname(directory.rstrip('/'))
-            if parent_dir:
-                menu.add_command(label=".. (Up)", command=lambda: self.update_file_list(server_name, menu_widget, var_widget, parent_dir, is_directory))
+        self.cancel_button = tk.Button(frame_buttons, text="Cancel", command=self.cancel_transfer, state=tk.DISABLED)
+        self.cancel_button.grid(row=0, column=1, padx=5)
 
-            if directories:
-                for dir in directories:
-                    menu.add_command(label=f"[D] {dir}", command=lambda value=dir: self.update_file_list(server_name, menu_widget, var_widget, os.path.join(directory, value), is_directory))
+        self.restore_button = tk.Button(frame_buttons, text="Restore Previous Version", command=self.restore_file)
+        self.restore_button.grid(row=0, column=2, padx=5)
 
-            if files:
-                for file in files:
-                    menu.add_command(label=file, command=lambda value=os.path.join(directory, value): var_widget.set(value))
+        self.progress_bar = ttk.Progressbar(self.master, length=300, mode="determinate", maximum=100)
+        self.progress_bar.pack(pady=5)
 
-            var_widget.set(directory if is_directory else "")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to update file list: {str(e)}")
+        self.status_label = tk.Label(self.master, text="")
+        self.status_label.pack(pady=5)
+
+        # Initialize navigation to the initial folder
+        self.update_source_file_list(self.source_server_var.get())
+        self.update_dest_dir_list(self.destination_server_var.get())
+
+    def update_source_file_list(self, server_name):
+        self.source_browser.open(server_name, "/app/mf/cer/data")
+
+    def update_dest_dir_list(self, server_name):
+        self.dest_browser.open(server_name, "/app/mf/cer/data")
+
+    def prefetch_children(self, server_name, directory, directories):
+        # The next click is most likely one of these subdirectories
+        self.prefetcher.prefetch_children(server_name, directory, directories)
 
     def transfer_file(self):
         source_server = self.source_server_var.get()
         destination_server = self.destination_server_var.get()
         source_file_path = self.source_file_var.get()
+        if not source_file_path:
+            messagebox.showerror("Error", "Select a file to transfer.")
+            return
         dest_path = self.dest_path_var.get()
-
-        try:
-            # Find and backup the file on the destination server
-            self.backup_file(destination_server, source_file_path)
-
-            # Find the file on the source server and copy it to transferfiles
-            local_file_path = self.find_and_copy_file(source_server, source_file_path)
-
-            # Upload the file from transferfiles to the destination server
-            self.upload_to_server(local_file_path, destination_server, os.path.join(dest_path, os.path.basename(source_file_path)))
-
-            messagebox.showinfo("Success", f"File transferred from {source_server} to {destination_server} successfully.")
-        except Exception as e:
-            messagebox.showerror("Error", f"An error occurred: {str(e)}")
-
-    def backup_file(self, server_name, file_path):
-        server_info = self.get_server_info(server_name)
-        if server_info is None:
-            raise ValueError(f"Server '{server_name}' not found in server list.")
-        try:
-            remote_file_path = self.find_file_on_server(server_info, file_path)
-            if remote_file_path:
-                local_backup_path = os.path.join(self.backup_dir, os.path.basename(file_path))
-                self.download_from_server(server_info, remote_file_path, local_backup_path)
-        except Exception as e:
-            messagebox.showerror("Backup Error", f"Failed to backup file from {server_name}: {str(e)}")
-
-    def find_and_copy_file(self, server_name, file_path):
-        server_info = self.get_server_info(server_name)
-        if server_info is None:
-            raise ValueError(f"Server '{server_name}' not found in server list.")
-        try:
-            remote_file_path = self.find_file_on_server(server_info, file_path)
-            if remote_file_path:
-                local_transfer_path = os.path.join(self.transfer_dir, os.path.basename(file_path))
-                self.download_from_server(server_info, remote_file_path, local_transfer_path)
-                return local_transfer_path
-            else:
-                raise FileNotFoundError(f"File {file_path} not found on {server_name}")
-        except Exception as e:
-            messagebox.showerror("Find Error", f"Failed to find file on {server_name}: {str(e)}")
-
-    def get_server_info(self, server_name):
-        servers = {
-            "Server 1": {"hostname": "server1.example.com", "username": "user1", "password": "pass1"},
-            "Server 2": {"hostname": "server2.example.com", "username": "user2", "password": "pass2"},
-            "Server 3": {"hostname": "server3.example.com", "username": "user3", "password": "pass3"},
-            "Server 4": {"hostname": "server4.example.com", "username": "user4", "password": "pass4"},
-            "Server 5": {"hostname": "server5.example.com", "username": "user5", "password": "pass5"},
-            "Server 6": {"hostname": "server6.example.com", "username": "user6", "password": "pass6"},
-            "Server 7": {"hostname": "server7.example.com", "username": "user7", "password": "pass7"},
-            "Server 8": {"hostname": "server8.example.com", "username": "user8", "password": "pass8"},
-            "Server 9": {"hostname": "server9.example.com", "username": "user9", "password": "pass9"},
-            "Server 10": {"hostname": "server10.example.com", "username": "user10", "password": "pass10"},
-            "Server 11": {"hostname": "server11.example.com", "username": "user11", "password": "pass11"},
-        }
-        return servers.get(server_name)
-
-    def list_files_and_dirs_on_server(self, server_info, directory):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        password = server_info["password"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, password=password)
-
-        sftp = ssh.open_sftp()
-        files = []
-        directories = []
-
-        for item in sftp.listdir_attr(directory):
-            item_name = item.filename
-            if stat.S_ISDIR(item.st_mode):
-                directories.append(item_name)
-            else:
-                files.append(item_name)
-
-        sftp.close()
-        ssh.close()
-
-        return files, directories
-
-    def find_file_on_server(self, server_info, file_path):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        password = server_info["password"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, password=password)
-
-        sftp = ssh.open_sftp()
-
-        try:
-            sftp.stat(file_path)
-            sftp.close()
-            ssh.close()
-            return file_path
-        except FileNotFoundError:
-            sftp.close()
-            ssh.close()
-            return None
-
-    def download_from_server(self, server_info, remote_path, local_path):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        password = server_info["password"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, password=password)
-
-        sftp = ssh.open_sftp()
-        sftp.get(remote_path, local_path)
-        sftp.close()
-        ssh.close()
-
-    def upload_to_server(self, local_path, server_name, remote_path):
-        server_info = self.get_server_info(server_name)
-        if server_info is None:
-            raise ValueError(f"Server '{server_name}' not found in server list.")
-        
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        password = server_info["password"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, password=password)
-
-        sftp = ssh.open_sftp()
-        sftp.put(local_path, remote_path)
-        sftp.close()
-        ssh.close()
+        remote_path = os.path.join(dest_path, os.path.basename(source_file_path))
+
+        self.progress = TransferProgress(self.worker, self.show_progress)
+        self.transfer_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar["value"] = 0
+        self.status_label.config(text=f"Transferring {os.path.basename(source_file_path)}...")
+        self.engine.compression = self.compression_var.get()
+
+        self.worker.submit(self.engine.run_transfer, source_server, source_file_path, destination_server, remote_path,
+                           self.mode_var.get(), self.progress, self.skip_identical_var.get(),
+                           on_success=lambda result: self.transfer_succeeded(source_server, destination_server, result),
+                           on_error=self.transfer_failed)
+
+    def restore_file(self):
+        # Puts back the version the destination file had before the last transfer
+        destination_server = self.destination_server_var.get()
+        source_file_path = self.source_file_var.get()
+        dest_path = self.dest_path_var.get()
+        if not source_file_path or not dest_path:
+            messagebox.showerror("Error", "Select the file and the destination path to restore.")
+            return
+        remote_path = os.path.join(dest_path, os.path.basename(source_file_path))
+        if not messagebox.askyesno("Restore", f"Restore the previous version of {remote_path} on {destination_server}?"):
+            return
+
+        self.restore_button.config(state=tk.DISABLED)
+        self.worker.submit(self.engine.restore_backup, destination_server, remote_path,
+                           on_success=lambda backup_path: self.restore_succeeded(destination_server, remote_path,
+                                                                                 backup_path),
+                           on_error=self.restore_failed)
+
+    def restore_succeeded(self, destination_server, remote_path, backup_path):
+        self.restore_button.config(state=tk.NORMAL)
+        messagebox.showinfo("Restored", f"{remote_path} on {destination_server} was restored from {backup_path}.\n"
+                                        "The replaced version was backed up, restore again to undo.")
+
+    def restore_failed(self, error):
+        self.restore_button.config(state=tk.NORMAL)
+        messagebox.showerror("Error", f"Restore failed: {str(error)}")
+
+    def cancel_transfer(self):
+        if self.progress:
+            self.progress.cancel()
+            self.status_label.config(text="Cancelling...")
+
+    def show_progress(self, transferred, total):
+        self.progress_bar["value"] = transferred * 100 / total if total else 100
+        self.status_label.config(text=f"{transferred // 1024} KB of {total // 1024} KB")
+
+    def end_transfer(self):
+        self.progress = None
+        self.transfer_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status_label.config(text="")
+
+    def transfer_succeeded(self, source_server, destination_server, result=None):
+        self.end_transfer()
+        message = f"File transferred from {source_server} to {destination_server} successfully."
+        if result and result.get("skipped"):
+            message = f"File is identical on {source_server} and {destination_server}, nothing was transferred."
+        elif result and "remote_copy" in result:
+            message += f"\nCopied on the servers with {result['remote_copy']}, nothing passed through this PC."
+        elif result and "saved" in result:
+            message += f"\n{result['sent']} of {result['size']} bytes sent, {result['saved']} bytes saved."
+        if result and "ratio" in result:
+            message += f"\nCompressed {result['ratio']:.1f}x, {result['throughput'] / 1024 / 1024:.2f} MB/s effective."
+        if result and result.get("phases"):
+            message += "\n" + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in result["phases"].items())
+        messagebox.showinfo("Success", message)
+
+    def transfer_failed(self, error):
+        self.end_transfer()
+        if isinstance(error, TransferCancelled):
+            messagebox.showinfo("Cancelled", "The transfer was cancelled.")
+        else:
+            messagebox.showerror("Error", f"An error occurred: {str(error)}")
+
+    def on_close(self):
+        if self.progress:
+            self.progress.cancel()
+        self.worker.shutdown()
+        self.prefetcher.shutdown()
+        self.engine.close()
+        self.master.destroy()
 
 if __name__ == "__main__":
     root = tk.Tk()
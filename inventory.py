@@ -0,0 +1,106 @@
+import json
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from bandwidth import LOCAL, parse_windows
+
+INVENTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "servers.json")
+
+# Settings a server may have in the inventory, directly or through the defaults.
+# auth is "key" or "password" and picks which of key_filename and password is used,
+# jump_host names another server of the inventory to tunnel through,
+# max_sessions caps the pooled SSH sessions to the host, ciphers lists the preferred ciphers first,
+# chunk_size is the size in MB of the byte ranges of parallel transfers,
+# direct_copy_to lists the servers this one can scp to with its own key, so files go straight between them,
+# bandwidth caps the MB/s of all transfers to and from the host, bandwidth_windows change that cap by time of day
+# and link_bandwidth caps the MB/s between this server and the named servers ("local" for this machine).
+SERVER_SETTINGS = ("hostname", "port", "username", "auth", "key_filename", "password", "jump_host", "max_sessions",
+                   "ciphers", "chunk_size", "compress", "direct_copy_to", "bandwidth", "bandwidth_windows",
+                   "link_bandwidth")
+
+
+def read_document(path):
+    with open(path, "rb") as inventory_file:
+        if path.endswith(".toml"):
+            import tomllib
+            return tomllib.load(inventory_file)
+        return json.load(inventory_file)
+
+
+def load_inventory(path=INVENTORY_PATH, resolve=True):
+    # Returns {server name: server info}, built once so looking a server up later allocates nothing
+    document = read_document(path)
+    defaults = document.get("defaults", {})
+    servers = {}
+    for name, settings in document["servers"].items():
+        server_info = dict(defaults, **settings)
+        unknown = sorted(set(server_info) - set(SERVER_SETTINGS))
+        if unknown:
+            raise ValueError(f"Unknown settings for server '{name}' in {path}: {', '.join(unknown)}")
+        for setting in ("hostname", "username"):
+            if not server_info.get(setting):
+                raise ValueError(f"Server '{name}' in {path} has no {setting}")
+
+        auth = server_info.pop("auth", None)
+        if auth == "key":
+            server_info.pop("password", None)
+        elif auth == "password":
+            server_info.pop("key_filename", None)
+        elif auth is not None:
+            raise ValueError(f"Server '{name}' in {path} has an unknown auth method '{auth}'")
+        if "chunk_size" in server_info:
+            server_info["chunk_size"] = int(server_info["chunk_size"] * 1024 * 1024)
+        if "bandwidth" in server_info:
+            server_info["bandwidth"] = int(server_info["bandwidth"] * 1024 * 1024)
+        if "bandwidth_windows" in server_info:
+            try:
+                server_info["bandwidth_windows"] = parse_windows(server_info["bandwidth_windows"])
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Server '{name}' in {path} has an invalid bandwidth window: {e}")
+        servers[name] = server_info
+
+    for name, server_info in servers.items():
+        jump_host = server_info.get("jump_host")
+        if jump_host:
+            if jump_host not in servers:
+                raise ValueError(f"Server '{name}' in {path} jumps through unknown server '{jump_host}'")
+            if servers[jump_host].get("jump_host"):
+                raise ValueError(f"Jump host '{jump_host}' of server '{name}' in {path} cannot use a jump host itself")
+            server_info["jump"] = servers[jump_host]
+        for target in server_info.get("direct_copy_to", ()):
+            if target not in servers:
+                raise ValueError(f"Server '{name}' in {path} copies directly to unknown server '{target}'")
+        # Links are kept by hostname, which is how transfers find them
+        link_bandwidth = {}
+        for peer, bandwidth in server_info.get("link_bandwidth", {}).items():
+            if peer != LOCAL and peer not in servers:
+                raise ValueError(f"Server '{name}' in {path} limits the link to unknown server '{peer}'")
+            link_bandwidth[servers[peer]["hostname"] if peer != LOCAL else LOCAL] = int(bandwidth * 1024 * 1024)
+        if link_bandwidth:
+            server_info["link_bandwidth"] = link_bandwidth
+
+    if resolve:
+        resolve_addresses(servers.values())
+    return servers
+
+
+def resolve_addresses(server_infos):
+    # Looks up every hostname once, in parallel, and keeps the address with the server.
+    # Servers behind a jump host are resolved by the jump host, names that do not resolve are looked up on connect.
+    hostnames = sorted({server_info["hostname"] for server_info in server_infos if not server_info.get("jump")})
+    if not hostnames:
+        return
+
+    def resolve(hostname):
+        try:
+            return socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror:
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(16, len(hostnames))) as executor:
+        addresses = dict(zip(hostnames, executor.map(resolve, hostnames)))
+    for server_info in server_infos:
+        address = addresses.get(server_info["hostname"])
+        if address and not server_info.get("jump"):
+            server_info["address"] = address
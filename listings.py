@@ -0,0 +1,58 @@
+import stat
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# One directory entry, a plain tuple so large directories stay small in memory
+RemoteEntry = namedtuple("RemoteEntry", "name is_dir size mtime")
+
+
+def entry_from_attributes(attributes):
+    return RemoteEntry(attributes.filename, stat.S_ISDIR(attributes.st_mode), attributes.st_size, attributes.st_mtime)
+
+
+class CachedListing:
+    def __init__(self, listing, mtime):
+        self.listing = listing
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+
+class ListingCache:
+    def __init__(self, max_entries=256, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, server, path):
+        # Returns the cached entry and whether it is still inside its TTL
+        with self._lock:
+            entry = self._entries.get((server, path))
+            if entry is None:
+                return None, False
+            self._entries.move_to_end((server, path))
+            return entry, time.monotonic() - entry.checked_at < self.ttl
+
+    def put(self, server, path, listing, mtime):
+        with self._lock:
+            self._entries[(server, path)] = CachedListing(listing, mtime)
+            self._entries.move_to_end((server, path))
+            # Least recently used directories are dropped first
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def renew(self, server, path):
+        # The directory mtime did not change, so the listing is good for another TTL
+        with self._lock:
+            entry = self._entries.get((server, path))
+            if entry is not None:
+                entry.checked_at = time.monotonic()
+
+    def invalidate(self, server, path):
+        with self._lock:
+            self._entries.pop((server, path), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,351 @@
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko import (AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK, ServerInterface, SFTPAttributes, SFTPHandle,
+                      SFTPServer, SFTPServerInterface)
+
+# Size of the pieces the shaped link forwards, small enough to pace bandwidth smoothly
+SEGMENT_SIZE = 16 * 1024
+
+# Clients dropping their connections when a benchmark ends is expected, not worth a traceback
+logging.getLogger("localserver.transport").setLevel(logging.CRITICAL)
+
+
+class StandInServer(ServerInterface):
+    # Accepts any user, the stand-in only listens on localhost
+    def __init__(self):
+        # Destinations of the forwarded channels by channel id, so the stand-in can act as a jump host
+        self.forwards = {}
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        # Commands run in a local shell, so find, sha256sum and gzip behave like on the real servers
+        threading.Thread(target=run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+def forward_channels(transport, server):
+    # Connects every direct-tcpip channel opened on the transport to its destination
+    while transport.is_active():
+        channel = transport.accept(1)
+        if channel is None or channel.get_id() not in server.forwards:
+            continue
+        try:
+            target = socket.create_connection(server.forwards.pop(channel.get_id()), timeout=15)
+        except OSError:
+            channel.close()
+            continue
+        target.settimeout(None)
+        threading.Thread(target=pipe, args=(channel, target), daemon=True).start()
+        threading.Thread(target=pipe, args=(target, channel), daemon=True).start()
+
+
+def pipe(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except (OSError, EOFError):
+        pass
+    destination.close()
+
+
+def run_command(channel, command):
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def forward_stdin():
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                process.stdin.write(data)
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    errors = []
+    threading.Thread(target=forward_stdin, daemon=True).start()
+    stderr_reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    try:
+        while True:
+            data = process.stdout.read1(65536)
+            if not data:
+                break
+            channel.sendall(data)
+        stderr_reader.join()
+        channel.sendall_stderr(errors[0])
+        channel.send_exit_status(process.wait())
+    except (OSError, EOFError):
+        process.kill()
+    finally:
+        channel.close()
+
+
+class LocalHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attributes):
+        try:
+            if attributes.st_size is not None:
+                self.writefile.truncate(attributes.st_size)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class LocalSFTP(SFTPServerInterface):
+    # Serves the local filesystem under its real absolute paths
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attributes = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attributes.filename = name
+                entries.append(attributes)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attributes):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = LocalHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, old_path, new_path):
+        return self._call(os.rename, old_path, new_path)
+
+    def posix_rename(self, old_path, new_path):
+        return self._call(os.replace, old_path, new_path)
+
+    def mkdir(self, path, attributes):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attributes):
+        try:
+            if attributes.st_size is not None:
+                os.truncate(path, attributes.st_size)
+            if attributes.st_mtime is not None:
+                os.utime(path, (attributes.st_atime or attributes.st_mtime, attributes.st_mtime))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+def shape(source, destination, latency, bandwidth):
+    # Forwards one direction of a connection, delayed by latency seconds and paced to bandwidth bytes/s
+    segments = queue.Queue()
+
+    def read():
+        try:
+            while True:
+                data = source.recv(SEGMENT_SIZE)
+                if not data:
+                    break
+                segments.put((time.monotonic() + latency, data))
+        except OSError:
+            pass
+        segments.put((0, b""))
+
+    def write():
+        free_at = 0
+        try:
+            while True:
+                due, data = segments.get()
+                if not data:
+                    break
+                ready = max(due, free_at)
+                delay = ready - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                destination.sendall(data)
+                free_at = ready + (len(data) / bandwidth if bandwidth else 0)
+        except OSError:
+            pass
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    threading.Thread(target=read, daemon=True).start()
+    threading.Thread(target=write, daemon=True).start()
+
+
+class LocalSFTPServer:
+    # A paramiko SFTP server on localhost that stands in for the Linux servers in benchmarks.
+    # latency is added to every packet in each direction, bandwidth caps each connection in bytes/s.
+    def __init__(self, latency=0, bandwidth=None, host_key=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.connections = 0
+        self._listener = None
+        self._transports = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=self._accept, name="sftp-stand-in", daemon=True).start()
+        return self.port
+
+    @property
+    def port(self):
+        return self._listener.getsockname()[1]
+
+    def server_info(self):
+        return {"hostname": "127.0.0.1", "port": self.port, "username": "benchmark", "password": "benchmark"}
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self._listener.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            # Replies go out right away, so only the injected latency delays them
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.latency or self.bandwidth:
+                # The SSH server talks to one end of a socket pair, the shaped link sits between it and the client
+                server_end = self._shaped(client)
+            else:
+                server_end = client
+            transport = paramiko.Transport(server_end)
+            transport.set_log_channel("localserver.transport")
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, LocalSFTP)
+            server = StandInServer()
+            try:
+                transport.start_server(server=server)
+            except (paramiko.SSHException, EOFError, OSError):
+                continue
+            threading.Thread(target=forward_channels, args=(transport, server), daemon=True).start()
+            with self._lock:
+                self._transports.append(transport)
+
+    def _shaped(self, client):
+        server_end, link_end = socket.socketpair()
+        shape(client, link_end, self.latency, self.bandwidth)
+        shape(link_end, client, self.latency, self.bandwidth)
+        return server_end
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+
+def serve(pipe, latency, bandwidth, host_key_text):
+    # Runs a LocalSFTPServer until told to close, answering connection counts over the pipe
+    server = LocalSFTPServer(latency, bandwidth, paramiko.RSAKey.from_private_key(io.StringIO(host_key_text)))
+    pipe.send(server.start())
+    while pipe.recv() != "close":
+        pipe.send(server.connections)
+    server.close()
+
+
+class LocalSFTPProcess:
+    # A LocalSFTPServer in a child process, so its threads and memory stay out of what the client measures
+    def __init__(self, latency=0, bandwidth=None, host_key=None):
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        key_text = io.StringIO()
+        self.host_key.write_private_key(key_text)
+        self.port = None
+        self._pipe, child_pipe = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=serve, args=(child_pipe, latency, bandwidth, key_text.getvalue()),
+                                                name="sftp-stand-in", daemon=True)
+
+    def start(self):
+        self._process.start()
+        self.port = self._pipe.recv()
+        return self.port
+
+    @property
+    def connections(self):
+        self._pipe.send("connections")
+        return self._pipe.recv()
+
+    def server_info(self):
+        return {"hostname": "127.0.0.1", "port": self.port, "username": "benchmark", "password": "benchmark"}
+
+    def close(self):
+        if self._process.is_alive():
+            self._pipe.send("close")
+            self._process.join(5)
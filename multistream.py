@@ -0,0 +1,78 @@
+import queue
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from checksum import remote_checksum
+from relay import read_chunks
+
+STREAMS = 4
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def parallel_relay(pool, source_info, source_path, destination_info, destination_path,
+                   streams=STREAMS, chunk_size=CHUNK_SIZE, callback=None):
+    # Each stream has its own pair of SSH sessions, so the file is not limited to one connection's window
+    with pool.session(source_info) as source_session:
+        file_size = source_session.open_sftp().stat(source_path).st_size
+
+    temp_path = destination_path + ".parallel-tmp"
+    with pool.session(destination_info) as destination_session:
+        with destination_session.open_sftp().open(temp_path, "wb") as temp_file:
+            temp_file.truncate(file_size)
+
+    ranges = queue.Queue()
+    for offset in range(0, file_size, chunk_size):
+        ranges.put((offset, min(chunk_size, file_size - offset)))
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+    transferred = [0]
+
+    def copy_ranges():
+        try:
+            with pool.sftps(source_info, destination_info) as (source_sftp, destination_sftp):
+                with source_sftp.open(source_path, "rb") as source_file, \
+                        destination_sftp.open(temp_path, "r+b") as temp_file:
+                    temp_file.set_pipelined(True)
+                    while not stop.is_set():
+                        try:
+                            offset, length = ranges.get_nowait()
+                        except queue.Empty:
+                            return
+                        temp_file.seek(offset)
+                        for data in read_chunks(source_file, offset + length, offset=offset):
+                            temp_file.write(data)
+                            with lock:
+                                transferred[0] += len(data)
+                                if callback:
+                                    callback(transferred[0], file_size)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    workers = [threading.Thread(target=copy_ranges, name=f"stream-{index}")
+               for index in range(max(1, min(streams, ranges.qsize())))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with pool.sessions(source_info, destination_info) as (source_session, destination_session):
+        try:
+            if errors:
+                raise errors[0]
+
+            # The reassembled file must match the source before it replaces the destination
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                source_checksum = executor.submit(remote_checksum, source_session, source_path)
+                temp_checksum = executor.submit(remote_checksum, destination_session, temp_path)
+                if source_checksum.result() != temp_checksum.result():
+                    raise IOError(f"Checksum mismatch after parallel transfer of {source_path}")
+            destination_session.open_sftp().posix_rename(temp_path, destination_path)
+        except BaseException:
+            destination_session.run(f"rm -f {shlex.quote(temp_path)}")
+            raise
+
+    return {"size": file_size, "sent": transferred[0], "streams": len(workers), "checksum": source_checksum.result()[1]}
@@ -0,0 +1,76 @@
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ROOTS = ("/app/mf/cer", "/app/mf/cer/data")
+
+# Rough in-memory size of one listing entry on top of its name
+ENTRY_OVERHEAD = 64
+
+
+class ListingPrefetcher:
+    def __init__(self, engine, max_workers=4, byte_budget=4 * 1024 * 1024):
+        self.engine = engine
+        self.byte_budget = byte_budget
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.generation = 0
+        self._pending = set()
+        self._server_locks = {}
+        self._lock = threading.Lock()
+
+    def prefetch_roots(self, roots=DEFAULT_ROOTS):
+        # Started with the app, so the first directories opened on any server are already listed
+        budget = [self.byte_budget]
+        for server_name in self.engine.servers:
+            for root in roots:
+                self._schedule(server_name, root, budget, None)
+
+    def prefetch_children(self, server_name, directory, directories):
+        # The subdirectories of the directory on screen are the likely next clicks
+        with self._lock:
+            self.generation += 1
+            generation = self.generation
+        budget = [self.byte_budget]
+        for name in directories:
+            self._schedule(server_name, posixpath.join(directory, name), budget, generation)
+
+    def _schedule(self, server_name, directory, budget, generation):
+        key = (server_name, posixpath.normpath(directory))
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self.executor.submit(self._prefetch, key, budget, generation)
+
+    def _prefetch(self, key, budget, generation):
+        server_name, directory = key
+        try:
+            # Prefetches for a directory the user already left are dropped
+            if generation is not None and generation != self.generation:
+                return
+            if budget[0] <= 0:
+                return
+            server_info = self.engine.get_server_info(server_name)
+            entry, fresh = self.engine.listings.get(server_info["hostname"], directory)
+            if fresh:
+                return
+
+            # One prefetch at a time per server, so it never holds more than one pooled SFTP session
+            with self._server_lock(server_info["hostname"]):
+                files, directories = self.engine.list_files_and_dirs_on_server(server_info, directory)
+            with self._lock:
+                budget[0] -= sum(len(name) + ENTRY_OVERHEAD for name in files + directories)
+        except Exception:
+            # A prefetch is only a guess, the real listing reports its own errors
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _server_lock(self, hostname):
+        with self._lock:
+            return self._server_locks.setdefault(hostname, threading.Lock())
+
+    def shutdown(self):
+        self.generation += 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,170 @@
+import os
+import queue
+import threading
+import time
+
+from worker import TransferCancelled
+
+CHUNK_SIZE = 1024 * 1024
+MAX_BUFFERED_CHUNKS = 8
+
+
+def read_chunks(remote_file, file_size, chunk_size=CHUNK_SIZE, offset=0):
+    # readv pipelines the SFTP read requests of one chunk without prefetching the whole file
+    while offset < file_size:
+        size = min(chunk_size, file_size - offset)
+        for data in remote_file.readv([(offset, size)]):
+            yield data
+        offset += size
+
+
+def relay_file(source_sftp, source_path, destination_sftp, destination_path,
+               chunk_size=CHUNK_SIZE, max_buffered_chunks=MAX_BUFFERED_CHUNKS, callback=None):
+    # Download and upload run at the same time, joined by a bounded queue so memory stays constant
+    chunks = queue.Queue(maxsize=max_buffered_chunks)
+    stop = threading.Event()
+    errors = []
+    file_size = source_sftp.stat(source_path).st_size
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def read_source():
+        try:
+            with source_sftp.open(source_path, "rb") as source_file:
+                for data in read_chunks(source_file, file_size, chunk_size):
+                    if stop.is_set():
+                        return
+                    put(data)
+            put(b"")
+        except Exception as e:
+            errors.append(e)
+            put(None)
+
+    reader = threading.Thread(target=read_source, name="relay-reader", daemon=True)
+    reader.start()
+
+    # The file is written under a .part name and only replaces the destination once complete
+    part_path = destination_path + ".part"
+    transferred = 0
+    try:
+        with destination_sftp.open(part_path, "wb") as destination_file:
+            destination_file.set_pipelined(True)
+            while True:
+                data = chunks.get()
+                if not data:
+                    break
+                destination_file.write(data)
+                transferred += len(data)
+                if callback:
+                    callback(transferred, file_size)
+        if not errors:
+            destination_sftp.posix_rename(part_path, destination_path)
+    finally:
+        stop.set()
+        reader.join()
+        if errors or transferred != file_size:
+            remove_quietly(destination_sftp, part_path)
+
+    if errors:
+        raise errors[0]
+    return transferred
+
+
+def remove_quietly(sftp, path):
+    try:
+        sftp.remove(path)
+    except (IOError, OSError):
+        pass
+
+
+def fanout_file(source_sftp, source_path, destinations, chunk_size=CHUNK_SIZE,
+                max_buffered_chunks=MAX_BUFFERED_CHUNKS, stall_timeout=300, callback=None):
+    # The source is read once and every chunk goes to one bounded queue per destination.
+    # destinations maps a name to (sftp, path), callback is called with (name, transferred, total).
+    # Returns {name: (bytes written, exception or None)}
+    file_size = source_sftp.stat(source_path).st_size
+    queues = {name: queue.Queue(maxsize=max_buffered_chunks) for name in destinations}
+    transferred = {name: 0 for name in destinations}
+    errors = {}
+    stop = threading.Event()
+
+    def put(name, item):
+        # A destination that stays a full buffer behind for stall_timeout is dropped so the others keep going
+        deadline = time.monotonic() + stall_timeout
+        while name not in errors and not stop.is_set():
+            try:
+                queues[name].put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    errors[name] = IOError(f"{name} stalled for {stall_timeout}s")
+
+    def write_destination(name, destination_sftp, destination_path):
+        # Each destination is written under a .part name and replaced only once its copy is complete.
+        # The name is unique per destination and process, hosts sharing storage would otherwise write one file.
+        part_path = f"{destination_path}.part.{name}.{os.getpid()}"
+        complete = False
+        try:
+            with destination_sftp.open(part_path, "wb") as destination_file:
+                destination_file.set_pipelined(True)
+                while name not in errors and not stop.is_set():
+                    try:
+                        data = queues[name].get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    if data is None:
+                        raise errors["source"]
+                    if not data:
+                        complete = True
+                        break
+                    destination_file.write(data)
+                    transferred[name] += len(data)
+                    if callback:
+                        callback(name, transferred[name], file_size)
+            if complete:
+                destination_sftp.posix_rename(part_path, destination_path)
+            else:
+                errors.setdefault(name, TransferCancelled("Transfer cancelled"))
+        except TransferCancelled as e:
+            errors[name] = e
+            stop.set()
+        except Exception as e:
+            errors.setdefault(name, e)
+        if name in errors:
+            remove_quietly(destination_sftp, part_path)
+
+    writers = [threading.Thread(target=write_destination, args=(name, destination_sftp, destination_path),
+                                name=f"fanout-{name}", daemon=True)
+               for name, (destination_sftp, destination_path) in destinations.items()]
+    for writer in writers:
+        writer.start()
+
+    try:
+        with source_sftp.open(source_path, "rb") as source_file:
+            for data in read_chunks(source_file, file_size, chunk_size):
+                if stop.is_set() or all(name in errors for name in destinations):
+                    break
+                for name in destinations:
+                    put(name, data)
+        for name in destinations:
+            put(name, b"")
+    except Exception as e:
+        errors["source"] = e
+        for name in destinations:
+            put(name, None)
+    finally:
+        for writer in writers:
+            writer.join()
+
+    for error in errors.values():
+        if isinstance(error, TransferCancelled):
+            raise error
+    if "source" in errors:
+        raise errors["source"]
+    return {name: (transferred[name], errors.get(name)) for name in destinations}
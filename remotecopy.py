@@ -0,0 +1,72 @@
+import posixpath
+import shlex
+
+
+def same_host(source_info, destination_info):
+    # Server names that point at the same machine and port
+    return ((source_info.get("address") or source_info["hostname"]) ==
+            (destination_info.get("address") or destination_info["hostname"])
+            and source_info.get("port", 22) == destination_info.get("port", 22))
+
+
+def file_identity(session, path):
+    # (device, inode, size, mtime) of a file readable by the session's user, None when it cannot be read
+    quoted = shlex.quote(path)
+    status, output, errors = session.run(f"test -r {quoted} && stat -L -c '%d %i %s %Y' -- {quoted}")
+    if status != 0:
+        return None
+    return tuple(output.split())
+
+
+def shares_file(source_session, source_path, destination_session):
+    # The destination sees the very same file under the same path, so it shares the source's storage.
+    # Cloned or restored machines can hold an equal looking file of their own, so a match is only trusted once
+    # a marker created next to the file on the source shows up on the destination.
+    identity = file_identity(destination_session, source_path)
+    if identity is None or identity != file_identity(source_session, source_path):
+        return False
+    directory = shlex.quote(posixpath.dirname(source_path) or "/")
+    status, output, errors = source_session.run(f"mktemp -p {directory} .share-probe.XXXXXX")
+    if status != 0:
+        return False
+    marker = shlex.quote(output.strip())
+    try:
+        status, output, errors = destination_session.run(f"test -e {marker}")
+        return status == 0
+    finally:
+        source_session.run(f"rm -f -- {marker}")
+
+
+def server_copy(session, source_path, destination_path):
+    # Copies a file on the server itself, a reflink on filesystems that support it.
+    # The copy goes to a temporary name first, so the destination is replaced only when it is complete.
+    temp_path = destination_path + ".copy-tmp"
+    source, temp, destination = shlex.quote(source_path), shlex.quote(temp_path), shlex.quote(destination_path)
+    status, output, errors = session.run(
+        f"(cp --reflink=auto -- {source} {temp} 2>/dev/null || cp -- {source} {temp}) && mv -f -- {temp} {destination}")
+    if status != 0:
+        session.run(f"rm -f -- {temp}")
+        raise IOError(f"Server-side copy of {source_path} failed: {errors.strip()}")
+    return file_size(session, destination_path)
+
+
+def direct_scp(source_session, source_path, destination_session, destination_info, destination_path):
+    # The source server sends the file straight to the destination with its own scp and SSH key.
+    # Returns None without copying when the paths need quoting, which scp's remote side may not honour.
+    temp_path = destination_path + ".copy-tmp"
+    if shlex.quote(source_path) != source_path or shlex.quote(temp_path) != temp_path:
+        return None
+    target = f"{destination_info['username']}@{destination_info['hostname']}:{temp_path}"
+    status, output, errors = source_session.run(
+        f"scp -q -o BatchMode=yes -o ConnectTimeout=15 -P {destination_info.get('port', 22)} -- {source_path} {target}")
+    if status != 0:
+        destination_session.run(f"rm -f -- {shlex.quote(temp_path)}")
+        raise IOError(f"scp from the source server failed: {errors.strip()}")
+    status, output, errors = destination_session.run(f"mv -f -- {temp_path} {shlex.quote(destination_path)}")
+    if status != 0:
+        raise IOError(f"Failed to move {temp_path} into place: {errors.strip()}")
+    return file_size(destination_session, destination_path)
+
+
+def file_size(session, path):
+    return session.open_sftp().stat(path).st_size
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import threading
+
+from relay import CHUNK_SIZE, read_chunks
+from transfercache import mapped
+
+# Bytes before the checkpoint that are compared again before a transfer continues
+OVERLAP_SIZE = 64 * 1024
+
+# A checkpoint is written to the journal every this many bytes
+CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+
+
+class TransferJournal:
+    def __init__(self, path="transfer_journal.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as journal_file:
+                    self._entries = json.load(journal_file)
+            except ValueError:
+                # A damaged journal only means the partial transfers start over
+                self._entries = {}
+
+    def get(self, key, identity):
+        # The checkpoint only counts when the source file is still the same version
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry["identity"] == list(identity):
+            return entry["offset"]
+        return 0
+
+    def update(self, key, identity, offset):
+        with self._lock:
+            self._entries[key] = {"identity": list(identity), "offset": offset}
+            self._save()
+
+    def remove(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as journal_file:
+            json.dump(self._entries, journal_file)
+        os.replace(temp_path, self.path)
+
+
+def digest(blocks):
+    checksum = hashlib.sha256()
+    for block in blocks:
+        checksum.update(block)
+    return checksum.digest()
+
+
+def read_local(path, offset, size):
+    with open(path, "rb") as local_file:
+        local_file.seek(offset)
+        return local_file.read(size)
+
+
+def resumable_download(sftp, remote_path, local_path, journal, key, chunk_size=CHUNK_SIZE, callback=None,
+                       on_resume=None):
+    # Downloads into local_path.part and continues from the journal checkpoint after a failure
+    attributes = sftp.stat(remote_path)
+    file_size = attributes.st_size
+    identity = (file_size, attributes.st_mtime)
+    part_path = local_path + ".part"
+
+    offset = journal.get(key, identity)
+    if offset and (not os.path.exists(part_path) or os.path.getsize(part_path) < offset):
+        offset = 0
+
+    with sftp.open(remote_path, "rb") as remote_file:
+        if offset:
+            # The end of what was already written must still match the remote file
+            start = max(0, offset - OVERLAP_SIZE)
+            remote_overlap = digest(read_chunks(remote_file, offset, chunk_size, offset=start))
+            if remote_overlap != digest([read_local(part_path, start, offset - start)]):
+                offset = 0
+
+        with open(part_path, "r+b" if offset else "wb") as local_file:
+            local_file.truncate(offset)
+            local_file.seek(offset)
+            checkpoint = offset
+            if offset:
+                # A resumed download reports where it continues from before the first new chunk
+                if on_resume:
+                    on_resume(offset)
+                if callback:
+                    callback(offset, file_size)
+            for data in read_chunks(remote_file, file_size, chunk_size, offset=offset):
+                local_file.write(data)
+                offset += len(data)
+                if offset - checkpoint >= CHECKPOINT_INTERVAL:
+                    local_file.flush()
+                    os.fsync(local_file.fileno())
+                    journal.update(key, identity, offset)
+                    checkpoint = offset
+                if callback:
+                    callback(offset, file_size)
+
+    os.replace(part_path, local_path)
+    journal.remove(key)
+    return file_size
+
+
+def resumable_upload(sftp, local_path, remote_path, journal, key, chunk_size=CHUNK_SIZE, callback=None,
+                     on_resume=None):
+    # Uploads into remote_path.part, which is renamed over remote_path only when complete
+    file_size = os.path.getsize(local_path)
+    identity = (file_size, int(os.path.getmtime(local_path)))
+    part_path = remote_path + ".part"
+
+    offset = journal.get(key, identity)
+    if offset:
+        try:
+            if sftp.stat(part_path).st_size < offset:
+                offset = 0
+        except FileNotFoundError:
+            offset = 0
+
+    if offset:
+        # The end of what was already written must still match the local file
+        start = max(0, offset - OVERLAP_SIZE)
+        with sftp.open(part_path, "rb") as part_file:
+            remote_overlap = digest(read_chunks(part_file, offset, chunk_size, offset=start))
+        if remote_overlap != digest([read_local(local_path, start, offset - start)]):
+            offset = 0
+
+    # The local file is memory-mapped, chunks are sent straight from the page cache without a read copy
+    with mapped(local_path) as view, sftp.open(part_path, "r+b" if offset else "wb") as part_file:
+        part_file.set_pipelined(True)
+        part_file.truncate(offset)
+        part_file.seek(offset)
+        checkpoint = offset
+        if offset:
+            if on_resume:
+                on_resume(offset)
+            if callback:
+                callback(offset, file_size)
+        while offset < len(view):
+            with view[offset:offset + chunk_size] as data:
+                part_file.write(data)
+                offset += len(data)
+            if offset - checkpoint >= CHECKPOINT_INTERVAL:
+                # Pipelined writes may still be in flight, a resume checks the .part size and overlap first
+                part_file.flush()
+                journal.update(key, identity, offset)
+                checkpoint = offset
+            if callback:
+                callback(offset, file_size)
+
+    sftp.posix_rename(part_path, remote_path)
+    journal.remove(key)
+    return file_size
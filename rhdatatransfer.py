@@ -1,13 +1,34 @@
 import tkinter as tk
-from tkinter import messagebox
-import paramiko
+from tkinter import messagebox, ttk
 import os
+import time
+
+from batch import BatchTransfer
+from browser import RemoteBrowser
+from compression import COMPRESSION_MODES
+from prefetch import ListingPrefetcher
+from treediff import batch_from_plan
+from transferengine import TRANSFER_MODES, TransferEngine
+from worker import BackgroundWorker, TransferCancelled, TransferProgress
 
 class FileTransferApp:
     def __init__(self, master):
         self.master = master
         master.title("File Transfer App")
 
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # Network work runs on worker threads, results come back through the Tk main loop
+        self.worker = BackgroundWorker(master)
+        self.engine = TransferEngine(notify=lambda title, message: self.worker.post(messagebox.showerror, title, message))
+        self.progress = None
+        self.fanout_progress = {}
+        self.batch = None
+
+        # List the default roots of every server in the background so the first clicks need no round trip
+        self.prefetcher = ListingPrefetcher(self.engine)
+        self.prefetcher.prefetch_roots()
+
         self.setup_gui()
 
     def setup_gui(self):
@@ -21,8 +42,8 @@ class FileTransferApp:
         self.source_server_var = tk.StringVar(self.master)
         self.source_server_var.set("CERLXPT")  # Default value
 
-        self.servers = ["DESLXPT", "CERLXPT", "CERVSPT", "SPPLXPT", "SPPVSPT", 
-                        "SPPLXINT", "SPPVSINT", "PRDLXPT", "PRDVSPT", "PRDLXINT", "PRDVSINT"]
+        # Servers in the order of the inventory file
+        self.servers = list(self.engine.servers)
 
         self.source_server_menu = tk.OptionMenu(self.master, self.source_server_var, *self.servers, command=self.update_directory_list)
         self.source_server_menu.pack(pady=5)
@@ -37,6 +58,15 @@ class FileTransferApp:
         self.destination_server_menu = tk.OptionMenu(self.master, self.destination_server_var, *self.servers)
         self.destination_server_menu.pack(pady=5)
 
+        # Servers for a fan-out, the file is read once and sent to all of them at the same time
+        self.fanout_label = tk.Label(self.master, text="Or select several destination servers to fan out to:")
+        self.fanout_label.pack(pady=5)
+
+        self.fanout_listbox = tk.Listbox(self.master, selectmode=tk.MULTIPLE, exportselection=False, height=6)
+        for server in self.servers:
+            self.fanout_listbox.insert("end", server)
+        self.fanout_listbox.pack(pady=5)
+
         # Dropdown to select directory
         self.directory_label = tk.Label(self.master, text="Select the directory:")
         self.directory_label.pack(pady=5)
@@ -45,13 +75,14 @@ class FileTransferApp:
         self.directory_menu = tk.OptionMenu(self.master, self.directory_var, "", command=self.update_file_list)
         self.directory_menu.pack(pady=5)
 
-        # Dropdown to select file
+        # Browser to select the file, large directories are listed and shown page by page
         self.file_label = tk.Label(self.master, text="Select the file:")
         self.file_label.pack(pady=5)
 
         self.file_var = tk.StringVar(self.master)
-        self.file_menu = tk.OptionMenu(self.master, self.file_var, "")
-        self.file_menu.pack(pady=5)
+        self.file_browser = RemoteBrowser(self.master, self.engine, self.worker, on_select=self.file_var.set,
+                                          on_loaded=self.prefetch_children)
+        self.file_browser.pack(pady=5, fill="both", expand=True)
 
         # Input for destination path
         self.dest_path_label = tk.Label(self.master, text="Enter the destination path:")
@@ -60,196 +91,408 @@ class FileTransferApp:
         self.dest_path_entry = tk.Entry(self.master, width=50)
         self.dest_path_entry.pack(pady=5)
 
-        # Transfer button
-        self.transfer_button = tk.Button(self.master, text="Transfer File", command=self.transfer_file)
-        self.transfer_button.pack(pady=10)
+        # Stream between the servers, stage a local copy, or only send the changed blocks
+        self.mode_label = tk.Label(self.master, text="Select the transfer mode:")
+        self.mode_label.pack(pady=5)
+
+        self.mode_var = tk.StringVar(self.master)
+        self.mode_var.set("stream")  # Default value
+
+        self.mode_menu = tk.OptionMenu(self.master, self.mode_var, *TRANSFER_MODES)
+        self.mode_menu.pack(pady=5)
+
+        # gzip the relayed stream, compress the SSH connections, or let each transfer choose
+        self.compression_var = tk.StringVar(self.master)
+        self.compression_var.set("auto")
+
+        self.compression_menu = tk.OptionMenu(self.master, self.compression_var, *COMPRESSION_MODES)
+        self.compression_menu.pack(pady=5)
+
+        self.skip_identical_var = tk.BooleanVar(self.master, value=True)
+        self.skip_identical_check = tk.Checkbutton(self.master, text="Skip files that are identical on the destination",
+                                                   variable=self.skip_identical_var)
+        self.skip_identical_check.pack(pady=5)
+
+        # Transfer and cancel buttons
+        frame_buttons = tk.Frame(self.master)
+        frame_buttons.pack(pady=10)
+
+        self.transfer_button = tk.Button(frame_buttons, text="Transfer File", command=self.transfer_file)
+        self.transfer_button.grid(row=0, column=0, padx=5)
+
+        self.fanout_button = tk.Button(frame_buttons, text="Fan Out", command=self.fanout_file)
+        self.fanout_button.grid(row=0, column=1, padx=5)
+
+        self.cancel_button = tk.Button(frame_buttons, text="Cancel", command=self.cancel_transfer, state=tk.DISABLED)
+        self.cancel_button.grid(row=0, column=2, padx=5)
+
+        self.search_button = tk.Button(frame_buttons, text="Find on All Servers", command=self.search_fleet)
+        self.search_button.grid(row=0, column=3, padx=5)
+
+        self.restore_button = tk.Button(frame_buttons, text="Restore Previous Version", command=self.restore_file)
+        self.restore_button.grid(row=0, column=4, padx=5)
 
-        # Create local directories for backup and transfer
-        self.backup_dir = "local_backup"
-        self.transfer_dir = "transferfiles"
+        # Progress of the running transfer
+        self.progress_bar = ttk.Progressbar(self.master, length=300, mode="determinate", maximum=100)
+        self.progress_bar.pack(pady=5)
 
-        if not os.path.exists(self.backup_dir):
-            os.makedirs(self.backup_dir)
+        self.status_label = tk.Label(self.master, text="")
+        self.status_label.pack(pady=5)
 
-        if not os.path.exists(self.transfer_dir):
-            os.makedirs(self.transfer_dir)
+        # Batch of transfers run by parallel workers
+        self.batch_label = tk.Label(self.master, text="Batch transfer queue:")
+        self.batch_label.pack(pady=5)
+
+        frame_batch = tk.Frame(self.master)
+        frame_batch.pack(pady=5)
+
+        self.add_file_button = tk.Button(frame_batch, text="Add File", command=self.add_file_to_batch)
+        self.add_file_button.grid(row=0, column=0, padx=5)
+
+        self.add_directory_button = tk.Button(frame_batch, text="Add Directory", command=self.add_directory_to_batch)
+        self.add_directory_button.grid(row=0, column=1, padx=5)
+
+        self.run_batch_button = tk.Button(frame_batch, text="Run Batch", command=self.run_batch)
+        self.run_batch_button.grid(row=0, column=2, padx=5)
+
+        self.compare_button = tk.Button(frame_batch, text="Compare Directories", command=self.compare_directories)
+        self.compare_button.grid(row=0, column=3, padx=5)
+
+        self.batch_listbox = tk.Listbox(self.master, width=100, height=8)
+        self.batch_listbox.pack(pady=5)
 
     def update_directory_list(self, server_name):
-        try:
-            server_info = self.get_server_info(server_name)
-            directories = self.list_directories_on_server(server_info, "/app/mf/cer")
-            if directories:
-                menu = self.directory_menu["menu"]
-                menu.delete(0, "end")
-                for directory in directories:
-                    menu.add_command(label=directory, command=lambda value=directory: self.directory_var.set(value))
-                self.directory_var.set(directories[0])
-                self.update_file_list(directories[0])
-            else:
-                self.directory_var.set("")
-                menu = self.directory_menu["menu"]
-                menu.delete(0, "end")
-                menu.add_command(label="No directories found", command=lambda: None)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to update directory list: {str(e)}")
+        server_info = self.engine.get_server_info(server_name)
+        self.worker.submit(self.engine.list_directories_on_server, server_info, "/app/mf/cer",
+                           on_success=self.show_directory_list,
+                           on_error=lambda e: messagebox.showerror("Error", f"Failed to update directory list: {str(e)}"),
+                           key="directories")
+
+    def show_directory_list(self, directories):
+        if directories:
+            menu = self.directory_menu["menu"]
+            menu.delete(0, "end")
+            for directory in directories:
+                menu.add_command(label=directory, command=lambda value=directory: self.select_directory(value))
+            self.select_directory(directories[0])
+            self.prefetcher.prefetch_children(self.source_server_var.get(), "/app/mf/cer",
+                                              [os.path.basename(directory) for directory in directories])
+        else:
+            self.directory_var.set("")
+            menu = self.directory_menu["menu"]
+            menu.delete(0, "end")
+            menu.add_command(label="No directories found", command=lambda: None)
+
+    def select_directory(self, directory):
+        self.directory_var.set(directory)
+        self.update_file_list(directory)
 
     def update_file_list(self, directory):
-        try:
-            server_name = self.source_server_var.get()
-            server_info = self.get_server_info(server_name)
-            files = self.list_files_on_server(server_info, f"/app/mf/cer/{directory}")
-            if files:
-                menu = self.file_menu["menu"]
-                menu.delete(0, "end")
-                for file in files:
-                    menu.add_command(label=file, command=lambda value=file: self.file_var.set(value))
-                self.file_var.set(files[0])
-            else:
-                self.file_var.set("")
-                menu = self.file_menu["menu"]
-                menu.delete(0, "end")
-                menu.add_command(label="No files found", command=lambda: None)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to update file list: {str(e)}")
+        # directory is a full path, as returned by list_directories_on_server
+        self.file_browser.open(self.source_server_var.get(), directory)
+
+    def prefetch_children(self, server_name, directory, directories):
+        self.prefetcher.prefetch_children(server_name, directory, directories)
 
     def transfer_file(self):
         source_server = self.source_server_var.get()
         destination_server = self.destination_server_var.get()
-        directory = self.directory_var.get()
-        source_file_path = os.path.join(f"/app/mf/cer/{directory}", self.file_var.get())
+        source_file_path = self.file_var.get()
+        if not source_file_path:
+            messagebox.showerror("Error", "Select a file to transfer.")
+            return
         dest_path = self.dest_path_entry.get()
+        remote_path = os.path.join(dest_path, os.path.basename(source_file_path))
+
+        self.progress = TransferProgress(self.worker, self.show_progress)
+        self.transfer_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar["value"] = 0
+        self.status_label.config(text=f"Transferring {os.path.basename(source_file_path)}...")
+        self.engine.compression = self.compression_var.get()
 
-        try:
-            # Find and backup the file on the destination server
-            self.backup_file(destination_server, source_file_path)
-
-            # Find the file on the source server and copy it to transferfiles
-            local_file_path = self.find_and_copy_file(source_server, source_file_path)
-
-            # Upload the file from transferfiles to the destination server
-            self.upload_to_server(local_file_path, destination_server, os.path.join(dest_path, os.path.basename(source_file_path)))
-
-            messagebox.showinfo("Success", f"File transferred from {source_server} to {destination_server} successfully.")
-        except Exception as e:
-            messagebox.showerror("Error", f"An error occurred: {str(e)}")
-
-    def backup_file(self, server_name, file_path):
-        server_info = self.get_server_info(server_name)
-        try:
-            # Find the file on the destination server and download it as backup
-            remote_file_path = self.find_file_on_server(server_info, file_path)
-            if remote_file_path:
-                local_backup_path = os.path.join(self.backup_dir, os.path.basename(file_path))
-                self.download_from_server(server_info, remote_file_path, local_backup_path)
-        except Exception as e:
-            messagebox.showerror("Backup Error", f"Failed to backup file from {server_name}: {str(e)}")
-
-    def find_and_copy_file(self, server_name, file_path):
-        server_info = self.get_server_info(server_name)
-        try:
-            # Find the file on the source server and copy it to transferfiles
-            remote_file_path = self.find_file_on_server(server_info, file_path)
-            if remote_file_path:
-                local_transfer_path = os.path.join(self.transfer_dir, os.path.basename(file_path))
-                self.download_from_server(server_info, remote_file_path, local_transfer_path)
-                return local_transfer_path
+        self.worker.submit(self.engine.run_transfer, source_server, source_file_path, destination_server, remote_path,
+                           self.mode_var.get(), self.progress, self.skip_identical_var.get(),
+                           on_success=lambda result: self.transfer_succeeded(source_server, destination_server, result),
+                           on_error=self.transfer_failed)
+
+    def fanout_file(self):
+        source_server = self.source_server_var.get()
+        destination_servers = [self.fanout_listbox.get(index) for index in self.fanout_listbox.curselection()]
+        source_file_path = self.file_var.get()
+        if not destination_servers:
+            messagebox.showerror("Error", "Select the servers to fan out to.")
+            return
+        if not source_file_path:
+            messagebox.showerror("Error", "Select a file to transfer.")
+            return
+        remote_path = os.path.join(self.dest_path_entry.get(), os.path.basename(source_file_path))
+
+        # One progress per destination, each can be cancelled and shows its own percentage
+        self.fanout_percent = {server: 0 for server in destination_servers}
+        self.fanout_progress = {server: TransferProgress(self.worker, lambda transferred, total, server=server:
+                                                         self.show_fanout_progress(server, transferred, total))
+                                for server in destination_servers}
+        self.transfer_button.config(state=tk.DISABLED)
+        self.fanout_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar["value"] = 0
+        self.status_label.config(text=f"Sending {os.path.basename(source_file_path)} to {len(destination_servers)} servers...")
+        self.engine.compression = self.compression_var.get()
+
+        self.worker.submit(self.engine.fanout_transfer, source_server, source_file_path, destination_servers, remote_path,
+                           lambda server, transferred, total: self.fanout_progress[server](transferred, total),
+                           self.skip_identical_var.get(),
+                           on_success=lambda result: self.fanout_finished(source_server, result),
+                           on_error=self.transfer_failed)
+
+    def show_fanout_progress(self, server, transferred, total):
+        self.fanout_percent[server] = transferred * 100 // total if total else 100
+        # The bar follows the slowest destination
+        self.progress_bar["value"] = min(self.fanout_percent.values())
+        self.status_label.config(text=" | ".join(f"{server} {percent}%" for server, percent in self.fanout_percent.items()))
+
+    def fanout_finished(self, source_server, result):
+        self.end_transfer()
+        lines = []
+        for server, destination in result["destinations"].items():
+            line = f"{server}: {destination['status']}"
+            if destination["error"]:
+                line += f" ({destination['error']})"
+            lines.append(line)
+        if all(destination["status"] in ("done", "skipped") for destination in result["destinations"].values()):
+            messagebox.showinfo("Success", f"Fan-out from {source_server} finished.\n" + "\n".join(lines))
+        else:
+            messagebox.showerror("Error", f"Fan-out from {source_server} failed on some servers.\n" + "\n".join(lines))
+
+    def search_fleet(self):
+        file_path = self.file_var.get()
+        if not file_path:
+            messagebox.showerror("Error", "Select a file to search for.")
+            return
+
+        self.search_button.config(state=tk.DISABLED)
+        self.status_label.config(text=f"Searching all servers for {os.path.basename(file_path)}...")
+        self.worker.submit(self.engine.search_fleet, file_path, on_success=self.show_search_results,
+                           on_error=self.search_failed, key="search")
+
+    def show_search_results(self, result):
+        self.search_button.config(state=tk.NORMAL)
+        self.status_label.config(text="")
+
+        window = tk.Toplevel(self.master)
+        window.title(f"Search for {result['file']}")
+        summary = f"Found on {result['found']} of {len(result['servers'])} servers"
+        if result["differs"]:
+            summary += ", the versions differ"
+        tk.Label(window, text=summary).pack(pady=5)
+
+        table = ttk.Treeview(window, columns=("path", "size", "modified", "checksum"), height=len(result["servers"]))
+        table.heading("#0", text="Server")
+        table.heading("path", text="Path")
+        table.heading("size", text="Size")
+        table.heading("modified", text="Modified")
+        table.heading("checksum", text="Checksum")
+        table.column("#0", width=100)
+        table.column("checksum", width=300)
+        for row in result["servers"]:
+            if row["error"]:
+                table.insert("", "end", text=row["server"], values=(row["error"], "", "", ""))
             else:
-                raise FileNotFoundError(f"File {file_path} not found on {server_name}")
-        except Exception as e:
-            messagebox.showerror("Find Error", f"Failed to find file on {server_name}: {str(e)}")
-
-    def get_server_info(self, server_name):
-        # Define the connection info for each server
-        servers = {
-            "DESLXPT": {"hostname": "lxrhbmwd01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "CERLXPT": {"hostname": "lxrhbmwc01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "CERVSPT": {"hostname": "vsrhbmwc01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "SPPLXPT": {"hostname": "lxrhbmwprtq01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "SPPVSPT": {"hostname": "vsrhbmwprtq01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "SPPLXINT": {"hostname": "lxrhbmwintq01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "SPPVSINT": {"hostname": "lxrhbmwintq01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "PRDLXPT": {"hostname": "lxrhbmwprtp01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "PRDVSPT": {"hostname": "vsrhbmwprtp01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "PRDLXINT": {"hostname": "lxrhbmwintp01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-            "PRDVSINT": {"hostname": "vsrhbmwintp01.sys.sibs.pt", "username": "mfocus", "key_filename":"\\\\sibsharectm\\CTM_Jobs\\SSH_Keys\\mfocus_py"},
-        }
-        return servers.get(server_name)
-
-    def list_directories_on_server(self, server_info, directory):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        key_filename = server_info["key_filename"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, key_filename=key_filename)
-
-        stdin, stdout, stderr = ssh.exec_command(f"ls -d {directory}/*/")
-        directories = [dir.rstrip('/') for dir in stdout.read().decode().split()]
-
-        ssh.close()
-        return directories
-
-    def list_files_on_server(self, server_info, directory):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        key_filename = server_info["key_filename"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, key_filename=key_filename)
-
-        stdin, stdout, stderr = ssh.exec_command(f"ls {directory}")
-        files = stdout.read().decode().split()
-
-        ssh.close()
-        return files
-
-    def find_file_on_server(self, server_info, file_path):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        key_filename = server_info["key_filename"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, key_filename=key_filename)
-
-        stdin, stdout, stderr = ssh.exec_command(f"find / -type f -name '{os.path.basename(file_path)}' 2>/dev/null")
-        remote_file_path = stdout.readline().strip()
-
-        ssh.close()
-
-        return remote_file_path
-
-    def download_from_server(self, server_info, remote_path, local_path):
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        key_filename = server_info["key_filename"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, key_filename=key_filename)
-
-        scp = paramiko.SFTPClient.from_transport(ssh.get_transport())
-        scp.get(remote_path, local_path)
-
-        scp.close()
-        ssh.close()
-
-    def upload_to_server(self, local_path, server_name, remote_path):
-        server_info = self.get_server_info(server_name)
-        hostname = server_info["hostname"]
-        username = server_info["username"]
-        key_filename = server_info["key_filename"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username, key_filename=key_filename)
-
-        sftp = ssh.open_sftp()
-        sftp.put(local_path, remote_path)
-        sftp.close()
-        ssh.close()
+                modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["mtime"]))
+                table.insert("", "end", text=row["server"], values=(row["path"], row["size"], modified, row["checksum"]))
+        table.pack(padx=10, pady=5, fill="both", expand=True)
+
+    def search_failed(self, error):
+        self.search_button.config(state=tk.NORMAL)
+        self.status_label.config(text="")
+        messagebox.showerror("Error", f"Search failed: {str(error)}")
+
+    def restore_file(self):
+        # Puts back the version the destination file had before the last transfer
+        destination_server = self.destination_server_var.get()
+        source_file_path = self.file_var.get()
+        dest_path = self.dest_path_entry.get()
+        if not source_file_path or not dest_path:
+            messagebox.showerror("Error", "Select the file and the destination path to restore.")
+            return
+        remote_path = os.path.join(dest_path, os.path.basename(source_file_path))
+        if not messagebox.askyesno("Restore", f"Restore the previous version of {remote_path} on {destination_server}?"):
+            return
+
+        self.restore_button.config(state=tk.DISABLED)
+        self.worker.submit(self.engine.restore_backup, destination_server, remote_path,
+                           on_success=lambda backup_path: self.restore_succeeded(destination_server, remote_path,
+                                                                                 backup_path),
+                           on_error=self.restore_failed)
+
+    def restore_succeeded(self, destination_server, remote_path, backup_path):
+        self.restore_button.config(state=tk.NORMAL)
+        messagebox.showinfo("Restored", f"{remote_path} on {destination_server} was restored from {backup_path}.\n"
+                                        "The replaced version was backed up, restore again to undo.")
+
+    def restore_failed(self, error):
+        self.restore_button.config(state=tk.NORMAL)
+        messagebox.showerror("Error", f"Restore failed: {str(error)}")
+
+    def cancel_transfer(self):
+        if self.progress:
+            self.progress.cancel()
+            self.status_label.config(text="Cancelling...")
+        for progress in self.fanout_progress.values():
+            progress.cancel()
+            self.status_label.config(text="Cancelling...")
+        if self.batch:
+            self.batch.cancel()
+            self.status_label.config(text="Cancelling...")
+
+    def new_batch(self):
+        if self.batch is None:
+            self.batch = BatchTransfer(self.engine, mode=self.mode_var.get(), skip_identical=self.skip_identical_var.get(),
+                                       on_update=lambda item: self.worker.post(self.show_batch))
+        return self.batch
+
+    def add_file_to_batch(self):
+        if self.file_var.get():
+            self.add_to_batch(self.file_var.get())
+
+    def add_directory_to_batch(self):
+        self.add_to_batch(self.file_browser.directory or self.directory_var.get())
+
+    def add_to_batch(self, source_path):
+        batch = self.new_batch()
+        self.worker.submit(batch.add, self.source_server_var.get(), source_path,
+                           self.destination_server_var.get(), self.dest_path_entry.get(),
+                           on_success=lambda items: self.show_batch(),
+                           on_error=lambda e: messagebox.showerror("Error", f"Failed to add {source_path} to the batch: {str(e)}"))
+
+    def compare_directories(self):
+        # Compares the open source directory with the destination path and offers to queue what differs
+        source_root = self.file_browser.directory or self.directory_var.get()
+        destination_root = self.dest_path_entry.get()
+        if not source_root or not destination_root:
+            messagebox.showerror("Error", "Select a source directory and enter the destination path.")
+            return
+
+        self.compare_button.config(state=tk.DISABLED)
+        self.status_label.config(text=f"Comparing {source_root} with {destination_root}...")
+        self.worker.submit(self.engine.diff_trees, self.source_server_var.get(), source_root,
+                           self.destination_server_var.get(), destination_root,
+                           on_success=self.show_sync_plan, on_error=self.compare_failed, key="compare")
+
+    def show_sync_plan(self, plan):
+        self.compare_button.config(state=tk.NORMAL)
+        self.status_label.config(text="")
+
+        window = tk.Toplevel(self.master)
+        window.title(f"{plan['source_server']}:{plan['source_root']} -> {plan['destination_server']}:{plan['destination_root']}")
+        tk.Label(window, text=f"{len(plan['new'])} new, {len(plan['changed'])} changed, "
+                              f"{len(plan['deleted'])} only on {plan['destination_server']}, "
+                              f"{plan['unchanged']} unchanged").pack(pady=5)
+
+        listbox = tk.Listbox(window, width=100, height=20)
+        for change in ("new", "changed", "deleted"):
+            for path in plan[change]:
+                listbox.insert("end", f"{change:8} {path}")
+        listbox.pack(padx=10, pady=5, fill="both", expand=True)
+
+        def add_plan_to_batch():
+            batch = self.new_batch()
+            batch.items.extend(batch_from_plan(self.engine, plan).items)
+            self.show_batch()
+            window.destroy()
+
+        tk.Button(window, text="Add New and Changed Files to Batch", command=add_plan_to_batch,
+                  state=tk.NORMAL if plan["new"] or plan["changed"] else tk.DISABLED).pack(pady=5)
+
+    def compare_failed(self, error):
+        self.compare_button.config(state=tk.NORMAL)
+        self.status_label.config(text="")
+        messagebox.showerror("Error", f"Failed to compare the directories: {str(error)}")
+
+    def show_batch(self):
+        self.batch_listbox.delete(0, "end")
+        if self.batch:
+            for item in self.batch.items:
+                self.batch_listbox.insert("end", str(item))
+
+    def run_batch(self):
+        if not self.batch or not self.batch.items:
+            messagebox.showinfo("Batch", "The batch is empty.")
+            return
+
+        self.run_batch_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.status_label.config(text=f"Running {len(self.batch.items)} transfers...")
+        self.engine.compression = self.compression_var.get()
+        self.worker.submit(self.batch.run, on_success=self.batch_finished, on_error=self.batch_failed)
+
+    def batch_finished(self, summary):
+        self.show_batch()
+        self.batch.cancel_event.clear()
+        if summary["statuses"].get("done", 0) + summary["statuses"].get("skipped", 0) == summary["items"]:
+            self.batch = None
+        self.run_batch_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status_label.config(text="")
+        statuses = ", ".join(f"{count} {status}" for status, count in summary["statuses"].items())
+        messagebox.showinfo("Batch", f"{statuses} in {summary['seconds']:.1f}s "
+                                     f"({summary['throughput'] / 1024 / 1024:.2f} MB/s)")
+
+    def batch_failed(self, error):
+        # The batch stays queued so it can be run again
+        self.show_batch()
+        self.batch.cancel_event.clear()
+        self.run_batch_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status_label.config(text="")
+        messagebox.showerror("Error", f"Batch failed: {str(error)}")
+
+    def show_progress(self, transferred, total):
+        self.progress_bar["value"] = transferred * 100 / total if total else 100
+        self.status_label.config(text=f"{transferred // 1024} KB of {total // 1024} KB")
+
+    def end_transfer(self):
+        self.progress = None
+        self.fanout_progress = {}
+        self.transfer_button.config(state=tk.NORMAL)
+        self.fanout_button.config(state=tk.NORMAL)
+        # A batch still running keeps Cancel, batch_finished turns it off
+        if str(self.run_batch_button["state"]) != tk.DISABLED:
+            self.cancel_button.config(state=tk.DISABLED)
+        self.status_label.config(text="")
+
+    def transfer_succeeded(self, source_server, destination_server, result=None):
+        self.end_transfer()
+        message = f"File transferred from {source_server} to {destination_server} successfully."
+        if result and result.get("skipped"):
+            message = f"File is identical on {source_server} and {destination_server}, nothing was transferred."
+        elif result and "remote_copy" in result:
+            message += f"\nCopied on the servers with {result['remote_copy']}, nothing passed through this PC."
+        elif result and "saved" in result:
+            message += f"\n{result['sent']} of {result['size']} bytes sent, {result['saved']} bytes saved."
+        if result and "ratio" in result:
+            message += f"\nCompressed {result['ratio']:.1f}x, {result['throughput'] / 1024 / 1024:.2f} MB/s effective."
+        if result and result.get("phases"):
+            message += "\n" + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in result["phases"].items())
+        messagebox.showinfo("Success", message)
+
+    def transfer_failed(self, error):
+        self.end_transfer()
+        if isinstance(error, TransferCancelled):
+            messagebox.showinfo("Cancelled", "The transfer was cancelled.")
+        else:
+            messagebox.showerror("Error", f"An error occurred: {str(error)}")
+
+    def on_close(self):
+        if self.progress:
+            self.progress.cancel()
+        for progress in self.fanout_progress.values():
+            progress.cancel()
+        self.worker.shutdown()
+        self.prefetcher.shutdown()
+        self.engine.close()
+        self.master.destroy()
 
 if __name__ == "__main__":
     root = tk.Tk()
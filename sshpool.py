@@ -0,0 +1,320 @@
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import paramiko
+
+from telemetry import Telemetry
+
+# Errors worth a reconnect attempt when opening a new session
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, socket.error)
+
+
+def connect_kwargs(server_info):
+    # Servers are configured either with a key file or with a password
+    kwargs = {"username": server_info["username"], "port": server_info.get("port", 22)}
+    if server_info.get("key_filename"):
+        kwargs["key_filename"] = server_info["key_filename"]
+    if server_info.get("password"):
+        kwargs["password"] = server_info["password"]
+    if "key_filename" in kwargs or "password" in kwargs:
+        # Only the configured credential is offered, no round trips for agent or default keys first
+        kwargs["allow_agent"] = False
+        kwargs["look_for_keys"] = False
+    if server_info.get("compress"):
+        kwargs["compress"] = True
+    if server_info.get("ciphers"):
+        kwargs["transport_factory"] = cipher_preference(server_info["ciphers"])
+    return kwargs
+
+
+def cipher_preference(ciphers):
+    def create_transport(sock, **kwargs):
+        transport = paramiko.Transport(sock, **kwargs)
+        options = transport.get_security_options()
+        # The preferred ciphers are offered first, the rest stay available for servers without them
+        options.ciphers = tuple(ciphers) + tuple(cipher for cipher in options.ciphers if cipher not in ciphers)
+        return transport
+
+    return create_transport
+
+
+class HostKeyCache(paramiko.MissingHostKeyPolicy):
+    # Host keys are read once and kept in memory; a new host is trusted and saved on first use, a changed key is refused
+    def __init__(self, path=None):
+        self.path = path
+        self.host_keys = paramiko.HostKeys()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.host_keys.load(path)
+
+    def missing_host_key(self, client, hostname, key):
+        self.check(hostname, key)
+
+    def check(self, hostname, key):
+        # Raises BadHostKeyException when hostname is known with another key of the same type
+        with self._lock:
+            known = self.host_keys.lookup(hostname)
+            if known is not None and key.get_name() in known:
+                if known[key.get_name()] != key:
+                    raise paramiko.BadHostKeyException(hostname, key, known[key.get_name()])
+                return
+            self.host_keys.add(hostname, key.get_name(), key)
+            if self.path:
+                try:
+                    self.host_keys.save(self.path)
+                except OSError:
+                    # The key is still cached for this run
+                    pass
+
+
+class PooledSession:
+    def __init__(self, key, ssh):
+        self.key = key
+        self.ssh = ssh
+        self.sftp = None
+        # Connection to the jump host the session is tunnelled through, if any
+        self.jump = None
+        self.last_used = time.monotonic()
+
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def open_sftp(self):
+        # The SFTP channel is opened once and kept with the session
+        if self.sftp is None:
+            self.sftp = self.ssh.open_sftp()
+        return self.sftp
+
+    def exec_command(self, command):
+        return self.ssh.exec_command(command)
+
+    def run(self, command, timeout=None):
+        # Runs a command to completion and returns its exit status, stdout and stderr
+        stdin, stdout, stderr = self.ssh.exec_command(command, timeout=timeout)
+        output = stdout.read().decode()
+        errors = stderr.read().decode()
+        return stdout.channel.recv_exit_status(), output, errors
+
+    def close(self):
+        try:
+            if self.sftp is not None:
+                self.sftp.close()
+        finally:
+            self.sftp = None
+            self.ssh.close()
+            if self.jump is not None:
+                self.jump.close()
+
+
+class SSHConnectionPool:
+    def __init__(self, max_sessions_per_host=4, idle_timeout=300, keepalive_interval=30,
+                 connect_timeout=15, connect_retries=2, telemetry=None, known_hosts=None):
+        self.max_sessions_per_host = max_sessions_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        self.connect_retries = connect_retries
+        self.handshakes = 0
+        self.telemetry = telemetry or Telemetry()
+        self.host_keys = HostKeyCache(known_hosts)
+
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._open = {}
+        self._closed = False
+        self._reaper = None
+
+    def _limit(self, server_info):
+        # Servers may allow fewer sessions than the pool default
+        return server_info.get("max_sessions", self.max_sessions_per_host)
+
+    def _key(self, server_info):
+        # Compressed and plain connections to the same host are kept apart
+        return (server_info["hostname"], server_info.get("port", 22), server_info["username"],
+                bool(server_info.get("compress")))
+
+    def _connect(self, server_info):
+        key = self._key(server_info)
+        host = server_info["hostname"]
+        port = server_info.get("port", 22)
+        delay = 1
+        for attempt in range(self.connect_retries + 1):
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(self.host_keys)
+            jump = None
+            try:
+                # The TCP connect is timed apart from the SSH handshake, which includes the authentication
+                with self.telemetry.phase("connect", host):
+                    if server_info.get("jump"):
+                        # Tunnelled through the jump host, which resolves the name itself
+                        jump = self._connect(server_info["jump"])
+                        sock = jump.ssh.get_transport().open_channel("direct-tcpip", (host, port), ("127.0.0.1", 0),
+                                                                     timeout=self.connect_timeout)
+                    else:
+                        # The address resolved with the inventory saves a DNS lookup, a retry resolves the name again
+                        address = server_info.get("address") if attempt == 0 else None
+                        sock = socket.create_connection((address or host, port), timeout=self.connect_timeout)
+                        # Small SFTP requests go out at once instead of waiting for the previous ACK
+                        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with self.telemetry.phase("handshake", host):
+                    ssh.connect(host, timeout=self.connect_timeout, sock=sock, **connect_kwargs(server_info))
+            except (paramiko.AuthenticationException, paramiko.BadHostKeyException):
+                ssh.close()
+                if jump is not None:
+                    jump.close()
+                raise
+            except CONNECTION_ERRORS:
+                ssh.close()
+                if jump is not None:
+                    jump.close()
+                if attempt == self.connect_retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+                continue
+            ssh.get_transport().set_keepalive(self.keepalive_interval)
+            with self._cond:
+                self.handshakes += 1
+            session = PooledSession(key, ssh)
+            session.jump = jump
+            return session
+
+    def acquire(self, server_info):
+        return self.acquire_many([server_info])[0]
+
+    def acquire_many(self, server_infos):
+        # All sessions are reserved at once, so a transfer never holds one host while waiting for another
+        keys = [self._key(server_info) for server_info in server_infos]
+        needed = Counter(keys)
+        limits = {key: self._limit(server_info) for key, server_info in zip(keys, server_infos)}
+        for key, count in needed.items():
+            if count > limits[key]:
+                raise ValueError(f"More than {limits[key]} sessions requested for {key[0]}")
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                self._start_reaper()
+                for key in needed:
+                    self._drop_dead_sessions(key)
+                if all(len(self._idle.get(key, [])) + limits[key] - self._open.get(key, 0) >= count
+                       for key, count in needed.items()):
+                    break
+                self._cond.wait()
+
+            sessions = []
+            for key in keys:
+                idle = self._idle.get(key)
+                if idle:
+                    sessions.append(idle.pop())
+                else:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    sessions.append(None)
+
+        try:
+            for index, server_info in enumerate(server_infos):
+                if sessions[index] is None:
+                    sessions[index] = self._connect(server_info)
+        except Exception:
+            for key, session in zip(keys, sessions):
+                if session is not None:
+                    self.release(session)
+                else:
+                    with self._cond:
+                        self._open[key] -= 1
+                        self._cond.notify_all()
+            raise
+        return sessions
+
+    def _drop_dead_sessions(self, key):
+        idle = self._idle.get(key, [])
+        for session in [session for session in idle if not session.is_active()]:
+            idle.remove(session)
+            self._open[key] -= 1
+            self._close(session)
+
+    def _close(self, session):
+        with self.telemetry.phase("close", session.key[0]):
+            session.close()
+
+    def release(self, session, broken=False):
+        with self._cond:
+            if broken or self._closed or not session.is_active():
+                self._open[session.key] -= 1
+                self._close(session)
+            else:
+                session.last_used = time.monotonic()
+                self._idle.setdefault(session.key, []).append(session)
+            self._cond.notify_all()
+
+    @contextmanager
+    def session(self, server_info):
+        with self.sessions(server_info) as (session,):
+            yield session
+
+    @contextmanager
+    def sessions(self, *server_infos):
+        sessions = self.acquire_many(server_infos)
+        broken = False
+        try:
+            yield sessions
+        except (paramiko.SSHException, EOFError):
+            broken = True
+            raise
+        finally:
+            # Remote errors such as a missing file leave the sessions usable
+            for session in sessions:
+                self.release(session, broken=broken)
+
+    @contextmanager
+    def sftp(self, server_info):
+        with self.session(server_info) as session:
+            yield session.open_sftp()
+
+    @contextmanager
+    def sftps(self, *server_infos):
+        with self.sessions(*server_infos) as sessions:
+            yield [session.open_sftp() for session in sessions]
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._cond:
+            for key, idle in self._idle.items():
+                keep = []
+                for session in idle:
+                    if now - session.last_used > self.idle_timeout or not session.is_active():
+                        self._open[key] -= 1
+                        self._close(session)
+                    else:
+                        keep.append(session)
+                self._idle[key] = keep
+            self._cond.notify_all()
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, name="ssh-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+            time.sleep(min(self.idle_timeout, 30))
+            self.evict_idle()
+
+    def close_all(self):
+        with self._cond:
+            self._closed = True
+            for key, idle in self._idle.items():
+                for session in idle:
+                    self._open[key] -= 1
+                    self._close(session)
+            self._idle.clear()
+            self._cond.notify_all()
@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the phase duration histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+METRICS_PORT = 9464
+
+
+class Measurement:
+    def __init__(self):
+        # Set by the code inside the phase when it moves data
+        self.bytes = 0
+
+
+class PhaseStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(BUCKETS)
+
+
+class Telemetry:
+    def __init__(self, log_path=None):
+        # One JSON line per finished phase is appended to log_path when it is set
+        self.log_path = log_path
+        self.stats = {}
+        self.server = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def phase(self, name, source="", destination=""):
+        # Times the block and records it under (name, source, destination), also when it raises
+        measurement = Measurement()
+        started = time.monotonic()
+        error = None
+        try:
+            yield measurement
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(name, source, destination, time.monotonic() - started, measurement.bytes, error)
+
+    @contextmanager
+    def collect(self):
+        # Gathers {phase: seconds} of the phases run by this thread inside the block
+        phases = {}
+        previous = getattr(self._local, "phases", None)
+        self._local.phases = phases
+        try:
+            yield phases
+        finally:
+            self._local.phases = previous
+
+    def record(self, name, source, destination, seconds, size=0, error=None):
+        phases = getattr(self._local, "phases", None)
+        if phases is not None:
+            phases[name] = phases.get(name, 0) + seconds
+
+        with self._lock:
+            stats = self.stats.setdefault((name, source, destination), PhaseStats())
+            stats.count += 1
+            stats.seconds += seconds
+            stats.bytes += size
+            if error:
+                stats.errors += 1
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[index] += 1
+
+            if self.log_path:
+                event = {"time": time.time(), "phase": name, "source": source, "destination": destination,
+                         "seconds": round(seconds, 6), "bytes": size,
+                         "throughput": round(size / seconds) if size and seconds else 0, "error": error}
+                try:
+                    with open(self.log_path, "a") as log_file:
+                        log_file.write(json.dumps(event) + "\n")
+                except OSError:
+                    # Metrics must never fail a transfer
+                    pass
+
+    def summary(self):
+        # One row per phase and server pair, slowest first
+        with self._lock:
+            rows = [{"phase": name, "source": source, "destination": destination, "count": stats.count,
+                     "errors": stats.errors, "seconds": stats.seconds, "bytes": stats.bytes,
+                     "throughput": stats.bytes / stats.seconds if stats.bytes and stats.seconds else 0}
+                    for (name, source, destination), stats in self.stats.items()]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = ["# HELP transfer_phase_seconds Time spent in each transfer phase.",
+                 "# TYPE transfer_phase_seconds histogram"]
+        with self._lock:
+            stats = sorted(self.stats.items())
+            for (name, source, destination), phase in stats:
+                labels = f'phase="{name}",source="{source}",destination="{destination}"'
+                for bound, count in zip(BUCKETS, phase.buckets):
+                    lines.append(f'transfer_phase_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'transfer_phase_seconds_bucket{{{labels},le="+Inf"}} {phase.count}')
+                lines.append(f"transfer_phase_seconds_sum{{{labels}}} {phase.seconds}")
+                lines.append(f"transfer_phase_seconds_count{{{labels}}} {phase.count}")
+
+            lines += ["# HELP transfer_bytes_total Bytes moved by each transfer phase.",
+                      "# TYPE transfer_bytes_total counter"]
+            for (name, source, destination), phase in stats:
+                lines.append(f'transfer_bytes_total{{phase="{name}",source="{source}",destination="{destination}"}} {phase.bytes}')
+
+            lines += ["# HELP transfer_phase_errors_total Transfer phases that ended with an error.",
+                      "# TYPE transfer_phase_errors_total counter"]
+            for (name, source, destination), phase in stats:
+                lines.append(f'transfer_phase_errors_total{{phase="{name}",source="{source}",destination="{destination}"}} {phase.errors}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=METRICS_PORT, address="127.0.0.1"):
+        # Exposes the metrics on http://address:port/metrics from a background thread
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = telemetry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
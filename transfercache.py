@@ -0,0 +1,167 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Bytes of staged files kept on disk, the least recently used ones are removed beyond this
+CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+# blobs holds one file per sha256, sources tells which version of which remote file each blob is
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+CREATE INDEX IF NOT EXISTS blobs_size ON blobs (size);
+CREATE TABLE IF NOT EXISTS sources (
+    hostname TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (hostname, path)
+);
+CREATE INDEX IF NOT EXISTS sources_sha256 ON sources (sha256);
+"""
+
+
+@contextmanager
+def mapped(path):
+    # Read-only memoryview of a local file, paged in by the OS instead of copied through read buffers
+    with open(path, "rb") as local_file:
+        if os.fstat(local_file.fileno()).st_size == 0:
+            # mmap cannot map an empty file
+            yield memoryview(b"")
+            return
+        with mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+            yield view
+
+
+def file_sha256(path):
+    checksum = hashlib.sha256()
+    with mapped(path) as view:
+        checksum.update(view)
+    return checksum.hexdigest()
+
+
+class TransferCache:
+    # Staged files stored once by content, so the same artifact promoted to several servers is downloaded once.
+    # A blob is pinned while a transfer uploads it and only unpinned blobs are evicted.
+    def __init__(self, directory="transferfiles", max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.incoming_dir = os.path.join(directory, "incoming")
+        for path in (self.blob_dir, self.incoming_dir):
+            os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pins = {}
+        self._source_locks = {}
+        self.db = sqlite3.connect(os.path.join(directory, "cache.db"), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def incoming_path(self, hostname, path):
+        # Downloads land under a name of their own per remote file, so a retry resumes them
+        # and files with the same basename in different directories never overwrite each other
+        return os.path.join(self.incoming_dir, hashlib.sha256(f"{hostname}:{path}".encode()).hexdigest())
+
+    def source_lock(self, hostname, path):
+        # Held while one remote file is looked up and downloaded, a second transfer of it waits and then hits the cache
+        with self._lock:
+            return self._source_locks.setdefault((hostname, path), threading.Lock())
+
+    def lookup(self, hostname, path, size, mtime):
+        # sha256 of this version of the remote file when it was cached before
+        with self._lock:
+            row = self.db.execute("SELECT sha256 FROM sources WHERE hostname = ? AND path = ? AND size = ? AND mtime = ?",
+                                  (hostname, path, size, int(mtime))).fetchone()
+        return row[0] if row else None
+
+    def has_size(self, size):
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM blobs WHERE size = ? LIMIT 1", (size,)).fetchone() is not None
+
+    def acquire(self, sha256):
+        # Pins the blob and returns its path, None when it is not cached or was removed from disk
+        blob_path = self.blob_path(sha256)
+        with self._lock:
+            if not os.path.exists(blob_path):
+                self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                self.db.execute("DELETE FROM sources WHERE sha256 = ?", (sha256,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE blobs SET last_used = ? WHERE sha256 = ?", (time.time(), sha256))
+            self.db.commit()
+            self._pins[sha256] = self._pins.get(sha256, 0) + 1
+        return blob_path
+
+    def link(self, hostname, path, size, mtime, sha256):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO sources (hostname, path, size, mtime, sha256) VALUES (?, ?, ?, ?, ?)",
+                            (hostname, path, size, int(mtime), sha256))
+            self.db.commit()
+
+    def add(self, hostname, path, size, mtime, local_path):
+        # Moves a downloaded file into the cache and returns the pinned blob path.
+        # When the content is already cached the download is dropped and the existing blob is used.
+        sha256 = file_sha256(local_path)
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with self._lock:
+            if os.path.exists(blob_path):
+                os.remove(local_path)
+            else:
+                os.replace(local_path, blob_path)
+            self.db.execute("INSERT OR REPLACE INTO blobs (sha256, size, last_used) VALUES (?, ?, ?)",
+                            (sha256, os.path.getsize(blob_path), time.time()))
+            self.db.execute("INSERT OR REPLACE INTO sources (hostname, path, size, mtime, sha256) VALUES (?, ?, ?, ?, ?)",
+                            (hostname, path, size, int(mtime), sha256))
+            self.db.commit()
+            self._pins[sha256] = self._pins.get(sha256, 0) + 1
+        self.evict()
+        return blob_path
+
+    def release(self, blob_path):
+        sha256 = os.path.basename(blob_path)
+        with self._lock:
+            count = self._pins.pop(sha256, 0) - 1
+            if count > 0:
+                self._pins[sha256] = count
+        self.evict()
+
+    def evict(self):
+        # Removes the least recently used unpinned blobs until the cache fits in max_size
+        with self._lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_size:
+                return
+            for sha256, size in self.db.execute("SELECT sha256, size FROM blobs ORDER BY last_used").fetchall():
+                if total <= self.max_size:
+                    break
+                if sha256 in self._pins:
+                    continue
+                try:
+                    os.remove(self.blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+                self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                self.db.execute("DELETE FROM sources WHERE sha256 = ?", (sha256,))
+                total -= size
+            self.db.commit()
+
+    def usage(self):
+        with self._lock:
+            blobs, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"blobs": blobs, "size": size, "max_size": self.max_size}
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,1020 @@
+import argparse
+import json
+import os
+import posixpath
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from bandwidth import LOCAL, PRIORITIES, BandwidthScheduler
+from backups import GENERATIONS, list_backups, restore, snapshot
+from catalog import RemoteFileCatalog
+from checksum import files_identical, remote_checksum
+from compression import COMPRESSION_MODES, LinkSpeeds, auto_compression, compressed_relay
+from delta import delta_copy
+from inventory import INVENTORY_PATH, load_inventory
+from listings import ListingCache, RemoteEntry, entry_from_attributes
+from multistream import CHUNK_SIZE, STREAMS, parallel_relay
+from relay import fanout_file, relay_file
+from remotecopy import direct_scp, same_host, server_copy, shares_file
+from resume import TransferJournal, resumable_download, resumable_upload
+from sshpool import SSHConnectionPool
+from telemetry import Telemetry
+from transfercache import CACHE_SIZE, TransferCache
+from treediff import compare_trees, remote_checksums, remote_tree
+from worker import TransferCancelled
+
+# stream relays the file between the servers, staged copies it through the transferfiles cache,
+# delta only sends the blocks that differ from the copy already on the destination,
+# parallel relays byte ranges of the file over several SSH sessions at once
+TRANSFER_MODES = ("stream", "staged", "delta", "parallel")
+
+# paramiko runs each operation on a thread with a pooled session, asyncio multiplexes them over one connection per host
+ENGINES = ("paramiko", "asyncio")
+ASYNC_COMMANDS = ("list", "backup", "transfer")
+
+
+class TransferEngine:
+    def __init__(self, servers=None, catalog_roots=("/app/mf/cer",), catalog_path="file_catalog.db",
+                 backup_dir="local_backup", transfer_dir="transferfiles", notify=None,
+                 streams=STREAMS, chunk_size=CHUNK_SIZE, compression="auto", journal_path="transfer_journal.json",
+                 retries=3, retry_backoff=2, metrics_log="transfer_metrics.jsonl", metrics_port=None,
+                 inventory_path=INVENTORY_PATH, known_hosts_path="known_hosts", remote_copy=True,
+                 backup_mode="server", backup_generations=GENERATIONS, cache_size=CACHE_SIZE,
+                 link_speeds_path="link_speeds.json"):
+        # The servers and their connection settings come from the inventory file unless they are given directly
+        self.servers = servers if servers is not None else load_inventory(inventory_path)
+        # Bandwidth limits per host and link, shared by all transfers; edits to the inventory apply while running
+        self.bandwidth = BandwidthScheduler(self.servers)
+        if servers is None:
+            self.bandwidth.watch(inventory_path)
+        # Server infos with SSH compression turned on, made once per server
+        self.compressed_servers = {}
+        self.streams = streams
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # Copy on the servers themselves when they share a host or storage, or trust each other for scp
+        self.remote_copy = remote_copy
+        # Measured bytes/s of plain transfers per server pair, used by the auto compression choice
+        self.link_speeds = LinkSpeeds(link_speeds_path)
+        # server keeps snapshots next to the file on the destination host, local downloads it to backup_dir
+        self.backup_mode = backup_mode
+        self.backup_generations = backup_generations
+        self.backup_dir = backup_dir
+        self.transfer_dir = transfer_dir
+        # Called with (title, message) for problems that do not stop a transfer
+        self.notify = notify or (lambda title, message: None)
+
+        # Timings and bytes of every transfer phase, logged as JSON lines and optionally served to Prometheus
+        self.telemetry = Telemetry(metrics_log)
+        if metrics_port:
+            self.telemetry.serve(metrics_port)
+
+        # SSH sessions are shared by all operations, one pool for the whole engine
+        self.pool = SSHConnectionPool(max_sessions_per_host=max(4, streams), telemetry=self.telemetry,
+                                      known_hosts=known_hosts_path)
+
+        # Index of the files under the catalog roots on each server, used instead of searching the whole filesystem
+        self.catalog = RemoteFileCatalog(catalog_path, roots=catalog_roots)
+
+        # Checkpoints of interrupted downloads and uploads, so a retry continues where it stopped
+        self.journal = TransferJournal(journal_path)
+
+        # Directory listings already seen while browsing, keyed by (hostname, directory)
+        self.listings = ListingCache()
+
+        # Create local directories for backup and transfer
+        for directory in (self.backup_dir, self.transfer_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        # Staged files by content, downloaded once however many servers they are uploaded to
+        self.cache = TransferCache(self.transfer_dir, max_size=cache_size)
+
+    def get_server_info(self, server_name):
+        server_info = self.servers.get(server_name)
+        if server_info is None:
+            raise ValueError(f"Server '{server_name}' not found in server list.")
+        if self.compression == "ssh":
+            compressed = self.compressed_servers.get(server_name)
+            if compressed is None:
+                compressed = self.compressed_servers[server_name] = dict(server_info, compress=True)
+            return compressed
+        return server_info
+
+    def run_transfer(self, source_server, source_file_path, destination_server, remote_path, mode="stream", progress=None,
+                     skip_identical=True, priority="normal"):
+        if mode not in TRANSFER_MODES:
+            raise ValueError(f"Unknown transfer mode '{mode}'")
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}'")
+
+        # The result reports the seconds spent in each phase of this transfer
+        with self.telemetry.collect() as phases:
+            result = self.transfer(source_server, source_file_path, destination_server, remote_path, mode, progress,
+                                   skip_identical, priority)
+        result["phases"] = phases
+        return result
+
+    def transfer(self, source_server, source_file_path, destination_server, remote_path, mode, progress, skip_identical,
+                 priority="normal"):
+        # Identical files are skipped entirely: no backup, download or upload
+        if skip_identical and self.is_identical(source_server, source_file_path, destination_server, remote_path):
+            return {"skipped": True}
+
+        # The source is found before anything happens on the destination, a missing or ambiguous one changes nothing
+        source_info = self.get_server_info(source_server)
+        remote_file_path = self.find_file_on_server(source_info, source_file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {source_file_path} not found on {source_server}")
+        source_file_path = remote_file_path
+
+        # Back up the file the transfer is about to replace on the destination server
+        self.backup_file(destination_server, remote_path)
+
+        # Whatever happens next, the destination directory listing may have changed
+        self.invalidate_listing(destination_server, posixpath.dirname(remote_path))
+
+        # Bytes relayed between the servers wait for the bandwidth of both hosts and the link between them
+        source_host = source_info["hostname"]
+        destination_host = self.get_server_info(destination_server)["hostname"]
+        throttled = self.bandwidth.throttle(progress, source_host, destination_host, priority)
+
+        started = time.monotonic()
+        result = None
+        if self.remote_copy:
+            result = self.server_side_transfer(source_server, source_file_path, destination_server, remote_path,
+                                               callback=progress)
+        if result is not None:
+            pass
+        elif mode == "delta":
+            # Only send the blocks that changed, the result reports the bytes saved
+            result = self.delta_transfer(source_server, source_file_path, destination_server, remote_path, callback=throttled)
+        elif mode == "parallel":
+            result = self.parallel_transfer(source_server, source_file_path, destination_server, remote_path, callback=throttled)
+        elif mode == "stream":
+            # Relay the file from the source server straight to the destination server
+            result = self.relay_transfer(source_server, source_file_path, destination_server, remote_path, callback=throttled)
+        else:
+            # Find the file on the source server and copy it to the transferfiles cache, unless it is cached already
+            local_file_path = self.find_and_copy_file(source_server, source_file_path, callback=progress, priority=priority)
+
+            # Upload the file from the cache to the destination server, the cached copy stays pinned until then
+            try:
+                size = self.upload_to_server(local_file_path, destination_server, remote_path, callback=progress,
+                                             priority=priority)
+            finally:
+                self.cache.release(local_file_path)
+            result = {"size": size, "sent": size}
+
+        result["seconds"] = time.monotonic() - started
+        result["throughput"] = result["size"] / result["seconds"] if result["seconds"] else 0
+        if mode in ("stream", "delta") and "remote_copy" not in result and "compression" not in result:
+            # Plain relays over one session measure the link, delta ones while they send the changed blocks
+            self.link_speeds.record(source_server, destination_server, result["sent"],
+                                    result.get("send_seconds", result["seconds"]))
+        return result
+
+    def fanout_transfer(self, source_server, source_file_path, destination_servers, remote_path, progress=None,
+                        skip_identical=True, priority="normal"):
+        # Reads the source once and writes it to every destination at the same time.
+        # progress is called with (destination_server, transferred, total), the result has one entry per destination.
+        source_info = self.get_server_info(source_server)
+        remote_file_path = self.find_file_on_server(source_info, source_file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {source_file_path} not found on {source_server}")
+
+        # Server names that point to the same machine share one upload
+        hosts = {}
+        for server in destination_servers:
+            server_info = self.get_server_info(server)
+            hosts.setdefault((server_info["hostname"], server_info.get("port", 22)), []).append(server)
+        targets = [servers[0] for servers in hosts.values()]
+        results = {}
+
+        def prepare(server):
+            if skip_identical and self.is_identical(source_server, remote_file_path, server, remote_path):
+                return "skipped"
+            self.backup_file(server, remote_path)
+            self.invalidate_listing(server, posixpath.dirname(remote_path))
+            return "pending"
+
+        # Every destination is checked and backed up in parallel before the upload starts
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = {server: executor.submit(prepare, server) for server in targets}
+        for server, future in futures.items():
+            try:
+                results[server] = {"status": future.result(), "bytes": 0, "error": None}
+            except Exception as e:
+                results[server] = {"status": "failed", "bytes": 0, "error": str(e)}
+
+        pending = [server for server in targets if results[server]["status"] == "pending"]
+        if pending:
+            # Each destination waits for its own bandwidth, a slow or limited one is dropped after the stall timeout
+            throttles = {server: self.bandwidth.throttle(progress and (lambda transferred, total, server=server:
+                                                                       progress(server, transferred, total)),
+                                                         source_info["hostname"], self.get_server_info(server)["hostname"],
+                                                         priority)
+                         for server in pending}
+            started = time.monotonic()
+            with self.pool.sftps(source_info, *[self.get_server_info(server) for server in pending]) as sftps:
+                destinations = {server: (sftp, remote_path) for server, sftp in zip(pending, sftps[1:])}
+                outcome = fanout_file(sftps[0], remote_file_path, destinations,
+                                      callback=lambda server, transferred, total: throttles[server](transferred, total))
+            seconds = time.monotonic() - started
+            for server, (written, error) in outcome.items():
+                results[server].update(status="failed" if error else "done", bytes=written,
+                                       error=str(error) if error else None)
+                self.telemetry.record("fanout", source_info["hostname"], self.get_server_info(server)["hostname"],
+                                      seconds, written, type(error).__name__ if error else None)
+
+        for servers in hosts.values():
+            for server in servers[1:]:
+                results[server] = dict(results[servers[0]], same_host_as=servers[0])
+        return {"destinations": results}
+
+    def search_fleet(self, file_path, servers=None, timeout=60, checksum=True):
+        # Every server is searched at the same time, so the search takes as long as the slowest host.
+        # Returns one row per server with the path, size, mtime and checksum found there, or the error.
+        servers = list(servers or self.servers)
+        futures = {server: Future() for server in servers}
+
+        def search(server, future):
+            try:
+                future.set_result(self.search_server(server, file_path, checksum))
+            except Exception as e:
+                future.set_exception(e)
+
+        # Daemon threads, so a host that hangs past the timeout does not keep the process alive
+        for server, future in futures.items():
+            threading.Thread(target=search, args=(server, future), name=f"search-{server}", daemon=True).start()
+        wait(futures.values(), timeout=timeout)
+
+        rows = []
+        for server, future in futures.items():
+            row = {"server": server, "path": None, "size": None, "mtime": None, "checksum": None, "error": None}
+            if not future.done():
+                row["error"] = f"timed out after {timeout}s"
+            elif future.exception():
+                row["error"] = str(future.exception())
+            else:
+                row.update(future.result())
+            rows.append(row)
+
+        # The file differs across the fleet when the hosts that have it disagree on its content
+        found = [row for row in rows if row["path"]]
+        versions = {row["checksum"] if checksum else (row["size"], row["mtime"]) for row in found}
+        return {"file": file_path, "servers": rows, "found": len(found), "differs": len(versions) > 1}
+
+    def search_server(self, server_name, file_path, checksum=True):
+        server_info = self.get_server_info(server_name)
+        remote_file_path = self.find_file_on_server(server_info, file_path)
+        if not remote_file_path:
+            return {"error": "not found"}
+
+        with self.pool.session(server_info) as session:
+            attributes = session.open_sftp().stat(remote_file_path)
+            row = {"path": remote_file_path, "size": attributes.st_size, "mtime": attributes.st_mtime}
+            if checksum:
+                algorithm, digest = remote_checksum(session, remote_file_path)
+                row["checksum"] = f"{algorithm}:{digest}"
+        return row
+
+    def diff_trees(self, source_server, source_root, destination_server, destination_root, checksum=False):
+        # Sync plan of the files under source_root that are new or changed compared to destination_root
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+
+        def destination_tree(session):
+            try:
+                return remote_tree(session, destination_root)
+            except FileNotFoundError:
+                return {}
+
+        # Both trees are listed at the same time, each by one find on its own server
+        with self.pool.sessions(source_info, destination_info) as (source_session, destination_session):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                source_future = executor.submit(remote_tree, source_session, source_root)
+                destination_future = executor.submit(destination_tree, destination_session)
+                source_files, destination_files = source_future.result(), destination_future.result()
+
+                source_checksums = destination_checksums = None
+                if checksum:
+                    same_size = [path for path, (size, mtime) in source_files.items()
+                                 if path in destination_files and destination_files[path][0] == size]
+                    source_future = executor.submit(remote_checksums, source_session, source_root, same_size)
+                    destination_future = executor.submit(remote_checksums, destination_session, destination_root, same_size)
+                    source_checksums, destination_checksums = source_future.result(), destination_future.result()
+
+        plan = compare_trees(source_files, destination_files, source_checksums, destination_checksums)
+        plan.update(source_server=source_server, source_root=source_root,
+                    destination_server=destination_server, destination_root=destination_root)
+        return plan
+
+    def is_identical(self, source_server, file_path, destination_server, remote_path):
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+
+        remote_file_path = self.find_file_on_server(source_info, file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {file_path} not found on {source_server}")
+
+        with self.telemetry.phase("compare", source_info["hostname"], destination_info["hostname"]):
+            with self.pool.sessions(source_info, destination_info) as (source_session, destination_session):
+                return files_identical(source_session, remote_file_path, destination_session, remote_path)
+
+    def backup_file(self, server_name, file_path):
+        # Transfers back up exactly the path they replace, nothing when it does not exist yet
+        try:
+            return self.create_backup(server_name, file_path, search=False)
+        except Exception as e:
+            self.notify("Backup Error", f"Failed to backup file from {server_name}: {str(e)}")
+
+    def create_backup(self, server_name, file_path, search=True):
+        # Returns where the backup went, None when there is no file to back up.
+        # With search the file may also be found elsewhere on the server through the catalog.
+        server_info = self.get_server_info(server_name)
+        remote_file_path = self.find_file_on_server(server_info, file_path) if search else file_path
+        if not remote_file_path:
+            return None
+
+        if self.backup_mode == "local":
+            local_backup_path = os.path.join(self.backup_dir, os.path.basename(file_path))
+            try:
+                self.download_from_server(server_info, remote_file_path, local_backup_path, phase="backup")
+            except FileNotFoundError:
+                return None
+            return local_backup_path
+
+        # A snapshot on the server itself, a hardlink or local copy that costs no transfer
+        with self.telemetry.phase("backup", server_info["hostname"]), self.pool.session(server_info) as session:
+            backup_path = snapshot(session, remote_file_path, self.backup_generations)
+        if backup_path:
+            self.invalidate_listing(server_name, posixpath.dirname(backup_path))
+        return backup_path
+
+    def list_backups(self, server_name, file_path):
+        # Server-side snapshots of a file, newest first
+        with self.pool.sftp(self.get_server_info(server_name)) as sftp:
+            return list_backups(sftp, file_path)
+
+    def restore_backup(self, server_name, file_path, backup_path=None):
+        # Puts the newest snapshot, or the given one, back in place; the replaced version is snapshotted first
+        server_info = self.get_server_info(server_name)
+        with self.telemetry.phase("restore", server_info["hostname"]), self.pool.session(server_info) as session:
+            restored = restore(session, file_path, backup_path, self.backup_generations)
+        self.invalidate_listing(server_name, posixpath.dirname(file_path))
+        self.invalidate_listing(server_name, posixpath.dirname(restored))
+        return restored
+
+    def find_and_copy_file(self, server_name, file_path, callback=None, priority="normal"):
+        # Returns the cached copy of the file, pinned until it is passed to self.cache.release
+        server_info = self.get_server_info(server_name)
+
+        # Find the file on the source server and copy it to transferfiles
+        remote_file_path = self.find_file_on_server(server_info, file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {file_path} not found on {server_name}")
+
+        hostname = server_info["hostname"]
+        with self.cache.source_lock(hostname, remote_file_path):
+            with self.pool.sftp(server_info) as sftp:
+                attributes = sftp.stat(remote_file_path)
+            blob_path = self.cached_copy(server_info, remote_file_path, attributes.st_size, attributes.st_mtime)
+            if blob_path:
+                if callback:
+                    callback(attributes.st_size, attributes.st_size)
+                return blob_path
+
+            incoming_path = self.cache.incoming_path(hostname, remote_file_path)
+            self.download_from_server(server_info, remote_file_path, incoming_path, callback=callback, priority=priority)
+            return self.cache.add(hostname, remote_file_path, attributes.st_size, attributes.st_mtime, incoming_path)
+
+    def cached_copy(self, server_info, remote_file_path, size, mtime):
+        # Pinned cache path of this version of the remote file, None when it has to be downloaded
+        hostname = server_info["hostname"]
+        with self.telemetry.phase("cache", hostname, "local"):
+            sha256 = self.cache.lookup(hostname, remote_file_path, size, mtime)
+            if sha256 is None and self.cache.has_size(size):
+                # The same content may be cached from another server or path, a checksum on the server settles it
+                try:
+                    with self.pool.session(server_info) as session:
+                        algorithm, digest = remote_checksum(session, remote_file_path)
+                except IOError:
+                    return None
+                if algorithm == "sha256":
+                    sha256 = digest
+            if sha256 is None:
+                return None
+            blob_path = self.cache.acquire(sha256)
+            if blob_path:
+                self.cache.link(hostname, remote_file_path, size, mtime, sha256)
+            return blob_path
+
+    def list_directories_on_server(self, server_info, directory):
+        # Same output as ls -d directory/*/: full paths of the visible subdirectories
+        files, directories = self.list_files_and_dirs_on_server(server_info, directory)
+        return [posixpath.join(directory, name) for name in sorted(directories) if not name.startswith(".")]
+
+    def list_files_on_server(self, server_info, directory):
+        # Same output as ls directory: names of all visible entries
+        files, directories = self.list_files_and_dirs_on_server(server_info, directory)
+        return sorted(name for name in files + directories if not name.startswith("."))
+
+    def list_files_and_dirs_on_server(self, server_info, directory):
+        files = []
+        directories = []
+
+        for entry in self.list_entries(server_info, directory):
+            if entry.is_dir:
+                directories.append(entry.name)
+            else:
+                files.append(entry.name)
+
+        return files, directories
+
+    def list_entries(self, server_info, directory):
+        return [entry for batch in self.iter_directory(server_info, directory) for entry in batch]
+
+    def iter_directory(self, server_info, directory, batch_size=500, pattern=None, min_size=None, modified_after=None):
+        # Yields the entries of a directory in batches as they arrive, so large directories show up progressively
+        if pattern or min_size or modified_after:
+            yield from self.find_entries(server_info, directory, batch_size, pattern, min_size, modified_after)
+            return
+
+        server = server_info["hostname"]
+        directory = posixpath.normpath(directory)
+        entry, fresh = self.listings.get(server, directory)
+        if fresh:
+            yield from batches(entry.listing, batch_size)
+            return
+
+        with self.pool.sftp(server_info) as sftp:
+            # Past the TTL an unchanged directory mtime still proves the listing is current
+            mtime = sftp.stat(directory).st_mtime
+            if entry is not None and entry.mtime == mtime:
+                self.listings.renew(server, directory)
+                yield from batches(entry.listing, batch_size)
+                return
+
+            # listdir_iter reads the directory in readdir batches instead of waiting for the whole listing
+            entries = []
+            for attributes in sftp.listdir_iter(directory):
+                entries.append(entry_from_attributes(attributes))
+                if len(entries) % batch_size == 0:
+                    yield entries[-batch_size:]
+            if len(entries) % batch_size:
+                yield entries[-(len(entries) % batch_size):]
+
+        self.listings.put(server, directory, tuple(entries), mtime)
+
+    def find_entries(self, server_info, directory, batch_size, pattern=None, min_size=None, modified_after=None):
+        # Filtering runs on the server with find, only matching files and the subdirectories come back
+        filters = []
+        if pattern:
+            filters.append(f"-name {shlex.quote(pattern)}")
+        if min_size:
+            filters.append(f"-size +{int(min_size) - 1}c")
+        if modified_after:
+            filters.append(f"-newermt @{int(modified_after)}")
+        command = (f"find {shlex.quote(directory)} -mindepth 1 -maxdepth 1 \\( -type d -o \\( {' '.join(filters)} \\) \\) "
+                   f"-printf '%y\\t%s\\t%T@\\t%f\\0'")
+
+        with self.pool.session(server_info) as session:
+            stdin, stdout, stderr = session.exec_command(command)
+            pending = b""
+            entries = []
+            while True:
+                data = stdout.channel.recv(65536)
+                if not data:
+                    break
+                *lines, pending = (pending + data).split(b"\0")
+                for line in lines:
+                    kind, size, mtime, name = line.decode(errors="replace").split("\t", 3)
+                    entries.append(RemoteEntry(name, kind == "d", int(size), int(float(mtime))))
+                if len(entries) >= batch_size:
+                    yield entries
+                    entries = []
+            if entries:
+                yield entries
+            if stdout.channel.recv_exit_status() != 0:
+                raise IOError(f"Failed to list {directory}: {stderr.read().decode().strip()}")
+
+    def invalidate_listing(self, server_name, directory):
+        self.listings.invalidate(self.get_server_info(server_name)["hostname"], posixpath.normpath(directory))
+
+    def find_file_on_server(self, server_info, file_path):
+        server = server_info["hostname"]
+        with self.telemetry.phase("lookup", server), self.pool.sftp(server_info) as sftp:
+            # The requested path is checked first, the catalog covers copies kept in other directories
+            try:
+                sftp.stat(file_path)
+                return file_path
+            except FileNotFoundError:
+                pass
+
+            # Only a stale catalog is walked again, a miss otherwise stays one index query
+            if self.catalog.is_stale(server):
+                self.catalog.refresh(server, sftp)
+
+        return self.catalog.resolve(server, file_path)
+
+    def download_from_server(self, server_info, remote_path, local_path, callback=None, phase="download",
+                             priority="normal"):
+        key = f"get:{server_info['hostname']}:{remote_path}:{os.path.abspath(local_path)}"
+        callback = self.bandwidth.throttle(callback, server_info["hostname"], LOCAL, priority)
+
+        def download():
+            with self.pool.sftp(server_info) as sftp:
+                return resumable_download(sftp, remote_path, local_path, self.journal, key, callback=callback,
+                                          on_resume=callback.resume)
+
+        with self.telemetry.phase(phase, server_info["hostname"], "local") as measurement:
+            measurement.bytes = self.with_retries(download)
+        return measurement.bytes
+
+    def upload_to_server(self, local_path, server_name, remote_path, callback=None, priority="normal"):
+        server_info = self.get_server_info(server_name)
+        key = f"put:{server_info['hostname']}:{remote_path}:{os.path.abspath(local_path)}"
+        callback = self.bandwidth.throttle(callback, LOCAL, server_info["hostname"], priority)
+
+        def upload():
+            with self.pool.sftp(server_info) as sftp:
+                return resumable_upload(sftp, local_path, remote_path, self.journal, key, callback=callback,
+                                        on_resume=callback.resume)
+
+        try:
+            with self.telemetry.phase("upload", "local", server_info["hostname"]) as measurement:
+                measurement.bytes = self.with_retries(upload)
+            return measurement.bytes
+        finally:
+            self.invalidate_listing(server_name, posixpath.dirname(remote_path))
+
+    def with_retries(self, operation):
+        # Dropped connections are retried with exponential backoff, each attempt resumes from the journal
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return operation()
+            except (TransferCancelled, FileNotFoundError, PermissionError):
+                raise
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def relay_transfer(self, source_server, file_path, destination_server, remote_path, callback=None):
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+
+        remote_file_path = self.find_file_on_server(source_info, file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {file_path} not found on {source_server}")
+
+        with self.telemetry.phase("stream", source_info["hostname"], destination_info["hostname"]) as measurement, \
+                self.pool.sessions(source_info, destination_info) as (source_session, destination_session):
+            source_sftp = source_session.open_sftp()
+            compression = self.compression
+            if compression == "auto":
+                compression = auto_compression(source_session, remote_file_path,
+                                               source_sftp.stat(remote_file_path).st_size,
+                                               self.link_speeds.get(source_server, destination_server))
+            if compression == "gzip":
+                result = compressed_relay(source_session, remote_file_path, destination_session, remote_path,
+                                          callback=callback)
+            else:
+                sent = relay_file(source_sftp, remote_file_path, destination_session.open_sftp(), remote_path,
+                                  callback=callback)
+                result = {"size": sent, "sent": sent}
+            measurement.bytes = result["sent"]
+            return result
+
+    def server_side_transfer(self, source_server, file_path, destination_server, remote_path, callback=None):
+        # Copies the file without its bytes passing through this machine, or returns None when the pair does not allow it
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+        direct = destination_server in source_info.get("direct_copy_to", ())
+
+        remote_file_path = self.find_file_on_server(source_info, file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {file_path} not found on {source_server}")
+
+        source_host, destination_host = source_info["hostname"], destination_info["hostname"]
+        with self.pool.sessions(source_info, destination_info) as (source_session, destination_session):
+            # The same machine, or a shared mount where the destination sees the source file under the same path
+            with self.telemetry.phase("probe", source_host, destination_host):
+                shared = (same_host(source_info, destination_info)
+                          or shares_file(source_session, remote_file_path, destination_session))
+
+            result = None
+            if shared:
+                with self.telemetry.phase("remote_copy", source_host, destination_host) as measurement:
+                    measurement.bytes = server_copy(destination_session, remote_file_path, remote_path)
+                result = {"size": measurement.bytes, "sent": 0, "remote_copy": "cp"}
+            elif direct and not self.bandwidth.is_limited(source_host, destination_host):
+                # scp moves the bytes out of reach of the bandwidth limits, limited pairs are relayed instead
+                try:
+                    with self.telemetry.phase("remote_copy", source_host, destination_host) as measurement:
+                        measurement.bytes = direct_scp(source_session, remote_file_path, destination_session,
+                                                       destination_info, remote_path)
+                except IOError as e:
+                    # The servers are expected to trust each other, report it and relay the file instead
+                    self.notify("Direct Copy Error", f"Direct scp from {source_server} to {destination_server} failed, "
+                                                     f"relaying instead: {str(e)}")
+                else:
+                    if measurement.bytes is not None:
+                        result = {"size": measurement.bytes, "sent": 0, "remote_copy": "scp"}
+
+        if result is not None and callback:
+            callback(result["size"], result["size"])
+        return result
+
+    def delta_transfer(self, source_server, file_path, destination_server, remote_path, callback=None):
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+
+        remote_file_path = self.find_file_on_server(source_info, file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {file_path} not found on {source_server}")
+
+        with self.telemetry.phase("delta", source_info["hostname"], destination_info["hostname"]) as measurement, \
+                self.pool.sessions(source_info, destination_info) as (source_session, destination_session):
+            destination_sftp = destination_session.open_sftp()
+            try:
+                destination_sftp.stat(remote_path)
+            except FileNotFoundError:
+                # Nothing to compare against, so the whole file is sent
+                sent = relay_file(source_session.open_sftp(), remote_file_path, destination_sftp, remote_path, callback=callback)
+                result = {"size": sent, "sent": sent, "saved": 0}
+            else:
+                result = delta_copy(source_session, remote_file_path, destination_session, remote_path, callback=callback)
+            measurement.bytes = result["sent"]
+            return result
+
+    def parallel_transfer(self, source_server, file_path, destination_server, remote_path, callback=None):
+        source_info = self.get_server_info(source_server)
+        destination_info = self.get_server_info(destination_server)
+
+        remote_file_path = self.find_file_on_server(source_info, file_path)
+        if not remote_file_path:
+            raise FileNotFoundError(f"File {file_path} not found on {source_server}")
+
+        # A server may ask for smaller byte ranges than the engine default, the smaller setting of the pair wins
+        chunk_size = min(source_info.get("chunk_size", self.chunk_size), destination_info.get("chunk_size", self.chunk_size))
+        with self.telemetry.phase("parallel", source_info["hostname"], destination_info["hostname"]) as measurement:
+            result = parallel_relay(self.pool, source_info, remote_file_path, destination_info, remote_path,
+                                    streams=self.streams, chunk_size=chunk_size, callback=callback)
+            measurement.bytes = result["sent"]
+            return result
+
+    def close(self):
+        self.pool.close_all()
+        self.catalog.close()
+        self.cache.close()
+        self.telemetry.close()
+
+
+def batches(items, batch_size):
+    for index in range(0, len(items), batch_size):
+        yield items[index:index + batch_size]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m transferengine",
+                                     description="Transfer files between the Linux servers without the GUI.")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--timings", action="store_true", help="print the time spent in each phase per server pair")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this localhost port while running")
+    parser.add_argument("--inventory", default=INVENTORY_PATH, help="JSON or TOML file with the servers and their settings")
+    parser.add_argument("--engine", choices=ENGINES, default="paramiko",
+                        help="asyncio runs list, backup and transfer over one connection per host (needs asyncssh)")
+    parser.add_argument("--limit", action="append", default=[], metavar="SERVER=MB/s",
+                        help="cap the bandwidth of a server for this run, 0 holds its transfers; may be repeated")
+    parser.add_argument("--cache-size", type=float, default=CACHE_SIZE / 1024 / 1024 / 1024,
+                        help="GB of staged files kept in transferfiles, least recently used ones are removed first")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="list the files and directories of a remote directory")
+    list_parser.add_argument("server")
+    list_parser.add_argument("directory")
+
+    transfer_parser = subparsers.add_parser("transfer", help="back up and transfer files, directories or glob patterns")
+    transfer_parser.add_argument("source_server")
+    transfer_parser.add_argument("source_path", nargs="+")
+    transfer_parser.add_argument("destination_server", help="one server, or several separated by commas to fan out")
+    transfer_parser.add_argument("destination_path")
+    transfer_parser.add_argument("--workers", type=int, default=2, help="parallel transfers per server pair")
+    transfer_parser.add_argument("--mode", choices=TRANSFER_MODES, default="stream",
+                                 help="stream between the servers, stage through transferfiles, or send only changed blocks")
+    transfer_parser.add_argument("--streams", type=int, default=STREAMS, help="SSH sessions per file in parallel mode")
+    transfer_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE // 1024 // 1024,
+                                 help="size in MB of the byte ranges sent in parallel mode")
+    transfer_parser.add_argument("--compression", choices=COMPRESSION_MODES, default="auto",
+                                 help="gzip the stream relay, use SSH compression, or pick per file from its type and the link speed")
+    transfer_parser.add_argument("--retries", type=int, default=3,
+                                 help="attempts to resume an interrupted download or upload")
+    transfer_parser.add_argument("--no-remote-copy", action="store_true",
+                                 help="always pass the file through this machine, even between servers that share storage")
+    transfer_parser.add_argument("--force", action="store_true", help="transfer files even when the destination copy is identical")
+    transfer_parser.add_argument("--priority", choices=PRIORITIES, default="normal",
+                                 help="order of the transfers that share a limited server or link")
+    transfer_parser.add_argument("--concurrency", type=int, default=64,
+                                 help="files transferred at once with --engine asyncio")
+
+    backup_parser = subparsers.add_parser("backup", help="snapshot a remote file on its server")
+    backup_parser.add_argument("server")
+    backup_parser.add_argument("file_path")
+    backup_parser.add_argument("--local", action="store_true", help="download the backup to local_backup instead")
+
+    backups_parser = subparsers.add_parser("backups", help="list the snapshots of a remote file")
+    backups_parser.add_argument("server")
+    backups_parser.add_argument("file_path")
+
+    restore_parser = subparsers.add_parser("restore", help="put the newest snapshot of a remote file back in place")
+    restore_parser.add_argument("server")
+    restore_parser.add_argument("file_path")
+    restore_parser.add_argument("--backup", help="snapshot to restore instead of the newest, as listed by backups")
+
+    diff_parser = subparsers.add_parser("diff", help="compare two directory trees and optionally sync what differs")
+    diff_parser.add_argument("source_server")
+    diff_parser.add_argument("source_root")
+    diff_parser.add_argument("destination_server")
+    diff_parser.add_argument("destination_root")
+    diff_parser.add_argument("--checksum", action="store_true", help="compare files of the same size by sha256 instead of mtime")
+    diff_parser.add_argument("--sync", action="store_true", help="transfer the new and changed files")
+    diff_parser.add_argument("--workers", type=int, default=2, help="parallel transfers when syncing")
+    diff_parser.add_argument("--mode", choices=TRANSFER_MODES, default="stream", help="transfer mode when syncing")
+    diff_parser.add_argument("--priority", choices=PRIORITIES, default="bulk",
+                             help="order of the sync transfers on limited servers, behind single transfers by default")
+
+    search_parser = subparsers.add_parser("search", help="find a file on every server and compare the versions")
+    search_parser.add_argument("file_path")
+    search_parser.add_argument("--servers", help="comma-separated servers to search instead of all of them")
+    search_parser.add_argument("--timeout", type=int, default=60, help="seconds to wait for the slowest server")
+    search_parser.add_argument("--no-checksum", action="store_true", help="only compare size and mtime")
+
+    return parser
+
+
+def set_limits(engine, limits):
+    # --limit SERVER=MB/s overrides the inventory bandwidth of the server's host for this run
+    for limit in limits:
+        server, _, bandwidth = limit.partition("=")
+        try:
+            bandwidth = float(bandwidth)
+        except ValueError:
+            raise ValueError(f"Invalid limit '{limit}', use SERVER=MB/s")
+        engine.bandwidth.set_limit(engine.get_server_info(server)["hostname"], int(bandwidth * 1024 * 1024))
+
+
+def run_command(engine, args):
+    # Returns the result to print and the process exit code
+    set_limits(engine, args.limit)
+    if args.command == "list":
+        files, directories = engine.list_files_and_dirs_on_server(engine.get_server_info(args.server), args.directory)
+        return {"directory": args.directory, "directories": sorted(directories), "files": sorted(files)}, 0
+
+    if args.command == "backup":
+        if args.local:
+            engine.backup_mode = "local"
+        backup_path = engine.create_backup(args.server, args.file_path)
+        if not backup_path:
+            raise FileNotFoundError(f"File {args.file_path} not found on {args.server}")
+        return {"server": args.server, "file": args.file_path, "backup": backup_path}, 0
+
+    if args.command == "backups":
+        backups = [backup._asdict() for backup in engine.list_backups(args.server, args.file_path)]
+        return {"server": args.server, "file": args.file_path, "backups": backups}, 0
+
+    if args.command == "restore":
+        restored = engine.restore_backup(args.server, args.file_path, args.backup)
+        return {"server": args.server, "file": args.file_path, "restored": restored}, 0
+
+    if args.command == "diff":
+        plan = engine.diff_trees(args.source_server, args.source_root, args.destination_server, args.destination_root,
+                                 checksum=args.checksum)
+        if not args.sync:
+            return plan, 0
+        from treediff import batch_from_plan
+
+        # The plan already compared the files, so the batch does not check them again
+        batch = batch_from_plan(engine, plan, workers_per_pair=args.workers, mode=args.mode, skip_identical=False,
+                                priority=args.priority)
+        summary = batch.run()
+        plan["sync"] = {key: summary[key] for key in ("items", "statuses", "bytes", "seconds")}
+        plan["sync"]["failed"] = [{"source": item.source_path, "error": str(item.error)}
+                                  for item in batch.items if item.status == "failed"]
+        return plan, 0 if not plan["sync"]["failed"] else 1
+
+    if args.command == "search":
+        servers = args.servers.split(",") if args.servers else None
+        result = engine.search_fleet(args.file_path, servers, timeout=args.timeout, checksum=not args.no_checksum)
+        return result, 0 if result["found"] else 1
+
+    from batch import BatchTransfer
+
+    engine.streams = args.streams
+    engine.chunk_size = args.chunk_size * 1024 * 1024
+    engine.compression = args.compression
+    engine.retries = args.retries
+    engine.remote_copy = not args.no_remote_copy
+    engine.pool.max_sessions_per_host = max(engine.pool.max_sessions_per_host, args.streams)
+
+    destination_servers = args.destination_server.split(",")
+    if len(destination_servers) > 1:
+        return run_fanout(engine, args, destination_servers)
+
+    batch = BatchTransfer(engine, workers_per_pair=args.workers, mode=args.mode, skip_identical=not args.force,
+                          priority=args.priority)
+    for source_path in args.source_path:
+        batch.add(args.source_server, source_path, args.destination_server, args.destination_path)
+    summary = batch.run()
+    summary["transfers"] = [{"source": item.source_path, "destination": item.remote_path, "status": item.status,
+                             "bytes": item.bytes_transferred, "seconds": round(item.duration, 3), "result": item.result,
+                             "error": str(item.error) if item.error else None}
+                            for item in batch.items]
+    succeeded = summary["statuses"].get("done", 0) + summary["statuses"].get("skipped", 0)
+    return summary, 0 if succeeded == summary["items"] else 1
+
+
+def run_fanout(engine, args, destination_servers):
+    from batch import BatchTransfer
+
+    # Each source file is read once and written to all destination servers at the same time
+    batch = BatchTransfer(engine, skip_identical=not args.force)
+    for source_path in args.source_path:
+        batch.add(args.source_server, source_path, destination_servers[0], args.destination_path)
+
+    started = time.monotonic()
+    transfers = []
+    for item in batch.items:
+        item_started = time.monotonic()
+        results = {}
+        ready = []
+        for server in destination_servers:
+            try:
+                batch.ensure_remote_directory(server, item.destination_path)
+                ready.append(server)
+            except Exception as e:
+                results[server] = {"status": "failed", "bytes": 0, "error": str(e)}
+        if ready:
+            try:
+                results.update(engine.fanout_transfer(args.source_server, item.source_path, ready, item.remote_path,
+                                                      skip_identical=not args.force, priority=args.priority)["destinations"])
+            except Exception as e:
+                results.update({server: {"status": "failed", "bytes": 0, "error": str(e)} for server in ready})
+        for server in destination_servers:
+            result = results[server]
+            transfers.append({"source": item.source_path, "destination": f"{server}:{item.remote_path}",
+                              "status": result["status"], "bytes": result["bytes"],
+                              "seconds": round(time.monotonic() - item_started, 3), "result": None, "error": result["error"]})
+
+    seconds = time.monotonic() - started
+    statuses = {}
+    for transfer in transfers:
+        statuses[transfer["status"]] = statuses.get(transfer["status"], 0) + 1
+    total_bytes = sum(transfer["bytes"] for transfer in transfers if transfer["status"] == "done")
+    summary = {"items": len(transfers), "statuses": statuses, "bytes": total_bytes, "seconds": seconds,
+               "throughput": total_bytes / seconds if seconds else 0, "transfers": transfers}
+    succeeded = statuses.get("done", 0) + statuses.get("skipped", 0)
+    return summary, 0 if succeeded == len(transfers) else 1
+
+
+def print_result(result, as_json):
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+    if "transfers" in result:
+        for transfer in result["transfers"]:
+            error = f" ({transfer['error']})" if transfer["error"] else ""
+            note = ""
+            if transfer["result"] and "ratio" in transfer["result"]:
+                note = f" (gzip {transfer['result']['ratio']:.1f}x)"
+            elif transfer["result"] and "remote_copy" in transfer["result"]:
+                note = f" (server-side {transfer['result']['remote_copy']})"
+            print(f"{transfer['status']:9} {transfer['source']} -> {transfer['destination']}{note}{error}")
+        print(f"{result['items']} files, {result['bytes']} bytes in {result['seconds']:.1f}s "
+              f"({result['throughput'] / 1024 / 1024:.2f} MB/s)")
+    elif "unchanged" in result:
+        for change in ("new", "changed", "deleted"):
+            for path in result[change]:
+                print(f"{change:8} {path}")
+        print(f"{len(result['new'])} new, {len(result['changed'])} changed, {len(result['deleted'])} only on "
+              f"{result['destination_server']}, {result['unchanged']} unchanged")
+        if "sync" in result:
+            for failure in result["sync"]["failed"]:
+                print(f"failed   {failure['source']} ({failure['error']})")
+            statuses = ", ".join(f"{count} {status}" for status, count in result["sync"]["statuses"].items())
+            print(f"Sync: {statuses or 'nothing to do'} in {result['sync']['seconds']:.1f}s")
+    elif "found" in result:
+        for row in result["servers"]:
+            if row["error"]:
+                print(f"{row['server']:10} {row['error']}")
+            else:
+                modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["mtime"]))
+                print(f"{row['server']:10} {row['path']} {row['size']} {modified} {row['checksum'] or ''}")
+        print(f"Found on {result['found']} of {len(result['servers'])} servers"
+              + (", versions differ" if result["differs"] else ""))
+    elif "files" in result:
+        for directory in result["directories"]:
+            print(f"[D] {directory}")
+        for file in result["files"]:
+            print(file)
+    elif "backups" in result:
+        for backup in result["backups"]:
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(backup["created"]))
+            print(f"{created} {backup['size']:>12} {backup['path']}")
+        print(f"{len(result['backups'])} backups of {result['server']}:{result['file']}")
+    elif "restored" in result:
+        print(f"{result['server']}:{result['file']} restored from {result['restored']}")
+    else:
+        print(f"{result['server']}:{result['file']} backed up to {result['backup']}")
+
+
+def print_timings(rows):
+    # Goes to stderr so --json output stays parseable
+    for row in rows:
+        pair = f"{row['source']} -> {row['destination']}" if row["destination"] else row["source"]
+        throughput = f" {row['throughput'] / 1024 / 1024:.2f} MB/s" if row["bytes"] else ""
+        errors = f" {row['errors']} failed" if row["errors"] else ""
+        print(f"{row['phase']:10} {pair:60} {row['count']:4}x {row['seconds']:8.2f}s{throughput}{errors}", file=sys.stderr)
+
+
+def print_error(error, as_json):
+    if as_json:
+        print(json.dumps({"error": str(error)}))
+    else:
+        print(f"Error: {str(error)}", file=sys.stderr)
+
+
+def main_async(parser, args):
+    # asyncssh is only imported when the asyncio engine is picked
+    if (args.command not in ASYNC_COMMANDS
+            or args.command == "transfer" and ("," in args.destination_server or args.mode != "stream")
+            or args.command == "backup" and args.local):
+        parser.error("--engine asyncio runs list, backup and stream transfers to one destination server")
+    if args.limit or args.command == "transfer" and args.priority != "normal":
+        parser.error("--engine asyncio does not limit bandwidth, use the paramiko engine for --limit and --priority")
+    import asyncio
+    try:
+        from asyncengine import AsyncTransferEngine, run_command as run_async_command
+    except ImportError as e:
+        parser.error(f"--engine asyncio needs asyncssh ({e}), install it with pip install asyncssh")
+
+    async def run():
+        engine = AsyncTransferEngine(inventory_path=args.inventory)
+        if args.metrics_port:
+            engine.telemetry.serve(args.metrics_port)
+        try:
+            return await run_async_command(engine, args)
+        finally:
+            await engine.close()
+            if args.timings:
+                print_timings(engine.telemetry.summary())
+
+    try:
+        result, exit_code = asyncio.run(run())
+    except (TransferCancelled, KeyboardInterrupt):
+        return 130
+    except Exception as e:
+        print_error(e, args.json)
+        return 1
+
+    print_result(result, args.json)
+    return exit_code
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.engine == "asyncio":
+        return main_async(parser, args)
+    # Inventory and setup errors are reported like any other, so --json output stays parseable
+    engine = None
+    try:
+        engine = TransferEngine(notify=lambda title, message: print(f"{title}: {message}", file=sys.stderr),
+                                metrics_port=args.metrics_port, inventory_path=args.inventory,
+                                cache_size=int(args.cache_size * 1024 * 1024 * 1024))
+        result, exit_code = run_command(engine, args)
+    except TransferCancelled:
+        return 130
+    except Exception as e:
+        print_error(e, args.json)
+        return 1
+    finally:
+        if engine is not None:
+            engine.close()
+            if args.timings:
+                print_timings(engine.telemetry.summary())
+
+    print_result(result, args.json)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
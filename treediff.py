@@ -0,0 +1,101 @@
+import posixpath
+import shlex
+import stat
+import threading
+
+from backups import BACKUP_DIR
+from batch import BatchTransfer, TransferItem
+
+
+def remote_tree(session, root):
+    # {relative path: (size, mtime)} of every file under root, from one find on the server when possible.
+    # Backup snapshots are not part of the tree.
+    status, output, errors = session.run(f"find {shlex.quote(root)} -name {BACKUP_DIR} -prune -o -type f "
+                                         f"-printf '%P\\t%s\\t%T@\\0'")
+    if status != 0 and not output:
+        if "No such file" in errors:
+            raise FileNotFoundError(f"{root}: {errors.strip()}")
+        # No GNU find on the server, walk the tree over SFTP instead
+        return walk_tree(session.open_sftp(), root)
+
+    # A non-zero status with output means some subdirectories could not be read, the rest is still valid
+    tree = {}
+    for line in output.split("\0"):
+        if line:
+            path, size, mtime = line.rsplit("\t", 2)
+            tree[path] = (int(size), int(float(mtime)))
+    return tree
+
+
+def walk_tree(sftp, root):
+    tree = {}
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        for entry in sftp.listdir_attr(posixpath.join(root, relative)):
+            path = posixpath.join(relative, entry.filename)
+            if stat.S_ISDIR(entry.st_mode):
+                if entry.filename != BACKUP_DIR:
+                    pending.append(path)
+            elif stat.S_ISREG(entry.st_mode):
+                tree[path] = (entry.st_size, entry.st_mtime)
+    return tree
+
+
+def remote_checksums(session, root, paths):
+    # {relative path: sha256} for the given files, all hashed by one command on the server
+    if not paths:
+        return {}
+    stdin, stdout, stderr = session.exec_command(f"cd {shlex.quote(root)} && xargs -0 sha256sum --")
+
+    # The paths go in from another thread while the checksums are read, on a large tree the output would
+    # otherwise fill the channel window while the paths are still being written and both ends would wait
+    def write_paths():
+        try:
+            stdin.write("\0".join(paths))
+            stdin.channel.shutdown_write()
+        except (OSError, EOFError):
+            pass
+
+    writer = threading.Thread(target=write_paths, name="checksum-paths", daemon=True)
+    writer.start()
+    output = stdout.read()
+    writer.join()
+    checksums = {}
+    for line in output.decode().splitlines():
+        digest, path = line.split(None, 1)
+        checksums[path.lstrip("*")] = digest
+    return checksums
+
+
+def compare_trees(source_tree, destination_tree, source_checksums=None, destination_checksums=None):
+    # Without checksums a file changed when its size differs or the source is newer than the copy
+    plan = {"new": [], "changed": [], "deleted": [], "unchanged": 0}
+    for path, (size, mtime) in sorted(source_tree.items()):
+        if path not in destination_tree:
+            plan["new"].append(path)
+            continue
+        destination_size, destination_mtime = destination_tree[path]
+        if size != destination_size:
+            plan["changed"].append(path)
+        elif source_checksums is not None:
+            if source_checksums.get(path) != destination_checksums.get(path):
+                plan["changed"].append(path)
+            else:
+                plan["unchanged"] += 1
+        elif mtime > destination_mtime:
+            plan["changed"].append(path)
+        else:
+            plan["unchanged"] += 1
+    plan["deleted"] = sorted(path for path in destination_tree if path not in source_tree)
+    return plan
+
+
+def batch_from_plan(app, plan, **options):
+    # The new and changed files of a sync plan, as a batch that keeps their place under the destination root
+    batch = BatchTransfer(app, **options)
+    for path in plan["new"] + plan["changed"]:
+        batch.items.append(TransferItem(plan["source_server"], posixpath.join(plan["source_root"], path),
+                                        plan["destination_server"],
+                                        posixpath.normpath(posixpath.join(plan["destination_root"], posixpath.dirname(path)))))
+    return batch
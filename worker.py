@@ -0,0 +1,83 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TransferCancelled(Exception):
+    pass
+
+
+class BackgroundWorker:
+    def __init__(self, master, max_workers=4, poll_interval=50):
+        self.master = master
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transfer-worker")
+        self.results = queue.Queue()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.master.after(self.poll_interval, self._poll)
+
+    def submit(self, func, *args, on_success=None, on_error=None, key=None):
+        # Only the newest call for a key gets its callbacks, older answers are dropped
+        with self._lock:
+            generation = self._latest.get(key, 0) + 1
+            self._latest[key] = generation
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception as e:
+                if self._is_current(key, generation) and on_error:
+                    self.post(on_error, e)
+            else:
+                if self._is_current(key, generation) and on_success:
+                    self.post(on_success, result)
+
+        return self.executor.submit(run)
+
+    def _is_current(self, key, generation):
+        if key is None:
+            return True
+        with self._lock:
+            return self._latest.get(key) == generation
+
+    def post(self, callback, *args):
+        # Safe to call from any thread, the callback runs on the Tk main loop
+        self.results.put((callback, args))
+
+    def _poll(self):
+        try:
+            while True:
+                try:
+                    callback, args = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                callback(*args)
+        finally:
+            if not self._closed:
+                self.master.after(self.poll_interval, self._poll)
+
+    def shutdown(self):
+        self._closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TransferProgress:
+    def __init__(self, worker, callback):
+        self.worker = worker
+        self.callback = callback
+        self.cancel_event = threading.Event()
+        self.last_percent = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def __call__(self, transferred, total):
+        # Used as the sftp.get/put callback, so cancelling aborts the transfer at the next chunk
+        if self.cancel_event.is_set():
+            raise TransferCancelled("Transfer cancelled")
+        percent = int(transferred * 100 / total) if total else 100
+        if percent != self.last_percent:
+            self.last_percent = percent
+            self.worker.post(self.callback, transferred, total)